@@ -9,9 +9,10 @@ from geopy.geocoders import Nominatim
 from geopy.extra.rate_limiter import RateLimiter
 
 from src.create_db import Prediction
-from src.featurize import generate_distance
-from src.helpers import load_model
-from src.split import one_hot_encoder
+from src.featurize import generate_distance, generate_zones
+from src.helpers import load_model, load_yaml
+from src.parse_datetime import parse_datetime_fields, DAY_NAMES
+from src.encoder import OneHotLayout, encoder_path
 
 # Initialize the Flask application
 app = Flask('NYC_Taxi_Fare', template_folder="app/templates", static_folder="app/static")
@@ -28,6 +29,19 @@ logger.debug('Test log')
 # Initialize the database
 db = SQLAlchemy(app)
 
+# features are generated with the same configuration as in the model pipeline
+config_featurize = load_yaml(app.config['PIPELINE_CONFIG'])['featurize']
+
+# features are one-hot encoded with the layout saved next to the model by the train step, so they are in the same
+# columns as in training
+try:
+    layout = OneHotLayout.load(encoder_path(app.config['MODEL_PATH']))
+except FileNotFoundError:
+    logger.error("No one-hot layout found at %s" % encoder_path(app.config['MODEL_PATH']))
+    raise FileNotFoundError("The model at %s has no one-hot layout saved next to it at %s, e.g. it was trained before "
+                            "layouts were saved. Please rerun `make split train` to retrain the model with its layout."
+                            % (app.config['MODEL_PATH'], encoder_path(app.config['MODEL_PATH'])))
+
 
 @app.route('/')
 def index():
@@ -117,33 +131,38 @@ def predict():
                                    'passenger_count'])
 
         # generate distance
-        df = generate_distance(df)
+        df = generate_distance(df, **config_featurize['generate_distance'])
         logger.info("distance has been extracted")
 
-        # generate pickup_hour
+        # generate zone features, looked up in the same grid as in training
+        df = generate_zones(df, **config_featurize.get('generate_zones', {'generate': False}))
+        logger.info("zone features have been extracted")
+
+        # generate pickup_dayofweek
+        # the date input is in the format of %Y-%m-%d, so it is parsed as the fixed-width datetime at midnight
         try:
-            pickup_date = pd.to_datetime(pickup_date, infer_datetime_format=True)
-            pickup_dayofweek = pickup_date.day_name()
+            pickup_dayofweek = int(parse_datetime_fields([pickup_date + ' 00:00:00'])['dayofweek'][0])
             df.loc[0, 'pickup_dayofweek'] = pickup_dayofweek
-            logger.info("pickup_dayofweek has been extracted")
+            # ensure pickup_dayofweek column is an integer code to be consistent with training set and database
+            df['pickup_dayofweek'] = df['pickup_dayofweek'].astype(int)
+            logger.info("pickup_dayofweek has been extracted: %s" % DAY_NAMES[pickup_dayofweek])
         except:
             return render_template('pickup_date_error.html')
 
-        # generate pickup_dayofweek
+        # generate pickup_hour
+        # the time input is in the format of %H:%M or %H:%M:%S, so only hours and minutes are kept
         try:
-            pickup_time = pd.to_datetime(pickup_time, infer_datetime_format=True)
-            pickup_hour = pickup_time.hour
+            pickup_hour = int(parse_datetime_fields(['2000-01-01 ' + pickup_time[:5] + ':00'])['hour'][0])
             df.loc[0, 'pickup_hour'] = pickup_hour
             # ensure pickup_hour column is integer to be consistent with training set and database
             df['pickup_hour'] = df['pickup_hour'].astype(int)
             logger.info("pickup_hour has been extracted")
         except:
-            return render_template('pickup_hour_error.html')
+            return render_template('pickup_time_error.html')
 
 
-        # one hot encode features specified in configurations
-        one_hot_dict = app.config['ONE_HOT_ENCODER']
-        df = one_hot_encoder(df, one_hot_dict)
+        # one hot encode features into the feature vector of the model
+        features = layout.encode(df.loc[0].to_dict())
 
         logger.info("All features have been extracted and transformed")
 
@@ -161,7 +180,7 @@ def predict():
                 dropoff_latitude=float(df.loc[0, 'dropoff_latitude']),
                 passenger_count=int(df.loc[0, 'passenger_count']),
                 pickup_hour=int(pickup_hour),
-                pickup_dayofweek=str(pickup_dayofweek),
+                pickup_dayofweek=int(pickup_dayofweek),
             ).first()
         except Exception as e:
             logger.error("Failed to query database, since %s" % e)
@@ -179,7 +198,7 @@ def predict():
 
             # make prediction and add it to data frame
             try:
-                prediction = model.predict(df)
+                prediction = model.predict(features)
             except Exception as e:
                 logger.error("Failed to make prediction, since %s " % e)
 
@@ -198,7 +217,7 @@ def predict():
                     dropoff_latitude=float(df.loc[0, 'dropoff_latitude']),
                     passenger_count=int(df.loc[0, 'passenger_count']),
                     pickup_hour=int(pickup_hour),
-                    pickup_dayofweek=str(pickup_dayofweek),
+                    pickup_dayofweek=int(pickup_dayofweek),
                     predicted_fare=float(df.loc[0, 'predicted_fare'])
                 )
                 db.session.add(prediction1)
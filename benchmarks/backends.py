@@ -0,0 +1,63 @@
+"""Benchmark the model backends of src.train with their configured parameters: fit time, model size, single-row
+predict latency, batch predict throughput and RMSE on a test set
+
+Usage: python -m benchmarks.backends --rows 100000 --backends random_forest hist_gradient_boosting
+"""
+import argparse
+import numpy as np
+
+from src.encoder import OneHotLayout
+from src.helpers import load_yaml
+from src.train import BACKENDS, train_model, model_config, predict
+from src.metrics import StageMetrics
+from benchmarks.one_hot import make_features
+
+
+def make_fares(df, random_state=678):
+    """Make fares that depend on the distance, the hour and the day of week of random features, with noise"""
+    rng = np.random.RandomState(random_state)
+    fare = 2.5 + 100 * (df['distance'] + 74) + 2 * (df['pickup_hour'] >= 16) + (df['pickup_dayofweek'] >= 5) \
+        + rng.normal(0, 1, df.shape[0])
+    return fare.astype(np.float32)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark model backends")
+    parser.add_argument('--config', default='config/config.yaml',
+                        help='Path to configuration file (optional, default = config/config.yaml)')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000],
+                        help="Numbers of rows of training sets (optional, default = 10000 100000)")
+    parser.add_argument('--backends', nargs='+', default=['random_forest', 'hist_gradient_boosting'],
+                        help="Backends to compare (optional, default = random_forest hist_gradient_boosting)")
+    parser.add_argument('--metrics', default='evaluation/benchmark-backends.json',
+                        help="Path to save the metrics of each training run, as the pipeline metrics of the train step "
+                             "(optional, default = evaluation/benchmark-backends.json)")
+    args = parser.parse_args()
+
+    config = load_yaml(args.config)
+    one_hot_dict = config['split']['one_hot_encoder']['one_hot_dict']
+
+    print("%10s %24s %12s %12s %14s %14s %8s" % ('rows', 'backend', 'fit (s)', 'size (MB)', 'latency (ms)',
+                                                 'rows/sec', 'rmse'), flush=True)
+    for rows in args.rows:
+        df = make_features(rows)
+        df['fare_amount'] = make_fares(df)
+        layout = OneHotLayout(df.columns, one_hot_dict)
+        train = layout.transform(df).astype(np.float32)
+        test = make_features(rows // 3, random_state=679)
+        test['fare_amount'] = make_fares(test, random_state=679)
+        test = layout.transform(test).astype(np.float32)
+
+        for backend in args.backends:
+            if backend not in BACKENDS:
+                raise ValueError("%s is not a model backend. Please choose from %s" % (backend, list(BACKENDS)))
+
+            # the model costs are reported to the active step, as in the train step
+            with StageMetrics('benchmark-' + backend, save_to=args.metrics) as metrics:
+                model, _ = train_model(train, **model_config(dict(config['train'], backend=backend)))
+            profile = metrics.model
+            X_test = test.drop(columns=['fare_amount'])
+            rmse = np.sqrt(np.mean((predict(model, X_test) - test['fare_amount'].values) ** 2))
+            print("%10i %24s %12.3f %12.1f %14.3f %14.0f %8.3f"
+                  % (rows, backend, profile['fit_time_sec'], profile['model_size_mb'], profile['predict_latency_ms'],
+                     profile['predict_rows_per_sec'], rmse), flush=True)
@@ -0,0 +1,63 @@
+"""Benchmark parsing pickup_datetime with src.parse_datetime against pd.to_datetime
+
+Usage: python -m benchmarks.datetime_parsing --rows 1000000
+"""
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+from src.parse_datetime import parse_datetime_fields
+
+
+def make_datetimes(rows, random_state=678):
+    """Make random pickup_datetime strings in the format of raw_data.csv"""
+    rng = np.random.RandomState(random_state)
+    seconds = rng.randint(0, 7 * 365 * 24 * 3600, size=rows)
+    datetimes = pd.Timestamp('2009-01-01') + pd.to_timedelta(seconds, unit='s')
+    return pd.Series(datetimes.strftime('%Y-%m-%d %H:%M:%S UTC'))
+
+
+def time_it(func, repeat=3):
+    """Return the best wall time of `repeat` calls of func"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def pandas_fields(values):
+    """The pandas path used before: infer the format, then get hour and day name"""
+    datetimes = pd.to_datetime(values, infer_datetime_format=True)
+    return datetimes.dt.year, datetimes.dt.hour, datetimes.dt.day_name()
+
+
+def pandas_format_fields(values):
+    """pd.to_datetime with the explicit format used by filter_year"""
+    datetimes = pd.to_datetime(values, format="%Y-%m-%d %H:%M:%S UTC")
+    return datetimes.dt.year, datetimes.dt.hour, datetimes.dt.dayofweek
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark pickup_datetime parsing")
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help="Numbers of rows to parse (optional, default = 10000 100000 1000000)")
+    args = parser.parse_args()
+
+    print("%10s %18s %18s %18s %10s" % ('rows', 'pandas infer (s)', 'pandas format (s)', 'fixed width (s)',
+                                        'speedup'))
+    for rows in args.rows:
+        values = make_datetimes(rows)
+
+        # both paths have to agree before they are timed
+        fields = parse_datetime_fields(values)
+        year, hour, dayofweek = pandas_format_fields(values)
+        assert (fields['year'] == year.values).all() and (fields['hour'] == hour.values).all() \
+            and (fields['dayofweek'] == dayofweek.values).all()
+
+        infer_time = time_it(lambda: pandas_fields(values))
+        format_time = time_it(lambda: pandas_format_fields(values))
+        fast_time = time_it(lambda: parse_datetime_fields(values))
+        print("%10i %18.4f %18.4f %18.4f %9.1fx" % (rows, infer_time, format_time, fast_time, infer_time / fast_time))
@@ -0,0 +1,52 @@
+"""Benchmark generating distances with src.distance against the previous generate_distance with temporary columns
+
+Usage: python -m benchmarks.distance --rows 1000000
+"""
+import argparse
+import numpy as np
+
+from src.distance import distance_kernel
+from src.schema import apply_schema
+from benchmarks.datetime_parsing import time_it
+from benchmarks.synthetic import make_raw_rows
+
+
+def column_distance(df):
+    """The previous generate_distance: temporary lat_diff and lon_diff columns, then the Euclidean distance"""
+    df["lat_diff"] = np.abs(df.dropoff_latitude - df.pickup_latitude)
+    df["lon_diff"] = np.abs(df.dropoff_longitude - df.pickup_longitude)
+    df['distance'] = ((df.lat_diff) ** 2 + (df.lon_diff) ** 2) ** .5
+    df.drop(['lat_diff', 'lon_diff'], axis=1, inplace=True)
+    return df
+
+
+def kernel_distance(df, metrics):
+    """Distances computed by the kernel from the coordinate arrays of a data frame"""
+    return distance_kernel(df['pickup_longitude'].values, df['pickup_latitude'].values,
+                           df['dropoff_longitude'].values, df['dropoff_latitude'].values, metrics=metrics)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark distance generation")
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 1000000, 10000000],
+                        help="Numbers of rows (optional, default = 10000 100000 1000000 10000000)")
+    args = parser.parse_args()
+
+    print("%10s %16s %16s %22s %10s" % ('rows', 'columns (s)', 'euclidean (s)', 'all three metrics (s)', 'speedup'))
+    for rows in args.rows:
+        # coordinates are float32 as in the data read by every step
+        df = apply_schema(make_raw_rows(rows, dirty_fraction=0))
+        coordinates = df[['pickup_longitude', 'pickup_latitude', 'dropoff_longitude', 'dropoff_latitude']]
+
+        # both paths have to agree before they are timed
+        expected = column_distance(coordinates.copy())['distance'].values
+        assert np.array_equal(kernel_distance(coordinates, ['euclidean'])['euclidean'], expected)
+
+        column_time = time_it(lambda: column_distance(coordinates.copy()))
+        copy_time = time_it(lambda: coordinates.copy())
+        # the column path works on a copy, so the time of copying is left out
+        column_time = max(column_time - copy_time, 0)
+        euclidean_time = time_it(lambda: kernel_distance(coordinates, ['euclidean']))
+        all_time = time_it(lambda: kernel_distance(coordinates, ['euclidean', 'haversine', 'manhattan']))
+        print("%10i %16.4f %16.4f %22.4f %9.1fx" % (rows, column_time, euclidean_time, all_time,
+                                                    column_time / euclidean_time))
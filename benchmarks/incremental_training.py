@@ -0,0 +1,65 @@
+"""Benchmark training a random forest by chunks on all rows of a training set against the baseline trained on a sample
+of the configured size, by fit time, model size and RMSE on the same test set
+
+Usage: python -m benchmarks.incremental_training --rows 1000000 --chunksize 100000
+"""
+import argparse
+import numpy as np
+
+from src.encoder import OneHotLayout
+from src.helpers import load_yaml
+from src.train import train_model, train_incremental, model_config, predict
+from src.metrics import StageMetrics
+from benchmarks.one_hot import make_features
+from benchmarks.backends import make_fares
+
+
+def make_set(rows, layout, random_state):
+    """Make a one-hot encoded set of random features with fares"""
+    df = make_features(rows, random_state=random_state)
+    df['fare_amount'] = make_fares(df, random_state=random_state)
+    return layout.transform(df).astype(np.float32)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark training by chunks against training on a sample")
+    parser.add_argument('--config', default='config/config.yaml',
+                        help='Path to configuration file (optional, default = config/config.yaml)')
+    parser.add_argument('--rows', type=int, default=1000000,
+                        help="Number of rows of the training set (optional, default = 1000000)")
+    parser.add_argument('--chunksize', type=int, default=100000,
+                        help="Number of rows of each chunk (optional, default = 100000)")
+    parser.add_argument('--n_estimators', type=int, default=50,
+                        help="Number of trees of the baseline (optional, default = 50)")
+    parser.add_argument('--metrics', default='evaluation/benchmark-incremental.json',
+                        help="Path to save the metrics of each training run, as the pipeline metrics of the train step "
+                             "(optional, default = evaluation/benchmark-incremental.json)")
+    args = parser.parse_args()
+
+    config = load_yaml(args.config)
+    config_train = model_config(dict(config['train'], backend='random_forest'))
+    sampling = config['split']['stratified_sampling']
+    sample_rows = int(sampling['sample_obs'] * (1 - sampling['test_size']))
+
+    layout = OneHotLayout(make_features(1).columns.tolist() + ['fare_amount'],
+                          config['split']['one_hot_encoder']['one_hot_dict'])
+    train = make_set(args.rows, layout, random_state=678)
+    test = make_set(max(args.rows // 10, 10000), layout, random_state=679)
+    X_test = test.drop(columns=['fare_amount'])
+
+    runs = [('sample', sample_rows, lambda: train_model(train.iloc[:sample_rows],
+                                                        **dict(config_train, n_estimators=args.n_estimators))),
+            ('chunks', args.rows, lambda: train_incremental(
+                (train.iloc[start:start + args.chunksize] for start in range(0, args.rows, args.chunksize)),
+                **config_train, **(config['train'].get('incremental') or {})))]
+
+    print("%8s %12s %8s %12s %12s %14s %8s" % ('training', 'rows', 'trees', 'fit (s)', 'size (MB)', 'latency (ms)',
+                                               'rmse'), flush=True)
+    for name, rows, fit in runs:
+        with StageMetrics('benchmark-' + name, save_to=args.metrics) as metrics:
+            model, _ = fit()
+        profile = metrics.model
+        rmse = np.sqrt(np.mean((predict(model, X_test) - test['fare_amount'].values) ** 2))
+        print("%8s %12i %8i %12.3f %12.1f %14.3f %8.3f"
+              % (name, rows, len(model.estimators_), profile['fit_time_sec'], profile['model_size_mb'],
+                 profile['predict_latency_ms'], rmse), flush=True)
@@ -0,0 +1,66 @@
+"""Benchmark one-hot encoding with src.encoder.OneHotLayout against split.one_hot_encoder, for a single request of the
+app and for whole training sets
+
+Usage: python -m benchmarks.one_hot --rows 1000000
+"""
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+from src.encoder import OneHotLayout
+from src.helpers import load_yaml
+from src.split import one_hot_encoder
+from benchmarks.datetime_parsing import time_it
+
+
+def make_features(rows, random_state=678):
+    """Make random rows in the format of features-data.csv with the columns the app generates"""
+    rng = np.random.RandomState(random_state)
+    df = pd.DataFrame({col: rng.uniform(-74, -73, rows).astype(np.float32)
+                       for col in ['pickup_longitude', 'pickup_latitude', 'dropoff_longitude', 'dropoff_latitude',
+                                   'distance']})
+    df['passenger_count'] = rng.randint(1, 6, rows).astype(np.uint8)
+    df['pickup_hour'] = rng.randint(0, 24, rows).astype(np.uint8)
+    df['pickup_dayofweek'] = rng.randint(0, 7, rows).astype(np.uint8)
+    return df
+
+
+def latency(func, repeat=1000):
+    """Return the median wall time of `repeat` calls of func in microseconds"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return np.median(times) * 1e6
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark one-hot encoding")
+    parser.add_argument('--config', default='config/config.yaml',
+                        help='Path to configuration file (optional, default = config/config.yaml)')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help="Numbers of rows of training sets (optional, default = 10000 100000 1000000)")
+    args = parser.parse_args()
+
+    one_hot_dict = load_yaml(args.config)['split']['one_hot_encoder']['one_hot_dict']
+    request = make_features(1)
+    layout = OneHotLayout(request.columns, one_hot_dict)
+    row = request.loc[0].to_dict()
+    out = np.zeros((1, len(layout.features)), dtype=np.float32)
+
+    # the app used to build a one-row data frame and encode it with one_hot_encoder on every request
+    frame_time = latency(lambda: one_hot_encoder(pd.DataFrame([row]), one_hot_dict))
+    row_time = latency(lambda: layout.encode(row, out=out))
+    print("Single row: one_hot_encoder %.1f us, OneHotLayout.encode %.1f us (%.0fx)"
+          % (frame_time, row_time, frame_time / row_time))
+
+    print("%10s %22s %26s %24s" % ('rows', 'one_hot_encoder (s)', 'OneHotLayout.transform (s)',
+                                   'OneHotLayout.encode (s)'))
+    for rows in args.rows:
+        df = make_features(rows)
+        encoder_time = time_it(lambda: one_hot_encoder(df, one_hot_dict))
+        transform_time = time_it(lambda: layout.transform(df))
+        encode_time = time_it(lambda: layout.encode(df))
+        print("%10i %22.4f %26.4f %24.4f" % (rows, encoder_time, transform_time, encode_time))
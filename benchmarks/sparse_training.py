@@ -0,0 +1,50 @@
+"""Benchmark training and scoring the random forest on dense one-hot encoded features against sparse CSR features
+
+Usage: python -m benchmarks.sparse_training --rows 100000 1000000
+"""
+import argparse
+import numpy as np
+
+from src.encoder import OneHotLayout
+from src.helpers import load_yaml, FeatureMatrix
+from src.train import train_model, model_config
+from src.score import score_model
+from benchmarks.stages import time_call
+from benchmarks.one_hot import make_features
+
+
+def nbytes(X):
+    """Get the bytes taken by the values of a dense array or a CSR matrix"""
+    if isinstance(X, np.ndarray):
+        return X.nbytes
+    return X.data.nbytes + X.indices.nbytes + X.indptr.nbytes
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark training on dense and sparse features")
+    parser.add_argument('--config', default='config/config.yaml',
+                        help='Path to configuration file (optional, default = config/config.yaml)')
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help="Numbers of rows of training sets (optional, default = 10000 100000 1000000)")
+    parser.add_argument('--n_estimators', type=int, default=10,
+                        help="Number of trees (optional, default = 10)")
+    args = parser.parse_args()
+
+    config = load_yaml(args.config)
+    config_train = dict(model_config(dict(config['train'], backend='random_forest')), n_estimators=args.n_estimators)
+
+    print("%10s %8s %12s %14s %14s" % ('rows', 'format', 'size (MB)', 'train (s)', 'score (s)'), flush=True)
+    for rows in args.rows:
+        df = make_features(rows)
+        df['fare_amount'] = (2.5 + 100 * df['distance'] + df['pickup_hour']).astype(np.float32)
+        layout = OneHotLayout(df.columns, config['split']['one_hot_encoder']['one_hot_dict'])
+
+        # csr is fitted as a dense copy by default, and with the sparse splitter of the forest with dense_fit=False
+        for fmt, X, dense_fit in [('dense', layout.encode(df), True), ('csr', layout.encode_sparse(df), True),
+                                  ('csr-fit', layout.encode_sparse(df), False)]:
+            matrix = FeatureMatrix(X=X, y=df['fare_amount'].values, columns=layout.features,
+                                   target_column='fare_amount')
+            train_time, (model, _) = time_call(train_model, matrix, dense_fit=dense_fit, **config_train)
+            score_time, _ = time_call(score_model, matrix, model)
+            print("%10i %8s %12.1f %14.3f %14.3f" % (rows, fmt, nbytes(X) / 2 ** 20, train_time, score_time),
+                  flush=True)
@@ -0,0 +1,165 @@
+"""Benchmark the functions of each pipeline step on synthetic raw data of growing sizes, and report how their run
+time scales with the number of rows
+
+Usage: python -m benchmarks.stages --rows 10000 100000 1000000 10000000 --output evaluation/benchmark-stages.json
+"""
+import os
+import json
+import time
+import argparse
+import tempfile
+import warnings
+import numpy as np
+
+from src.helpers import load_yaml, check_path
+from src.filter import filter_year, process_by_chunk
+from src.clean import remove_missing_obs, clean_key, clean_fare_amount, clean_locations, clean_passenger_count
+from src.featurize import generate_hour, generate_dayofweek, generate_distance
+from src.split import stratified_sampling
+from src.encoder import OneHotLayout
+from src.train import train_model, model_config
+from src.score import score_model
+from benchmarks.synthetic import make_raw_rows, write_raw_data
+
+
+def time_call(func, *args, **kwargs):
+    """Call func once and return its wall time and its result"""
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def copy_of(df):
+    """Copy a data frame before a timed call, since most step functions drop rows or columns in place"""
+    return df.copy()
+
+
+def run_stages(rows, config, n_estimators=10, max_model_rows=1000000, tmp_dir=None):
+    """ Time the functions of each pipeline step on `rows` rows of synthetic raw data, each on the output of the
+    previous one, with the settings in the configuration
+    Args:
+        rows (int): The number of rows of raw data
+        config (`dict`): The configuration
+        n_estimators (int): The number of trees of the benchmarked model, instead of the configured one. Default: 10.
+        max_model_rows (int): Training and scoring are skipped when the training set has more rows. Default: 1000000.
+        tmp_dir (`str`): The directory to write raw data to for `process_by_chunk`. Default: a temporary directory.
+    Returns:
+        times (`dict`): Wall time in seconds of each function, or None if it was skipped
+    """
+    times = {}
+    raw = make_raw_rows(rows)
+
+    # filter: process_by_chunk reads raw data from a csv, by chunks of the configured size
+    config_filter = config['filter']
+    times['filter_year'], _ = time_call(filter_year, copy_of(raw), config_filter['year'])
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as directory:
+        path = os.path.join(directory, 'raw_data.csv')
+        write_raw_data(path, rows)
+        times['process_by_chunk'], _ = time_call(process_by_chunk, path, config_filter['year'], None,
+                                                 config_filter['chunksize'], log_per_chunks=10 ** 9)
+
+    # clean and featurize all raw rows rather than the filtered ones, so every function runs on about `rows` rows
+    config_clean = config['clean']
+    times['remove_missing_obs'], data = time_call(remove_missing_obs, raw)
+    times['clean_key'], data = time_call(clean_key, copy_of(data))
+    times['clean_fare_amount'], data = time_call(clean_fare_amount, copy_of(data),
+                                                 **config_clean['clean_fare_amount'])
+    times['clean_locations'], data = time_call(clean_locations, copy_of(data), **config_clean['clean_locations'])
+    times['clean_passenger_count'], data = time_call(clean_passenger_count, copy_of(data),
+                                                     **config_clean['clean_passenger_count'])
+
+    times['generate_hour'], data = time_call(generate_hour, copy_of(data))
+    times['generate_dayofweek'], data = time_call(generate_dayofweek, copy_of(data))
+    data = data.drop(['pickup_datetime'], axis=1)
+    times['generate_distance'], data = time_call(generate_distance, copy_of(data))
+
+    # sample every row, so the split scales with the data instead of the configured sample size
+    config_split = dict(config['split']['stratified_sampling'], sample_obs=data.shape[0])
+    times['stratified_sampling'], (train, test) = time_call(stratified_sampling, data, **config_split)
+    layout = OneHotLayout(data.columns, config['split']['one_hot_encoder']['one_hot_dict'],
+                          target_column=config['split']['target_column'])
+    times['one_hot_encoder'], train = time_call(layout.transform, train)
+    test = layout.transform(test)
+
+    if train.shape[0] > max_model_rows:
+        times['train'], times['score'] = None, None
+        return times
+
+    # the timings are of the random forest, with fewer trees than configured
+    config_train = dict(model_config(dict(config['train'], backend='random_forest')), n_estimators=n_estimators)
+    train = train.astype(np.float32)
+    times['train'], (model, _) = time_call(train_model, train, **config_train)
+    times['score'], _ = time_call(score_model, test.astype(np.float32), model, **config['score'])
+    return times
+
+
+def scaling_exponent(rows, seconds):
+    """Get the slope of log(seconds) over log(rows) between the two largest sizes that were timed, which is about 1
+    for a function linear in the number of rows and about 2 for a quadratic one"""
+    points = [(n, t) for n, t in zip(rows, seconds) if t is not None and t > 0]
+    if len(points) < 2:
+        return None
+    (n1, t1), (n2, t2) = points[-2:]
+    return np.log(t2 / t1) / np.log(n2 / n1)
+
+
+def report(results, baseline=None):
+    """Print the wall time of each function at each size, its throughput at the largest size and its scaling
+    exponent, and the ratio to a baseline report if given"""
+    rows = results['rows']
+    header = "%-22s" % 'function' + ''.join("%12s" % ('%.0e rows' % n) for n in rows) \
+        + "%14s %9s" % ('rows/sec', 'scaling')
+    print(header)
+    print('-' * len(header))
+
+    for name, seconds in results['stages'].items():
+        cells = ''.join("%12s" % ('-' if t is None else '%.4fs' % t) for t in seconds)
+        measured = [(n, t) for n, t in zip(rows, seconds) if t is not None]
+        throughput = '%.0f' % (measured[-1][0] / max(measured[-1][1], 1e-9)) if measured else '-'
+        exponent = scaling_exponent(rows, seconds)
+        print("%-22s%s%14s %9s" % (name, cells, throughput, '-' if exponent is None else '%.2f' % exponent))
+
+    if baseline is not None:
+        print("\nRatio of wall time to the baseline (> 1 is slower)")
+        for name, seconds in results['stages'].items():
+            before = dict(zip(baseline['rows'], baseline['stages'].get(name, [])))
+            ratios = [None if t is None or not before.get(n) else t / before[n] for n, t in zip(rows, seconds)]
+            print("%-22s%s" % (name, ''.join("%12s" % ('-' if r is None else '%.2fx' % r) for r in ratios)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark pipeline steps on synthetic raw data")
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 1000000, 10000000],
+                        help="Numbers of rows of raw data (optional, default = 10000 100000 1000000 10000000)")
+    parser.add_argument('--config', default='config/config.yaml',
+                        help='Path to configuration file (optional, default = config/config.yaml)')
+    parser.add_argument('--n_estimators', type=int, default=10,
+                        help="Number of trees of the benchmarked model (optional, default = 10)")
+    parser.add_argument('--max_model_rows', type=int, default=1000000,
+                        help="Skip training and scoring on larger training sets (optional, default = 1000000)")
+    parser.add_argument('--output', default=None,
+                        help="Path to save the timings as JSON (optional, default = None, which does not save them)")
+    parser.add_argument('--baseline', default=None,
+                        help="Path to timings saved by an earlier run to compare against (optional, default = None)")
+    args = parser.parse_args()
+
+    # deprecation warnings of the step functions would be repeated at every size
+    warnings.filterwarnings('ignore', category=FutureWarning)
+    config = load_yaml(args.config)
+    results = {'rows': args.rows, 'stages': {}}
+    for i, rows in enumerate(args.rows):
+        print("Benchmarking %i rows..." % rows)
+        for name, seconds in run_stages(rows, config, args.n_estimators, args.max_model_rows).items():
+            results['stages'].setdefault(name, [None] * len(args.rows))[i] = seconds
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+    report(results, baseline)
+
+    if args.output is not None:
+        check_path(args.output)
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print("Timings saved to %s" % args.output)
@@ -0,0 +1,115 @@
+"""Generate synthetic raw data in the format of raw_data.csv, including dirty rows that the clean step drops
+
+Usage: python -m benchmarks.synthetic --rows 1000000 --output data/synthetic-raw-data.csv
+"""
+import argparse
+import numpy as np
+import pandas as pd
+
+from src.helpers import check_path
+
+# columns of raw_data.csv
+RAW_COLUMNS = ['key', 'fare_amount', 'pickup_datetime', 'pickup_longitude', 'pickup_latitude', 'dropoff_longitude',
+               'dropoff_latitude', 'passenger_count']
+
+# pickups are spread around Midtown Manhattan, and the raw data covers 2009-01-01 to 2015-06-30
+NYC_CENTER = (-73.98, 40.75)
+START, END = np.datetime64('2009-01-01T00:00:00', 's'), np.datetime64('2015-07-01T00:00:00', 's')
+
+# share of trips by passenger count from 1 to 6
+PASSENGER_SHARES = [0.69, 0.15, 0.05, 0.02, 0.07, 0.02]
+
+# kinds of dirty rows seen in the raw data
+DIRTY_KINDS = ['missing_dropoff', 'zero_coordinates', 'outside_nyc', 'negative_fare', 'zero_fare',
+               'no_passengers', 'too_many_passengers']
+
+
+def make_raw_rows(rows, random_state=678, dirty_fraction=0.02, first_key=0):
+    """ Make random taxi rides in the format of raw_data.csv
+    Args:
+        rows (int): The number of rows
+        random_state (int): The seed of the random number generator. Default: 678.
+        dirty_fraction (float): The share of rows made dirty in one of the ways in DIRTY_KINDS. Default: 0.02.
+        first_key (int): The sequence number of the first row, which makes keys unique across calls. Default: 0.
+    Returns:
+        df (`pandas.DataFrame`): Raw data
+    """
+    rng = np.random.RandomState(random_state)
+
+    seconds = rng.randint(0, int((END - START) / np.timedelta64(1, 's')), size=rows)
+    datetimes = pd.Series(np.datetime_as_string(START + seconds.astype('timedelta64[s]'), unit='s'))
+    datetimes = datetimes.str.replace('T', ' ', regex=False)
+    # keys are the pickup time followed by a sequence number, e.g. 2010-01-05 16:52:16.0000002
+    sequence = pd.Series(np.arange(first_key, first_key + rows) % 10 ** 7).astype(str).str.zfill(7)
+    keys = datetimes + '.' + sequence
+
+    pickup_lon = rng.normal(NYC_CENTER[0], 0.04, size=rows)
+    pickup_lat = rng.normal(NYC_CENTER[1], 0.03, size=rows)
+    # trips go in a random direction over an exponentially distributed distance in degrees
+    trip = rng.exponential(0.03, size=rows)
+    angle = rng.uniform(0, 2 * np.pi, size=rows)
+    dropoff_lon = pickup_lon + trip * np.cos(angle)
+    dropoff_lat = pickup_lat + trip * np.sin(angle)
+
+    # fares are the initial charge plus a rate per km (about 100 km per degree) and a random tip-like noise
+    fare = 2.5 + 1.75 * trip * 100 + rng.exponential(1.0, size=rows)
+    passengers = rng.choice(np.arange(1, 7), size=rows, p=PASSENGER_SHARES)
+
+    df = pd.DataFrame({'key': keys, 'fare_amount': fare.round(2), 'pickup_datetime': datetimes + ' UTC',
+                       'pickup_longitude': pickup_lon.round(6), 'pickup_latitude': pickup_lat.round(6),
+                       'dropoff_longitude': dropoff_lon.round(6), 'dropoff_latitude': dropoff_lat.round(6),
+                       'passenger_count': passengers}, columns=RAW_COLUMNS)
+
+    dirty = np.flatnonzero(rng.uniform(size=rows) < dirty_fraction)
+    kinds = rng.randint(0, len(DIRTY_KINDS), size=dirty.shape[0])
+    for i, kind in enumerate(DIRTY_KINDS):
+        index = dirty[kinds == i]
+        if kind == 'missing_dropoff':
+            df.loc[index, ['dropoff_longitude', 'dropoff_latitude']] = np.nan
+        elif kind == 'zero_coordinates':
+            df.loc[index, ['pickup_longitude', 'pickup_latitude', 'dropoff_longitude', 'dropoff_latitude']] = 0
+        elif kind == 'outside_nyc':
+            df.loc[index, 'pickup_latitude'] = df.loc[index, 'pickup_latitude'] * 10
+        elif kind == 'negative_fare':
+            df.loc[index, 'fare_amount'] = -df.loc[index, 'fare_amount']
+        elif kind == 'zero_fare':
+            df.loc[index, 'fare_amount'] = 0
+        elif kind == 'no_passengers':
+            df.loc[index, 'passenger_count'] = 0
+        else:
+            df.loc[index, 'passenger_count'] = 208
+
+    return df
+
+
+def write_raw_data(path, rows, chunksize=1000000, random_state=678, dirty_fraction=0.02):
+    """ Write random taxi rides in the format of raw_data.csv by chunks, so memory usage is bounded by the chunk size
+    Args:
+        path (`str`): The path to save the raw data
+        rows (int): The number of rows
+        chunksize (int): The number of rows generated at once. Default: 1000000.
+        random_state (int): The seed of the first chunk, which is incremented for each following chunk. Default: 678.
+        dirty_fraction (float): The share of dirty rows. Default: 0.02.
+    Returns:
+        None
+    """
+    check_path(path)
+    for i, first_key in enumerate(range(0, rows, chunksize)):
+        chunk = make_raw_rows(min(chunksize, rows - first_key), random_state + i, dirty_fraction, first_key)
+        chunk.to_csv(path, index=False, mode='w' if i == 0 else 'a', header=(i == 0))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate synthetic raw data in the format of raw_data.csv")
+    parser.add_argument('--rows', type=int, default=1000000,
+                        help="Number of rows (optional, default = 1000000)")
+    parser.add_argument('--output', default='data/synthetic-raw-data.csv',
+                        help="Path to save the raw data (optional, default = data/synthetic-raw-data.csv)")
+    parser.add_argument('--dirty_fraction', type=float, default=0.02,
+                        help="Share of dirty rows (optional, default = 0.02)")
+    parser.add_argument('--random_state', type=int, default=678,
+                        help="Seed of the random number generator (optional, default = 678)")
+    args = parser.parse_args()
+
+    write_raw_data(args.output, args.rows, random_state=args.random_state, dirty_fraction=args.dirty_fraction)
+    print("%i rows of synthetic raw data saved to %s" % (args.rows, args.output))
@@ -32,11 +32,9 @@ else:
 # delay between geocoding calls
 MIN_DEALY_SECONDS = 1
 
-# trained model path
+# trained model path, next to which the train step saves the one-hot layout of its features (model/model.encoder.json)
 MODEL_PATH = "model/model.pkl"
 
-# dictionary to indicate what features need to be one-hot encoded
-# list all possible values for each feature for one-hot encoding
-ONE_HOT_ENCODER = {
-    'pickup_dayofweek': ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday'],
-    'pickup_hour': [str(x) for x in range(24)]}
+# configuration of the model pipeline, whose featurize section is used to generate the same features as in training
+PIPELINE_CONFIG = "config/config.yaml"
+
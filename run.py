@@ -5,13 +5,17 @@ import os
 from src.download import run_download
 from src.clean import run_clean
 from src.filter import run_filter
+from src.year_index import run_index
 from src.featurize import run_featurize
+from src.stream import run_stream
 from src.split import run_split
 from src.train import run_train
+from src.tune import run_tune
 from src.score import run_score
 from src.evaluate import run_evaluate
 
 from src.s3_upload import s3_upload
+from src.stage_cache import run_cached
 from src.create_db import create_local_db, create_RDS_db
 
 logging.config.fileConfig('config/logging/logging.conf', disable_existing_loggers=False)
@@ -23,6 +27,18 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Upload raw data to S3 and/or create database")
     subparsers = parser.add_subparsers()
 
+    # Arguments shared by pipeline steps, which are skipped if their inputs and configuration have not changed
+    cache_parser = argparse.ArgumentParser(add_help=False)
+    cache_parser.add_argument('--force', action='store_true',
+                              help='Rerun this step and mark all its downstream steps to rerun (optional)')
+    cache_parser.add_argument('--manifest', default='data/stage-manifest.json',
+                              help='Path to the manifest of step hashes used to skip unchanged steps '
+                                   '(optional, default = data/stage-manifest.json)')
+    cache_parser.add_argument('--metrics', default='evaluation/pipeline-metrics.json',
+                              help='Path to the JSON report that the wall time, rows, throughput, peak memory and '
+                                   'bytes read and written of this step are appended to '
+                                   '(optional, default = evaluation/pipeline-metrics.json)')
+
     # Sub-parser for downloading data from S3
     sb_download = subparsers.add_parser("download", description="Download raw data from S3")
     sb_download.add_argument('--s3_bucket', default='nw-lma-s3',
@@ -35,50 +51,98 @@ if __name__ == '__main__':
                                    "(optional, default = data/raw_data.csv)")
     sb_download.set_defaults(func=run_download)
 
+    # Sub-parser for indexing raw data by year
+    sb_index = subparsers.add_parser('index', description='Index blocks of raw data by pickup year',
+                                     parents=[cache_parser])
+    sb_index.add_argument('--input', '-i', default='data/raw_data.csv',
+                          help='Path to raw data to be indexed (optional, default = data/raw_data.csv)')
+    sb_index.add_argument('--output', default='data/raw_data.index.json',
+                          help='Path to save the year index (optional, default = data/raw_data.index.json)')
+    sb_index.add_argument('--config', default='config/config.yaml',
+                          help='Path to configuration file (optional, default = config/config.yaml)')
+    sb_index.set_defaults(func=run_index, stage='index')
+
     # Sub-parser for filtering data
-    sb_filter = subparsers.add_parser('filter', description='Filter raw data by a specific year')
+    sb_filter = subparsers.add_parser('filter', description='Filter raw data by a specific year',
+                                      parents=[cache_parser])
     sb_filter.add_argument('--input', '-i', default='data/raw_data.csv',
                            help='Path to raw data to be filtered (optional, default = data/raw_data.csv)')
     sb_filter.add_argument('--output', default='data/filtered-data.csv',
-                           help='Path to save filtered data CSV (optional, default = data/filtered-data.csv)')
+                           help='Path to save filtered data (.csv, .parquet or .feather) '
+                                '(optional, default = data/filtered-data.csv)')
     sb_filter.add_argument('--config', default='config/config.yaml',
                            help='Path to configuration file (optional, default = config/config.yaml)')
-    sb_filter.set_defaults(func=run_filter)
+    sb_filter.add_argument('--index', default=None,
+                           help='Path to the year index of raw data built by `index`. If it is up to date, only blocks '
+                                'containing the year are read (optional, default = None, which reads all raw data)')
+    sb_filter.add_argument('--resume', default=False, action='store_true',
+                           help='Continue from the checkpoint saved by an interrupted run, when `checkpoint_per_chunks` '
+                                'is set in the configuration (optional, default = False)')
+    sb_filter.set_defaults(func=run_filter, stage='filter')
 
     # Sub-parser for cleaning data
-    sb_clean = subparsers.add_parser('clean', description='Clean raw data')
+    sb_clean = subparsers.add_parser('clean', description='Clean raw data', parents=[cache_parser])
     sb_clean.add_argument('--input', '-i', default='data/raw_data.csv',
                            help='Path to raw data to be cleaned (optional, default = data/raw_data.csv)')
     sb_clean.add_argument('--output', default='data/clean-data.csv',
-                           help='Path to save clean data CSV (optional, default = data/clean-data.csv)')
+                           help='Path to save clean data (.csv, .parquet or .feather) '
+                                '(optional, default = data/clean-data.csv)')
     sb_clean.add_argument('--config', default='config/config.yaml',
                            help='Path to configuration file (optional, default = config/config.yaml)')
-    sb_clean.set_defaults(func=run_clean)
+    sb_clean.add_argument('--chunksize', type=int, default=None,
+                           help='Clean data by chunks of this number of rows, so memory usage does not grow with the '
+                                'data (optional, default = None, which cleans all data at once)')
+    sb_clean.set_defaults(func=run_clean, stage='clean')
 
     # Sub-parser for generating features
-    sb_featurize = subparsers.add_parser('featurize', description='Generate features')
+    sb_featurize = subparsers.add_parser('featurize', description='Generate features', parents=[cache_parser])
     sb_featurize.add_argument('--input', '-i', default='data/clean-data.csv',
                            help='Path to input data (optional, default = data/clean-data.csv)')
     sb_featurize.add_argument('--output', default='data/features-data.csv',
-                           help='Path to save output CSV (optional, default = data/features-data.csv)')
+                           help='Path to save output (.csv, .parquet or .feather) '
+                                '(optional, default = data/features-data.csv)')
     sb_featurize.add_argument('--config', default='config/config.yaml',
                            help='Path to configuration file (optional, default = config/config.yaml)')
-    sb_featurize.set_defaults(func=run_featurize)
+    sb_featurize.add_argument('--chunksize', type=int, default=None,
+                           help='Generate features by chunks of this number of rows, so memory usage does not grow '
+                                'with the data (optional, default = None, which reads all data at once)')
+    sb_featurize.set_defaults(func=run_featurize, stage='featurize')
+
+    # Sub-parser for filtering, cleaning and generating features in one pass
+    sb_stream = subparsers.add_parser('stream', description='Filter, clean and generate features by chunks in one pass',
+                                      parents=[cache_parser])
+    sb_stream.add_argument('--input', '-i', default='data/raw_data.csv',
+                           help='Path to raw data (optional, default = data/raw_data.csv)')
+    sb_stream.add_argument('--output', default='data/features-data.csv',
+                           help='Path to save output (.csv, .parquet or .feather) '
+                                '(optional, default = data/features-data.csv)')
+    sb_stream.add_argument('--config', default='config/config.yaml',
+                           help='Path to configuration file (optional, default = config/config.yaml)')
+    sb_stream.add_argument('--index', default=None,
+                           help='Path to the year index of raw data built by `index` (optional, default = None, which '
+                                'reads all raw data)')
+    sb_stream.set_defaults(func=run_stream, stage='stream')
 
     # Sub-parser for train test split
-    sb_split = subparsers.add_parser('split', description='Train test split')
+    sb_split = subparsers.add_parser('split', description='Train test split', parents=[cache_parser])
     sb_split.add_argument('--input', '-i', default='data/features-data.csv',
                            help='Path to input data (optional, default = data/features-data.csv)')
     sb_split.add_argument('--output_train', default='data/train-data.csv',
-                           help='Path to save training set CSV (optional, default = data/train-data.csv)')
+                           help='Path to save training set (.csv, .parquet or .feather) '
+                                '(optional, default = data/train-data.csv)')
     sb_split.add_argument('--output_test', default='data/test-data.csv',
-                           help='Path to save test set CSV (optional, default = data/test-data.csv)')
+                           help='Path to save test set (.csv, .parquet or .feather) '
+                                '(optional, default = data/test-data.csv)')
     sb_split.add_argument('--config', default='config/config.yaml',
                            help='Path to configuration file (optional, default = config/config.yaml)')
-    sb_split.set_defaults(func=run_split)
+    sb_split.add_argument('--chunksize', type=int, default=None,
+                           help='Sample from the input by chunks of this number of rows with one reservoir per '
+                                'stratum, so the input is not loaded into memory (optional, default = None, which '
+                                'reads all data at once)')
+    sb_split.set_defaults(func=run_split, stage='split')
 
     # Sub-parser for model training
-    sb_train = subparsers.add_parser('train', description='Train a logistic regression model')
+    sb_train = subparsers.add_parser('train', description='Train a logistic regression model', parents=[cache_parser])
     sb_train.add_argument('--input', '-i', default='data/train-data.csv',
                            help='Path to traininig data set (optional, default = data/train-data.csv)')
     sb_train.add_argument('--output_model', default='model/model.pkl',
@@ -87,29 +151,56 @@ if __name__ == '__main__':
                            help='Path to save feature importance(optional, default = evaluation/feature-imp.csv)')
     sb_train.add_argument('--config', default='config/config.yaml',
                            help='Path to configuration file (optional, default = config/config.yaml)')
-    sb_train.set_defaults(func=run_train)
+    sb_train.add_argument('--chunksize', type=int, default=None,
+                           help='Train by chunks of this number of rows, adding trees fitted on each chunk to the model, '
+                                'so the training set is not loaded into memory (optional, default = None, which '
+                                'trains on all data at once)')
+    sb_train.add_argument('--exclude', default=None,
+                           help='Path to a row manifest, e.g. data/test-data.rows. With --chunksize, train on every '
+                                'row of the features data it was sampled from except its rows, instead of the input '
+                                '(optional, default = None)')
+    sb_train.set_defaults(func=run_train, stage='train')
+
+    # Sub-parser for tuning model parameters
+    sb_tune = subparsers.add_parser('tune', description='Search model parameters with successive halving',
+                                    parents=[cache_parser])
+    sb_tune.add_argument('--input', '-i', default='data/train-data.csv',
+                           help='Path to traininig data set (optional, default = data/train-data.csv)')
+    sb_tune.add_argument('--output_params', default='config/tuned-params.yaml',
+                           help='Path to save the best parameters as a fragment of config.yaml '
+                                '(optional, default = config/tuned-params.yaml)')
+    sb_tune.add_argument('--output_leaderboard', default='evaluation/tune-leaderboard.csv',
+                           help='Path to save the RMSE and timings of every candidate '
+                                '(optional, default = evaluation/tune-leaderboard.csv)')
+    sb_tune.add_argument('--cache_dir', default='data/tune-cache',
+                           help='Directory of the cached CV folds and of the training set converted to a feature '
+                                'matrix (optional, default = data/tune-cache)')
+    sb_tune.add_argument('--config', default='config/config.yaml',
+                           help='Path to configuration file (optional, default = config/config.yaml)')
+    sb_tune.set_defaults(func=run_tune, stage='tune')
 
     # Sub-parser for scoring model
-    sb_score = subparsers.add_parser('score', description='Generate predictions on test set')
+    sb_score = subparsers.add_parser('score', description='Generate predictions on test set', parents=[cache_parser])
     sb_score.add_argument('--input_data', default='data/test-data.csv',
                            help='Path to test data set (optional, default = data/test-data.csv)')
     sb_score.add_argument('--input_model', default='model/model.pkl',
                            help='Path to trained model (optional, default = model/model.pkl)')
     sb_score.add_argument('--output', default='data/test-predictions.csv',
-                           help='Path to save predictions CSV (optional, default = data/test-predictions.csv)')
+                           help='Path to save predictions (.csv, .parquet or .feather) '
+                                '(optional, default = data/test-predictions.csv)')
     sb_score.add_argument('--config', default='config/config.yaml',
                            help='Path to configuration file (optional, default = config/config.yaml)')
-    sb_score.set_defaults(func=run_score)
+    sb_score.set_defaults(func=run_score, stage='score')
 
     # Sub-parser for evaluating model
-    sb_evaluate = subparsers.add_parser('evaluate', description='Evaluate model performance')
+    sb_evaluate = subparsers.add_parser('evaluate', description='Evaluate model performance', parents=[cache_parser])
     sb_evaluate.add_argument('--input', default='data/test-predictions.csv',
                            help='Path to test predictions data (optional, default = data/test-predictions.csv)')
     sb_evaluate.add_argument('--output', default='evaluation/test-metrics.txt',
                            help='Path to save evaluation metrics txt (optional, default = evaluation/test-metrics.txt)')
     sb_evaluate.add_argument('--config', default='config/config.yaml',
                            help='Path to configuration file (optional, default = config/config.yaml)')
-    sb_evaluate.set_defaults(func=run_evaluate)
+    sb_evaluate.set_defaults(func=run_evaluate, stage='evaluate')
 
     # The following functionality is not going to be used in the model pipeline
     # Sub-parser for uploading data to S3
@@ -136,4 +227,9 @@ if __name__ == '__main__':
     sb_create_RDS_db.set_defaults(func=create_RDS_db)
 
     args = parser.parse_args()
-    args.func(args)
+    if getattr(args, 'exclude', None) is not None and args.chunksize is None:
+        parser.error("--exclude requires --chunksize")
+    if getattr(args, 'stage', None) is not None:
+        run_cached(args.stage, args.func, args)
+    else:
+        args.func(args)
@@ -3,16 +3,26 @@ import numpy as np
 import pandas as pd
 from numbers import Number
 
-from src.helpers import read_csv, load_yaml, write_csv
+from src.helpers import read_data, read_data_chunks, load_yaml, write_data, ChunkWriter
+from src.metrics import StageMetrics, record_chunk
 
 logger = logging.getLogger(__name__)
 
-def remove_missing_obs(df):
-    """Remove observations with any missing values and return the cleaned data frame"""
+def nonmissing_mask(df):
+    """Get a boolean array that is True for observations without any missing values"""
     if not isinstance(df, pd.DataFrame):
         raise TypeError("The `df` input has to be pd.DataFrame")
 
-    df = df.dropna(axis=0)
+    mask = np.ones(df.shape[0], dtype=bool)
+    for col in df.columns:
+        mask &= df[col].notna().values
+    return mask
+
+
+def remove_missing_obs(df):
+    """Remove observations with any missing values and return the cleaned data frame"""
+    mask = nonmissing_mask(df)
+    df = df[mask]
     logger.info("Observations with any missing values have been dropped")
     return df
 
@@ -30,6 +40,23 @@ def clean_key(df):
     return df
 
 
+def fare_amount_mask(df, initial_charge=2.5):
+    """Get a boolean array that is True for observations whose fare_amount is no less than the initial charge of NYC
+    taxi, or None if data does not contain fare_amount. See `clean_fare_amount` for the arguments."""
+    if not isinstance(df, pd.DataFrame):
+        raise TypeError("The `df` input has to be pd.DataFrame")
+
+    if not isinstance(initial_charge, Number):
+        raise TypeError("The `initial_charge` input has to be numeric")
+
+    if initial_charge <= 0:
+        raise ValueError("The initial charge for fare amount has to be positive")
+
+    if 'fare_amount' not in list(df.columns):
+        return None
+    return ~(df['fare_amount'].values < initial_charge)
+
+
 def clean_fare_amount(df, initial_charge=2.5):
     """Clean fare_amount by dropping observations whose fare_amount < initial charge of NYC taxi.
 
@@ -41,23 +68,44 @@ def clean_fare_amount(df, initial_charge=2.5):
     Returns:
         df (`pandas.DataFrame`): The cleaned data frame
     """
-    if not isinstance(df, pd.DataFrame):
-        raise TypeError("The `df` input has to be pd.DataFrame")
+    mask = fare_amount_mask(df, initial_charge)
 
-    if not isinstance(initial_charge, Number):
-        raise TypeError("The `initial_charge` input has to be numeric")
-
-    if initial_charge <= 0:
-        raise ValueError("The initial charge for fare amount has to be positive")
-
-    if 'fare_amount' not in list(df.columns):
+    if mask is None:
         logger.warning("Failed to drop feature `fare_amount`: it does not exist in df. Original df has been returned.")
     else:
-        df.drop(index=df[(df.fare_amount < initial_charge)].index, inplace=True)
+        df.drop(index=df.index[~mask], inplace=True)
         logger.info("`fare_amount` has been cleaned.")
     return df
 
 
+def locations_mask(df, nyc_min_lon=-75, nyc_max_lon=-72, nyc_min_lat=39, nyc_max_lat=42):
+    """Get a boolean array that is True for observations whose drop-off and pickup locations are both in NYC. See
+    `clean_locations` for the arguments."""
+    if not isinstance(df, pd.DataFrame):
+        raise TypeError("The `df` input has to be pd.DataFrame")
+
+    if not all(isinstance(x, Number) for x in [nyc_min_lon, nyc_max_lon, nyc_min_lat, nyc_max_lat]):
+        raise TypeError("At least one longitude and latitude input is not numeric")
+
+    # check field exists and are numeric
+    for col in ['pickup_longitude', 'dropoff_longitude', 'pickup_latitude', 'dropoff_latitude']:
+        if col not in list(df.columns):
+            raise KeyError("Data does not contain a required location field. Columns in data are %s"
+                           % df.columns.to_list())
+
+        if not np.issubdtype(df[col].dtype, np.number):
+            raise TypeError("%s has to be numeric" % col)
+
+    mask = np.ones(df.shape[0], dtype=bool)
+    for col, min_value, max_value in [('pickup_longitude', nyc_min_lon, nyc_max_lon),
+                                      ('dropoff_longitude', nyc_min_lon, nyc_max_lon),
+                                      ('pickup_latitude', nyc_min_lat, nyc_max_lat),
+                                      ('dropoff_latitude', nyc_min_lat, nyc_max_lat)]:
+        values = df[col].values
+        mask &= ~((values < min_value) | (values > max_value))
+    return mask
+
+
 def clean_locations(df, nyc_min_lon=-75, nyc_max_lon=-72, nyc_min_lat=39, nyc_max_lat=42):
     """Clean longitude and latitude features by dropping observations with drop-off or pickup locations beyond NYC
 
@@ -71,31 +119,27 @@ def clean_locations(df, nyc_min_lon=-75, nyc_max_lon=-72, nyc_min_lat=39, nyc_ma
     Returns:
         df (`pandas.DataFrame`): The cleaned data frame
     """
-    if not isinstance(df, pd.DataFrame):
-        raise TypeError("The `df` input has to be pd.DataFrame")
+    mask = locations_mask(df, nyc_min_lon, nyc_max_lon, nyc_min_lat, nyc_max_lat)
+    df.drop(index=df.index[~mask], inplace=True)
+    logger.info("Location features have been cleaned.")
 
-    if not all(isinstance(x, Number) for x in [nyc_min_lon, nyc_max_lon, nyc_min_lat, nyc_max_lat]):
-        raise TypeError("At least one longitude and latitude input is not numeric")
+    return df
 
-    # check field exists and are numeric
-    if ('pickup_longitude' or 'dropoff_longitude' or 'pickup_latitude' or 'dropoff_latitude') not in list(df.columns):
-        raise KeyError("Data does not contain a required location field. Columns in data are %s" % df.columns.to_list())
 
-    for col in ['pickup_longitude', 'dropoff_longitude', 'pickup_latitude', 'dropoff_latitude']:
-        if not np.issubdtype(df[col].dtype, np.number):
-            raise TypeError("%s has to be numeric" % col)
+def passenger_count_mask(df, min_count=1, max_count=5):
+    """Get a boolean array that is True for observations whose passenger_count is in the range defined. See
+    `clean_passenger_count` for the arguments."""
+    if not isinstance(df, pd.DataFrame):
+        raise TypeError("The `df` input has to be pd.DataFrame")
 
-    df.drop(index=df[(df.pickup_longitude < nyc_min_lon)
-                     | (df.pickup_longitude > nyc_max_lon)
-                     | (df.dropoff_longitude < nyc_min_lon)
-                     | (df.dropoff_longitude > nyc_max_lon)
-                     | (df.pickup_latitude < nyc_min_lat)
-                     | (df.pickup_latitude > nyc_max_lat)
-                     | (df.dropoff_latitude < nyc_min_lat)
-                     | (df.dropoff_latitude > nyc_max_lat)].index, inplace=True)
-    logger.info("Location features have been cleaned.")
+    if not all(isinstance(x, int) for x in [min_count, max_count]):
+        raise TypeError("At least one count inputs is not an integer")
 
-    return df
+    if (min_count <= 0) | (min_count > max_count):
+        raise ValueError("min_count has to be positive and no greater than max_count")
+
+    values = df['passenger_count'].values
+    return ~((values < min_count) | (values > max_count))
 
 
 def clean_passenger_count(df, min_count=1, max_count=5):
@@ -109,39 +153,94 @@ def clean_passenger_count(df, min_count=1, max_count=5):
     Returns:
         df (`pandas.DataFrame`): The cleaned data frame
     """
-    if not isinstance(df, pd.DataFrame):
-        raise TypeError("The `df` input has to be pd.DataFrame")
+    mask = passenger_count_mask(df, min_count, max_count)
+    df.drop(index=df.index[~mask], inplace=True)
+    logger.info("`passenger_count` has been cleaned.")
+    return df
 
-    if not all(isinstance(x, int) for x in [min_count, max_count]):
-        raise TypeError("At least one count inputs is not an integer")
 
-    if (min_count <= 0) | (min_count > max_count):
-        raise ValueError("min_count has to be positive and no greater than max_count")
+# cleaning rules by their section in the `clean` configuration, each of which builds a mask of valid observations
+CLEAN_RULES = {
+    'clean_fare_amount': fare_amount_mask,
+    'clean_locations': locations_mask,
+    'clean_passenger_count': passenger_count_mask,
+}
 
-    df.drop(index=df[(df.passenger_count < min_count) | (df.passenger_count > max_count)].index, inplace=True)
-    logger.info("`passenger_count` has been cleaned.")
-    return df
+
+def validity_mask(df, config_clean):
+    """ Evaluate the rule of every section in the `clean` configuration, plus the removal of observations with missing
+    values, and combine them into one mask of valid observations
+    Args:
+        df (`pandas.DataFrame`): The data frame that needs to be cleaned
+        config_clean (`dict`): The `clean` section of the configuration, whose keys are rules in CLEAN_RULES and whose
+            values are the keyword arguments of the rules
+    Returns:
+        mask (`numpy.ndarray`): Boolean array that is True for observations passing every rule
+        rejected (`dict`): The number of observations failing each rule. An observation failing several rules is
+            counted for each of them.
+    """
+    for rule in config_clean:
+        if rule not in CLEAN_RULES:
+            raise KeyError("%s is not a cleaning rule. Rules are %s" % (rule, list(CLEAN_RULES)))
+
+    mask = nonmissing_mask(df)
+    rejected = {'remove_missing_obs': int(df.shape[0] - mask.sum())}
+
+    for rule, kwargs in config_clean.items():
+        rule_mask = CLEAN_RULES[rule](df, **(kwargs or {}))
+        if rule_mask is None:
+            logger.warning("Skipped %s, since its column does not exist in df." % rule)
+            continue
+        rejected[rule] = int(df.shape[0] - rule_mask.sum())
+        mask &= rule_mask
+
+    return mask, rejected
+
+
+def clean_data(data, config_clean):
+    """ Drop every observation failing a rule of the `clean` section of the configuration or having missing values with
+    a single combined mask, drop the `key` column, and return the clean data """
+    if not isinstance(data, pd.DataFrame):
+        raise TypeError("The `data` input has to be pd.DataFrame")
+
+    mask, rejected = validity_mask(data, config_clean)
+    for rule, count in rejected.items():
+        logger.info("%s rejected %i out of %i observations" % (rule, count, data.shape[0]))
+
+    # select the valid rows and all columns but `key` at once, instead of dropping rows rule by rule
+    columns = [col for col in data.columns if col != 'key']
+    data = data.loc[mask, columns]
+    logger.info("Data has been cleaned, and %i observations are kept" % data.shape[0])
+    return data
 
 
 def run_clean(args):
     """ Wrapper function to pass in args, load configuration, read data, and execute each step in data cleaning """
 
     logger.info("------------------Starting to clean data-----------------")
-    # read data and configuration
-    data = read_csv(args.input)
-    config = load_yaml(args.config)
-    config_clean = config['clean']
-
-    # remove observations with any missing values
-    nonmissing_data = remove_missing_obs(data)
-
-    # clean each feature
-    data = clean_key(nonmissing_data)
-    data = clean_fare_amount(data, **config_clean['clean_fare_amount'])
-    data = clean_locations(data, **config_clean['clean_locations'])
-    data = clean_passenger_count(data, **config_clean['clean_passenger_count'])
-
-    # save output
-    write_csv(data, path=args.output, description='Clean data')
+    with StageMetrics('clean', args.metrics) as metrics:
+        config = load_yaml(args.config)
+        metrics.read(args.input)
+
+        if args.chunksize is not None:
+            # clean data by chunks and append each clean chunk to the output, so memory usage is bounded by chunksize
+            with ChunkWriter(args.output) as writer:
+                for chunk in read_data_chunks(args.input, chunksize=args.chunksize):
+                    rows_in = chunk.shape[0]
+                    chunk = clean_data(chunk, config['clean'])
+                    record_chunk(rows_in, chunk.shape[0])
+                    writer.write(chunk)
+            logger.info("Clean data saved to %s by chunks" % args.output)
+        else:
+            # read data
+            data = read_data(args.input)
+            metrics.rows(rows_in=data.shape[0])
+
+            data = clean_data(data, config['clean'])
+
+            # save output
+            write_data(data, path=args.output, description='Clean data')
+            metrics.rows(rows_out=data.shape[0])
+        metrics.write(args.output)
 
     logger.info("------------------Finished cleaning data-----------------")
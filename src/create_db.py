@@ -3,7 +3,7 @@ import logging
 
 import sqlalchemy as sql
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, Float
+from sqlalchemy import Column, Integer, Float
 
 from src.helpers import check_path
 
@@ -24,7 +24,7 @@ class Prediction(Base):
     dropoff_latitude = Column(Float, unique=False, nullable=False)
     passenger_count = Column(Integer, unique=False, nullable=False)
     pickup_hour = Column(Integer, unique=False, nullable=False)
-    pickup_dayofweek = Column(String(100), unique=False, nullable=False)
+    pickup_dayofweek = Column(Integer, unique=False, nullable=False)
     predicted_fare = Column(Float, unique=False, nullable=False)
 
     def __repr__(self):
@@ -0,0 +1,100 @@
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# mean radius of the earth in km
+EARTH_RADIUS_KM = 6371.0088
+
+# distance metrics and the columns they are saved to. Euclidean distance is in degrees, as it has always been, and
+# haversine (great-circle) and Manhattan (L1 along north-south and east-west streets) distances are in km.
+DISTANCE_COLUMNS = {'euclidean': 'distance', 'haversine': 'haversine_km', 'manhattan': 'manhattan_km'}
+
+
+def distance_kernel(pickup_longitude, pickup_latitude, dropoff_longitude, dropoff_latitude, metrics=('euclidean',),
+                    dtype=None):
+    """ Compute several distance metrics between pickup and dropoff locations in one pass over contiguous arrays. The
+    coordinate differences are computed once and shared by all metrics, and every intermediate result is written into
+    preallocated arrays instead of allocating a new array per operation.
+    Args:
+        pickup_longitude, pickup_latitude, dropoff_longitude, dropoff_latitude (`numpy.ndarray` or `pandas.Series`):
+            Coordinates in degrees
+        metrics (:obj:`list` of :obj:`str`): The metrics to compute, out of the keys of DISTANCE_COLUMNS.
+            Default: ('euclidean',).
+        dtype (`str`): The float dtype of the computation and the outputs, e.g. float32. Default: None, which uses the
+            dtype of the coordinates (at least float32).
+    Returns:
+        distances (`dict`): Arrays of distances by metric
+    """
+    unknown = [metric for metric in metrics if metric not in DISTANCE_COLUMNS]
+    if unknown:
+        raise ValueError("%s are not distance metrics. Metrics are %s" % (unknown, list(DISTANCE_COLUMNS)))
+
+    coordinates = [np.asarray(values) for values in [pickup_longitude, pickup_latitude, dropoff_longitude,
+                                                      dropoff_latitude]]
+    if dtype is None:
+        dtype = np.result_type(np.float32, *coordinates)
+    dtype = np.dtype(dtype)
+    if not np.issubdtype(dtype, np.floating):
+        raise TypeError("The dtype of distances has to be a float dtype, but %s is obtained" % dtype)
+
+    # no copy is made if the coordinates are already contiguous arrays of dtype
+    lon1, lat1, lon2, lat2 = [np.ascontiguousarray(values, dtype=dtype) for values in coordinates]
+    n = lon1.shape[0]
+
+    # shared differences and work buffers
+    dlat = np.subtract(lat2, lat1, dtype=dtype)
+    dlon = np.subtract(lon2, lon1, dtype=dtype)
+    work = np.empty(n, dtype=dtype)
+
+    distances = {}
+    if 'euclidean' in metrics:
+        out = np.empty(n, dtype=dtype)
+        np.square(dlat, out=out)
+        np.square(dlon, out=work)
+        np.add(out, work, out=out)
+        distances['euclidean'] = np.sqrt(out, out=out)
+
+    if 'haversine' in metrics or 'manhattan' in metrics:
+        # from here on the differences are in radians
+        radians = dtype.type(np.pi / 180)
+        np.multiply(dlat, radians, out=dlat)
+        np.multiply(dlon, radians, out=dlon)
+
+    if 'haversine' in metrics:
+        # a = sin^2(dlat / 2) + cos(lat1) cos(lat2) sin^2(dlon / 2), and distance = 2 R arcsin(sqrt(a))
+        cos_product = np.empty(n, dtype=dtype)
+        np.multiply(lat1, radians, out=cos_product)
+        np.cos(cos_product, out=cos_product)
+        np.multiply(lat2, radians, out=work)
+        np.cos(work, out=work)
+        np.multiply(cos_product, work, out=cos_product)
+
+        out = np.empty(n, dtype=dtype)
+        np.multiply(dlon, dtype.type(0.5), out=work)
+        np.sin(work, out=work)
+        np.square(work, out=work)
+        np.multiply(cos_product, work, out=cos_product)
+        np.multiply(dlat, dtype.type(0.5), out=out)
+        np.sin(out, out=out)
+        np.square(out, out=out)
+        np.add(out, cos_product, out=out)
+        # rounding can push a slightly above 1 for antipodal points
+        np.clip(out, 0, 1, out=out)
+        np.sqrt(out, out=out)
+        np.arcsin(out, out=out)
+        distances['haversine'] = np.multiply(out, dtype.type(2 * EARTH_RADIUS_KM), out=out)
+
+    if 'manhattan' in metrics:
+        # R (|dlat| + |dlon| cos(mean latitude)), the length of a path along meridians and parallels
+        out = np.empty(n, dtype=dtype)
+        np.add(lat1, lat2, out=work)
+        np.multiply(work, dtype.type(np.pi / 360), out=work)
+        np.cos(work, out=work)
+        np.abs(dlon, out=out)
+        np.multiply(out, work, out=out)
+        np.abs(dlat, out=work)
+        np.add(out, work, out=out)
+        distances['manhattan'] = np.multiply(out, dtype.type(EARTH_RADIUS_KM), out=out)
+
+    return distances
@@ -0,0 +1,193 @@
+import os
+import json
+import logging
+import numpy as np
+import pandas as pd
+
+from src.helpers import check_path
+
+logger = logging.getLogger(__name__)
+
+
+def encoder_path(path):
+    """Get the path to the one-hot layout that is saved next to a training set or a model"""
+    return os.path.splitext(path)[0] + '.encoder.json'
+
+
+class OneHotLayout:
+    """A one-hot encoding fitted to the columns of the features data, with a fixed output column order
+
+    The output columns are the columns that are not encoded, in the order of the features data, followed by one
+    binary column `<feature>_<value>` per value of each encoded feature, in the order of `one_hot_dict`. Values that
+    are not in `one_hot_dict` are encoded as zeros in all columns of their feature. Since the order does not depend on
+    the values in the data, every set and every request encoded with the same layout has the same columns.
+
+    Args:
+        columns (:obj:`list` of :obj:`str`): The columns of the data to encode
+        one_hot_dict (`dict`): For each feature to encode, the list of all its possible values
+        target_column (`str`): Column name of the target, which is not a model feature. Default: fare_amount.
+        features (:obj:`list` of :obj:`str`): The output columns that the model uses, in order. Default: None, which
+            uses every output column except the target.
+    """
+
+    def __init__(self, columns, one_hot_dict, target_column='fare_amount', features=None):
+        missing = [feature for feature in one_hot_dict if feature not in columns]
+        if missing:
+            raise KeyError("%s need to be one-hot encoded but do not exist in data. Columns in data are %s"
+                           % (missing, list(columns)))
+
+        self.one_hot_dict = {feature: list(values) for feature, values in one_hot_dict.items()}
+        self.target_column = target_column
+        self.passthrough = [col for col in columns if col not in one_hot_dict]
+        self.columns = self.passthrough + [feature + '_' + str(value) for feature, values in self.one_hot_dict.items()
+                                           for value in values]
+        if features is None:
+            features = [col for col in self.columns if col != target_column]
+        unknown = [col for col in features if col not in self.columns]
+        if unknown:
+            raise KeyError("%s are not output columns of the one-hot layout" % unknown)
+        self.features = list(features)
+
+        # positions of each input column and each encoded value in the feature vector of the model, so a single row is
+        # written without looking up any names
+        positions = {col: i for i, col in enumerate(self.features)}
+        self._passthrough_positions = [(col, positions[col]) for col in self.passthrough if col in positions]
+        self._value_positions = {feature: {value: positions[feature + '_' + str(value)] for value in values
+                                           if feature + '_' + str(value) in positions}
+                                 for feature, values in self.one_hot_dict.items()}
+
+    def select(self, feature_columns=None):
+        """Get the layout of a model trained on some of the output columns, in the order of the output columns as
+        in `src.train.select_features`. Default: None, which uses every output column except the target."""
+        features = None if feature_columns is None else [col for col in self.columns if col in feature_columns]
+        return OneHotLayout(self.passthrough + list(self.one_hot_dict), self.one_hot_dict, self.target_column,
+                            features)
+
+    def transform(self, data):
+        """One-hot encode a data frame
+
+        Args:
+            data (`pandas.DataFrame`): The data frame with all columns the layout is fitted to
+
+        Returns:
+            data (`pandas.DataFrame`): The data frame with the output columns in order. Columns that are not encoded
+                keep their dtypes and binary columns are uint8.
+        """
+        if not isinstance(data, pd.DataFrame):
+            raise TypeError("The `data` input has to be pd.DataFrame")
+
+        blocks = [data[self.passthrough]]
+        for feature, values in self.one_hot_dict.items():
+            # position of the value of each row in the values of the feature, or -1 for values not in the layout
+            codes = pd.Index(values).get_indexer(data[feature])
+            binary = np.zeros((data.shape[0], len(values)), dtype=np.uint8)
+            known = codes >= 0
+            binary[np.flatnonzero(known), codes[known]] = 1
+            blocks.append(pd.DataFrame(binary, index=data.index,
+                                       columns=[feature + '_' + str(value) for value in values]))
+        return pd.concat(blocks, axis=1)
+
+    def encode(self, data, out=None):
+        """Write the model features of a single row or a batch of rows into a float32 array
+
+        Args:
+            data (`dict` or `pandas.DataFrame`): A single row as a dict of input column values, or a batch of rows
+            out (`numpy.ndarray`): A preallocated float32 array of shape (rows, len(features)) to write to. Default:
+                None, which allocates it.
+
+        Returns:
+            out (`numpy.ndarray`): The model features of the rows, with the columns in the order of `features`
+        """
+        rows = 1 if isinstance(data, dict) else data.shape[0]
+        if out is None:
+            out = np.zeros((rows, len(self.features)), dtype=np.float32)
+        else:
+            out[:] = 0
+
+        if isinstance(data, dict):
+            # single-row fast path: one assignment per input column
+            row = out[0]
+            for col, position in self._passthrough_positions:
+                row[position] = float(data[col])
+            for feature, positions in self._value_positions.items():
+                position = positions.get(data[feature])
+                if position is not None:
+                    row[position] = 1
+            return out
+
+        for col, position in self._passthrough_positions:
+            out[:, position] = data[col].values
+        for feature, positions in self._value_positions.items():
+            if not positions:
+                continue
+            codes = pd.Index(list(positions)).get_indexer(data[feature])
+            known = np.flatnonzero(codes >= 0)
+            out[known, np.fromiter(positions.values(), dtype=np.int64)[codes[known]]] = 1
+        return out
+
+    def encode_sparse(self, data):
+        """Encode the model features of a batch of rows as a CSR matrix, which only stores the values of the columns
+        that are not encoded and a single 1 per encoded feature of each row, instead of a dense column per value
+
+        Args:
+            data (`pandas.DataFrame`): The batch of rows
+
+        Returns:
+            matrix (`scipy.sparse.csr_matrix`): The float32 model features of the rows, with the columns in the order
+                of `features`
+        """
+        from scipy import sparse
+
+        if not isinstance(data, pd.DataFrame):
+            raise TypeError("The `data` input has to be pd.DataFrame")
+
+        rows = data.shape[0]
+        # one entry per row for each column that is not encoded and each encoded feature, in increasing column order
+        # since the columns that are not encoded come first in `features`, followed by the encoded features in order
+        indices = [np.full(rows, position, dtype=np.int32) for _, position in self._passthrough_positions]
+        values = [data[col].to_numpy(dtype=np.float32) for col, _ in self._passthrough_positions]
+        known = [np.ones(rows, dtype=bool)] * len(indices)
+        for feature, positions in self._value_positions.items():
+            if not positions:
+                continue
+            codes = pd.Index(list(positions)).get_indexer(data[feature])
+            indices.append(np.fromiter(positions.values(), dtype=np.int32)[codes])
+            values.append(np.ones(rows, dtype=np.float32))
+            # values not in the layout have no entry
+            known.append(codes >= 0)
+
+        if not indices:
+            return sparse.csr_matrix((rows, len(self.features)), dtype=np.float32)
+
+        known = np.column_stack(known)
+        indptr = np.zeros(rows + 1, dtype=np.int64)
+        np.cumsum(known.sum(axis=1), out=indptr[1:])
+        return sparse.csr_matrix((np.column_stack(values)[known], np.column_stack(indices)[known], indptr),
+                                 shape=(rows, len(self.features)))
+
+    def to_dict(self):
+        """Get the layout as a JSON-serializable dict"""
+        return {'columns': self.passthrough + list(self.one_hot_dict), 'one_hot_dict': self.one_hot_dict,
+                'target_column': self.target_column, 'features': self.features, 'output_columns': self.columns}
+
+    @classmethod
+    def from_dict(cls, layout):
+        """Build a layout from a dict made by `to_dict`"""
+        return cls(layout['columns'], layout['one_hot_dict'], layout['target_column'], layout['features'])
+
+    def save(self, path):
+        """Save the layout as JSON"""
+        check_path(path)
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+        logger.info("One-hot layout with %i features saved to %s" % (len(self.features), path))
+
+    @classmethod
+    def load(cls, path):
+        """Load a layout saved by `save`"""
+        if os.path.exists(path) is False:
+            raise FileNotFoundError("%s is invalid. Please provide a valid one-hot layout saved by the split or train "
+                                    "step." % path)
+
+        with open(path, 'r') as f:
+            return cls.from_dict(json.load(f))
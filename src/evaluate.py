@@ -3,7 +3,8 @@ import logging
 import pandas as pd
 from sklearn.metrics import mean_absolute_error, mean_squared_error, r2_score
 
-from src.helpers import read_csv, load_yaml, check_path
+from src.helpers import read_data, load_yaml, check_path
+from src.metrics import StageMetrics
 
 logger = logging.getLogger(__name__)
 
@@ -53,10 +54,15 @@ def run_evaluate(args):
 
     logger.info("-------------Starting to evaluate model-------------")
 
-    # load configuration
-    config = load_yaml(args.config)
-    # read data
-    data = read_csv(args.input)
-    evaluate_model(data, save_to=args.output, **config['evaluate'])
+    with StageMetrics('evaluate', args.metrics) as metrics:
+        # load configuration
+        config = load_yaml(args.config)
+        # read data
+        data = read_data(args.input, columns=[config['evaluate']['y_test_name'], config['evaluate']['ypred_name']])
+        metrics.read(args.input)
+        metrics.rows(rows_in=data.shape[0])
+
+        evaluate_model(data, save_to=args.output, **config['evaluate'])
+        metrics.write(args.output)
     logger.info("-------------Finished evaluating model-------------")
 
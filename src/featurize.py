@@ -2,7 +2,11 @@ import logging
 import numpy as np
 import pandas as pd
 
-from src.helpers import read_csv, load_yaml, write_csv
+from src.helpers import read_data, read_data_chunks, load_yaml, write_data, ChunkWriter
+from src.metrics import StageMetrics, record_chunk
+from src.distance import distance_kernel, DISTANCE_COLUMNS
+from src.parse_datetime import parse_datetime_fields
+from src.zones import build_zone_grid, zone_ids
 
 logger = logging.getLogger(__name__)
 
@@ -18,14 +22,14 @@ def generate_hour(df, generate=True):
             raise KeyError("Data does not contain a pickup_datetime field. Columns in data are %s"
                            % df.columns.to_list())
 
-        df['pickup_hour'] = df['pickup_datetime'].dt.hour
+        df['pickup_hour'] = parse_datetime_fields(df['pickup_datetime'])['hour']
         logger.info("`pickup_hour` column has been generated.")
     return df
 
 
 def generate_dayofweek(df, generate=True):
-    """Generate day of week from pickup_datetime and one-hot encode it and return the new df,
-    if generate is True (Default: True)"""
+    """Generate day of week from pickup_datetime as an integer code (Monday = 0, ..., Sunday = 6) and return the new
+    df, if generate is True (Default: True). Day names are only looked up in DAY_NAMES for display."""
     if generate:
         if not isinstance(df, pd.DataFrame):
             raise TypeError("The `df` input has to be pd.DataFrame")
@@ -34,13 +38,26 @@ def generate_dayofweek(df, generate=True):
             raise KeyError("Data does not contain a pickup_datetime field. Columns in data are %s"
                            % df.columns.to_list())
 
-        df['pickup_dayofweek'] = df['pickup_datetime'].dt.day_name()
+        df['pickup_dayofweek'] = parse_datetime_fields(df['pickup_datetime'])['dayofweek'].astype(np.uint8)
         logger.info("`pickup_dayofweek` column has been generated.")
     return df
 
 
-def generate_distance(df, generate=True):
-    """Generate distance between dropoff and pickup locations and return the new df, if generate is True (Default: True)"""
+def generate_distance(df, generate=True, metrics=('euclidean',), dtype=None):
+    """Generate distances between dropoff and pickup locations and return the new df, if generate is True (Default: True)
+
+    Args:
+        df (`pandas.DataFrame`): The data frame with pickup and dropoff longitude and latitude
+        generate (bool): Whether to generate distances. Default: True.
+        metrics (:obj:`list` of :obj:`str`): The distance metrics to generate: `euclidean` (in degrees, saved to
+            `distance`), `haversine` (in km, saved to `haversine_km`) and/or `manhattan` (in km, saved to
+            `manhattan_km`). Default: ('euclidean',).
+        dtype (`str`): The float dtype of the distances, e.g. float32. Default: None, which uses the dtype of the
+            coordinates.
+
+    Returns:
+        df (`pandas.DataFrame`): The data frame with distance columns generated
+    """
     if generate:
         if not isinstance(df, pd.DataFrame):
             raise TypeError("The `df` input has to be pd.DataFrame")
@@ -53,33 +70,62 @@ def generate_distance(df, generate=True):
             if not np.issubdtype(df[col].dtype, np.number):
                 raise TypeError("%s has to be numeric" % col)
 
-        # calculate difference in latitude and longitude
-        df["lat_diff"] = np.abs(df.dropoff_latitude - df.pickup_latitude)
-        df["lon_diff"] = np.abs(df.dropoff_longitude - df.pickup_longitude)
+        # every metric is computed from the same coordinate differences, without temporary columns
+        distances = distance_kernel(df['pickup_longitude'].values, df['pickup_latitude'].values,
+                                    df['dropoff_longitude'].values, df['dropoff_latitude'].values,
+                                    metrics=metrics, dtype=dtype)
+        for metric, values in distances.items():
+            df[DISTANCE_COLUMNS[metric]] = values
+        logger.info("%s columns have been generated." % [DISTANCE_COLUMNS[metric] for metric in distances])
+    return df
 
-        # calculate distance
-        df['distance'] = ((df.lat_diff) ** 2 + (df.lon_diff) ** 2) ** .5
 
-        # drop temporary variables
-        df.drop(['lat_diff', 'lon_diff'], axis=1, inplace=True)
-        logger.info("`distance` column has been generated.")
-    return df
+def generate_zones(df, generate=True, min_lon=-75, max_lon=-72, min_lat=39, max_lat=42, cell_size=0.01,
+                   landmarks=None):
+    """Generate pickup and dropoff zone IDs on a fixed grid, and the distances in km from each zone to landmarks, and
+    return the new df, if generate is True (Default: True)
+
+    Args:
+        df (`pandas.DataFrame`): The data frame with pickup and dropoff longitude and latitude
+        generate (bool): Whether to generate zone features. Default: True.
+        min_lon, max_lon, min_lat, max_lat (float): The bounding box of the grid. Default: the bounds of NYC used by
+            `clean_locations`.
+        cell_size (float): The width and height of a zone in degrees. Default: 0.01.
+        landmarks (`dict`): Landmark names and their [longitude, latitude]. Default: None, which uses JFK, LGA and
+            Midtown in `src.zones.LANDMARKS`.
+
+    Returns:
+        df (`pandas.DataFrame`): The data frame with `pickup_zone`, `dropoff_zone` and `<pickup|dropoff>_<landmark>_km`
+            columns generated
+    """
+    if generate:
+        if not isinstance(df, pd.DataFrame):
+            raise TypeError("The `df` input has to be pd.DataFrame")
 
+        for col in ['pickup_longitude', 'dropoff_longitude', 'pickup_latitude', 'dropoff_latitude']:
+            if col not in list(df.columns):
+                raise KeyError("%s does not exist in data frame" % col)
 
-def run_featurize(args):
-    """ Wrapper function to pass in args, load configuration, read data and execute each step in feature engineering """
+        if landmarks is not None:
+            landmarks = tuple((name, float(lon), float(lat)) for name, (lon, lat) in landmarks.items())
+        grid = build_zone_grid(min_lon, max_lon, min_lat, max_lat, cell_size, landmarks)
+
+        for location in ['pickup', 'dropoff']:
+            ids = zone_ids(grid, df[location + '_longitude'].values, df[location + '_latitude'].values)
+            df[location + '_zone'] = ids
+            # per-zone features are looked up by zone ID
+            for name, values in grid.features.items():
+                df[location + '_' + name] = values[ids]
+        logger.info("Zone features have been generated.")
+    return df
 
-    logger.info("------------------Starting to perform feature engineering-----------------")
-    # read data and configuration
-    data = read_csv(args.input)
-    config = load_yaml(args.config)
-    config_featurize = config['featurize']
 
-    try:
-        # format pickup_datetime column
-        data['pickup_datetime'] = pd.to_datetime(data['pickup_datetime'], infer_datetime_format=True)
+def featurize_data(data, config_featurize):
+    """ Execute each step in feature engineering with the `featurize` section of the configuration and return the
+    data with features generated """
 
-        # generate hour and day of week
+    try:
+        # generate hour and day of week, which are parsed from the fixed-width pickup_datetime strings
         data = generate_hour(data, **config_featurize['generate_hour'])
         data = generate_dayofweek(data, **config_featurize['generate_dayofweek'])
 
@@ -94,7 +140,37 @@ def run_featurize(args):
     # generate distance feature
     data = generate_distance(data, **config_featurize['generate_distance'])
 
-    # save output
-    write_csv(data, path=args.output, description='Data with additional features generated')
+    # generate zone features, which older configurations do not have
+    data = generate_zones(data, **config_featurize.get('generate_zones', {'generate': False}))
+    return data
+
+
+def run_featurize(args):
+    """ Wrapper function to pass in args, load configuration, read data and execute each step in feature engineering """
+
+    logger.info("------------------Starting to perform feature engineering-----------------")
+    with StageMetrics('featurize', args.metrics) as metrics:
+        config = load_yaml(args.config)
+        metrics.read(args.input)
+
+        if args.chunksize is not None:
+            # generate features by chunks and append each chunk to the output, so memory usage is bounded by chunksize
+            with ChunkWriter(args.output) as writer:
+                for chunk in read_data_chunks(args.input, chunksize=args.chunksize):
+                    chunk = featurize_data(chunk, config['featurize'])
+                    record_chunk(chunk.shape[0], chunk.shape[0])
+                    writer.write(chunk)
+            logger.info("Data with additional features generated saved to %s by chunks" % args.output)
+        else:
+            # read data
+            data = read_data(args.input)
+            metrics.rows(rows_in=data.shape[0])
+
+            data = featurize_data(data, config['featurize'])
+
+            # save output
+            write_data(data, path=args.output, description='Data with additional features generated')
+            metrics.rows(rows_out=data.shape[0])
+        metrics.write(args.output)
 
     logger.info("------------------Finished feature engineering-----------------")
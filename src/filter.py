@@ -1,8 +1,16 @@
 import os
-import pandas as pd
+import json
+import time
+import shutil
 import logging
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 
-from src.helpers import load_yaml, write_csv, check_path
+from src.helpers import load_yaml, append_csv, csv_byte_ranges, read_csv_byte_range, read_csv_lines, read_data_chunks, \
+    data_format, check_path, ChunkWriter
+from src.metrics import StageMetrics, record_chunk
+from src.schema import read_dtypes, apply_schema
+from src.year_index import load_year_index, year_blocks, file_signature
 
 logger = logging.getLogger(__name__)
 
@@ -28,92 +36,392 @@ def filter_year(df, year = 2015):
     df.drop(['pickup_year'], axis=1, inplace=True)
     return df
 
-def process_by_chunk(file_path, year = 2015, max_num_rows_read = None, chunksize = 10000, log_per_chunks = 500):
-    """ Read and filter data by chunks
+def read_blocks(file_path, blocks, chunksize=10000, max_num_rows_read=None):
+    """ Read blocks of raw data recorded in a year index by chunks, seeking directly to each block
+    Args:
+        file_path (`str`): The path to the raw data
+        blocks (:obj:`list` of :obj:`dict`): Blocks from a year index, with `start`, `end`, `first_row` and `num_rows`
+        chunksize: The chunk size. Optional, default is 10000.
+        max_num_rows_read: Rows beyond this number of rows of raw data are not read. Optional, default is None, which
+            indicates reading all rows in the blocks.
+    Yields:
+        chunk (`pandas.DataFrame`): A chunk of raw data, indexed by row number in the raw data
+    """
+    for block in blocks:
+        first_row = block['first_row']
+        num_rows = block['num_rows']
+        if max_num_rows_read is not None:
+            num_rows = min(num_rows, max_num_rows_read - first_row)
+
+        for chunk in read_csv_byte_range(file_path, block['start'], block['end'], chunksize=chunksize):
+            if num_rows <= 0:
+                break
+            if chunk.shape[0] > num_rows:
+                chunk = chunk.iloc[:num_rows].copy()
+            chunk.index = pd.RangeIndex(first_row, first_row + chunk.shape[0])
+            first_row = first_row + chunk.shape[0]
+            num_rows = num_rows - chunk.shape[0]
+            yield chunk
+
+
+def read_by_chunk(file_path, year=2015, max_num_rows_read=None, chunksize=10000, log_per_chunks=500,
+                  index_path=None):
+    """ Read raw data by chunks and yield each chunk after filtering it by year
     Args:
         file_path (`str`): The path to the raw data
         year (int): The specific year where data is filtered by. Optional, default is most recent year in raw data, 2015
         max_num_rows_read: The max number of rows read from raw data. Optional, default is None, which indicates reading
             all data
-        chunksize: The chunk size. Optional, default is None when max_num_rows_read is not None, indicating read all
-            data at once. Default is 10000 when max_num_rows_read is None, since the data is too big to be read once.
+        chunksize: The chunk size. Optional, default is 10000, since the data is too big to be read once. It is reset to
+            max_num_rows_read if it is greater than max_num_rows_read.
         log_per_chunks: After this number of chunks gets done, log information once. Optional, default = 500 chunks.
-    Returns:
-        df (`pandas.DataFrame`): Filtered data frame
+        index_path (`str`): The path to a year index built by `python run.py index`. If it is up to date, only blocks
+            containing rows of the specific year are read. Optional, default is None, which indicates reading all data.
+    Yields:
+        chunk (`pandas.DataFrame`): Filtered chunk of data
     """
     if os.path.exists(file_path) is False:
         raise FileNotFoundError("Failed to read and filter data by chunks, since the file path does not exist")
 
-    # create a data frame to save results
-    filtered_df = pd.DataFrame()
+    # if chunksize > total # of rows needed to read
+    # set it to be total # of rows needed to read, so read data at once
+    if max_num_rows_read is not None and max_num_rows_read < chunksize:
+        logger.warning("Chunksize reset from %i to %i, since it is greater than the total number of rows needed to read"
+                       % (chunksize, max_num_rows_read))
+        chunksize = max_num_rows_read
+
+    if max_num_rows_read is None:
+        logger.info("Starting to read raw data by chunk and filter by year = %i" % year)
+    else:
+        logger.info("Starting to read %i rows of raw data by chunk and filter by year = %i" % (max_num_rows_read, year))
 
     # set a counter for the number of chunks that have been filtered
     counter = 0
 
-    # read all data by chunks if max_num_rows_read is None
-    if max_num_rows_read is None:
+    index = None if index_path is None else load_year_index(index_path, file_path)
+    if index is None:
+        # nrows=None reads all data, otherwise reading stops after max_num_rows_read rows
+        chunks = (apply_schema(chunk) for chunk in
+                  pd.read_csv(file_path, chunksize=chunksize, nrows=max_num_rows_read, dtype=read_dtypes()))
+    else:
+        blocks = year_blocks(index, year, max_num_rows_read)
+        logger.info("Reading %i out of %i blocks that contain rows of year = %i"
+                    % (len(blocks), len(index['blocks']), year))
+        chunks = read_blocks(file_path, blocks, chunksize, max_num_rows_read)
 
-        logger.info("Starting to read raw data by chunk and filter by year = %i" % year)
-        for chunk in pd.read_csv(file_path, chunksize=chunksize):
-            # if filtered_df is empty, assign column names to it
-            if not list(filtered_df.columns):
-                filtered_df = pd.DataFrame(columns=chunk.columns)
-            # append valid rows
-            filtered_df = filtered_df.append(filter_year(chunk, year))
-
-            # increment counter
-            counter = counter + 1
+    start = time.perf_counter()
+    num_rows_read = 0
+    for chunk in chunks:
+        rows_in = chunk.shape[0]
+        chunk = filter_year(chunk, year)
+        record_chunk(rows_in, chunk.shape[0])
+        yield chunk
 
-            # log info after each `log_per_chunks` chunks done
-            if counter % log_per_chunks == 0:
-                logger.info("Filtered data by year for %i chunks" % counter)
+        # increment counter
+        counter = counter + 1
+        num_rows_read = num_rows_read + rows_in
 
-        logger.info("Filtered all data by year = %i, and the filtered data has %i rows" % (year, filtered_df.shape[0]))
+        # log info after each `log_per_chunks` chunks done
+        if counter % log_per_chunks == 0:
+            logger.info("Filtered data by year for %i chunks (%i rows read, %.0f rows/sec)"
+                        % (counter, num_rows_read, num_rows_read / max(time.perf_counter() - start, 1e-9)))
 
-    # read max_num_rows_read rows of data by chunks if max_num_rows_read is not None
+
+def process_by_chunk(file_path, year = 2015, max_num_rows_read = None, chunksize = 10000, log_per_chunks = 500,
+                     index_path = None):
+    """ Read and filter data by chunks
+    Args:
+        file_path (`str`): The path to the raw data
+        year (int): The specific year where data is filtered by. Optional, default is most recent year in raw data, 2015
+        max_num_rows_read: The max number of rows read from raw data. Optional, default is None, which indicates reading
+            all data
+        chunksize: The chunk size. Optional, default is 10000, since the data is too big to be read once. It is reset to
+            max_num_rows_read if it is greater than max_num_rows_read.
+        log_per_chunks: After this number of chunks gets done, log information once. Optional, default = 500 chunks.
+        index_path (`str`): The path to a year index. If it is up to date, only blocks containing rows of the specific
+            year are read. Optional, default is None, which indicates reading all data.
+    Returns:
+        df (`pandas.DataFrame`): Filtered data frame
+    """
+    # collect filtered chunks and concatenate them once, instead of re-copying the accumulated data for every chunk
+    chunks = list(read_by_chunk(file_path, year, max_num_rows_read, chunksize, log_per_chunks, index_path))
+    filtered_df = pd.concat(chunks) if chunks else pd.DataFrame()
+
+    logger.info("Filtered data by year = %i, and the filtered data has %i rows" % (year, filtered_df.shape[0]))
+    return filtered_df
+
+
+def filter_byte_range(file_path, start, end, save_to, year=2015, chunksize=10000):
+    """ Filter the rows of raw data between two line-aligned byte offsets by year and write them to a shard
+    Args:
+        file_path (`str`): The path to the raw data
+        start (int): The byte offset of the first row to filter
+        end (int): The byte offset right after the last row to filter
+        save_to (`str`): The path to save the filtered rows (a shard of the filtered data)
+        year (int): The specific year where data is filtered by. Optional, default = 2015
+        chunksize: The chunk size. Optional, default is 10000.
+    Returns:
+        num_rows_read (int): The number of rows read from the byte range
+        num_rows (int): The number of rows in the shard
+    """
+    num_rows_read = 0
+    with ChunkWriter(save_to) as writer:
+        for chunk in read_csv_byte_range(file_path, start, end, chunksize=chunksize):
+            num_rows_read = num_rows_read + chunk.shape[0]
+            writer.write(filter_year(chunk, year))
+
+    return num_rows_read, writer.num_rows
+
+
+def merge_shards(shards, save_to, columns):
+    """ Merge shards of filtered data in order into one file
+    Args:
+        shards (:obj:`list` of :obj:`str`): The paths to the shards, in the same format as save_to
+        save_to (`str`): The path to save the merged data
+        columns (:obj:`list` of :obj:`str`): The column names of the data, used to write the header of a csv
+    Returns:
+        None
+    """
+    # skip shards of byte ranges that did not contain any rows
+    shards = [shard for shard in shards if os.path.exists(shard)]
+
+    if data_format(save_to) == 'csv':
+        # write the header once, then append the rows of each shard without its header
+        append_csv(pd.DataFrame(columns=columns), save_to, header=True)
+        with open(save_to, 'a') as output:
+            for shard in shards:
+                with open(shard, 'r') as f:
+                    f.readline()
+                    shutil.copyfileobj(f, output)
     else:
-        # if chunksize > total # of rows needed to read
-        # set it to be total # of rows needed to read, so read data at once
-        if max_num_rows_read < chunksize:
-            logger.warning("Chunksize reset from %i to %i, since it is greater than the total number of rows needed to read"
-                           % (chunksize, max_num_rows_read))
-            chunksize = max_num_rows_read
-
-        for chunk in pd.read_csv(file_path, chunksize=chunksize):
-            # if filtered_df is empty, assign column names to it
-            if not list(filtered_df.columns):
-                filtered_df = pd.DataFrame(columns=chunk.columns)
-            # append valid rows
-            filtered_df = filtered_df.append(filter_year(chunk, year))
-
-            # increment counterer
+        with ChunkWriter(save_to, columns=columns) as writer:
+            for shard in shards:
+                for chunk in read_data_chunks(shard):
+                    writer.write(chunk)
+
+
+def parallel_filter(file_path, save_to, year=2015, n_workers=2, chunksize=10000, ranges=None):
+    """ Split raw data into newline-aligned byte ranges, filter each range by year in a process pool, and merge the
+    shards in order, so the output is identical to the one written by `stream_by_chunk`
+    Args:
+        file_path (`str`): The path to the raw data
+        save_to (`str`): The path to save the filtered data
+        year (int): The specific year where data is filtered by. Optional, default = 2015
+        n_workers (int): The number of worker processes. Optional, default = 2.
+        chunksize: The chunk size used by each worker. Optional, default is 10000.
+        ranges (:obj:`list` of :obj:`tuple`): Line-aligned (start, end) byte ranges to filter, e.g. blocks from a
+            year index. Optional, default is None, which splits the whole file into `n_workers` ranges.
+    Returns:
+        num_rows (int): The number of rows in the filtered data
+    """
+    if os.path.exists(file_path) is False:
+        raise FileNotFoundError("Failed to filter data in parallel, since the file path does not exist")
+
+    if not isinstance(n_workers, int) or n_workers < 1:
+        raise ValueError("n_workers has to be a positive integer")
+
+    if ranges is None:
+        ranges = csv_byte_ranges(file_path, n_workers)
+    root, extension = os.path.splitext(save_to)
+    shards = ['%s.part%03d%s' % (root, i, extension) for i in range(len(ranges))]
+    logger.info("Starting to filter raw data by year = %i in %i byte ranges with %i workers"
+                % (year, len(ranges), n_workers))
+
+    try:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(filter_byte_range, file_path, start, end, shard, year, chunksize)
+                       for (start, end), shard in zip(ranges, shards)]
+            results = [future.result() for future in futures]
+
+        # workers do not see the step being recorded, so the rows of each byte range are reported from here
+        for rows_in, rows_out in results:
+            record_chunk(rows_in, rows_out)
+        num_rows = sum(rows_out for _, rows_out in results)
+
+        # merge the shards in the order of byte ranges
+        merge_shards(shards, save_to, columns=list(pd.read_csv(file_path, nrows=0).columns))
+    finally:
+        for shard in shards:
+            if os.path.exists(shard):
+                os.remove(shard)
+
+    logger.info("Filtered data by year = %i, and the filtered data has %i rows" % (year, num_rows))
+    return num_rows
+
+
+def checkpoint_path(save_to):
+    """Get the path to the checkpoint of a filtered data file, which is kept next to it"""
+    return save_to + '.checkpoint.json'
+
+
+def save_checkpoint(checkpoint, path):
+    """Save a checkpoint to a temporary file first and then move it into place, so a crash while saving never leaves
+    a half-written checkpoint behind"""
+    check_path(path)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def load_checkpoint(path, settings):
+    """ Load the checkpoint of a previous run if it can be resumed from
+    Args:
+        path (`str`): The path to the checkpoint
+        settings (`dict`): The raw data signature and filter arguments of the current run, which have to be the same
+            as those of the previous run
+    Returns:
+        checkpoint (`dict`): The checkpoint, or None if it does not exist or does not match the current run
+    """
+    if os.path.exists(path) is False:
+        logger.warning("No checkpoint found at %s, filtering starts from the first row" % path)
+        return None
+
+    with open(path, 'r') as f:
+        checkpoint = json.load(f)
+
+    if checkpoint.get('settings') != settings:
+        logger.warning("The checkpoint at %s was saved with different raw data or filter arguments, "
+                       "filtering starts from the first row" % path)
+        return None
+
+    output = checkpoint['output']
+    if os.path.exists(output['path']) is False or os.path.getsize(output['path']) < output['size']:
+        logger.warning("The filtered data recorded in the checkpoint at %s is missing or incomplete, "
+                       "filtering starts from the first row" % path)
+        return None
+
+    return checkpoint
+
+
+def checkpointed_filter(file_path, save_to, year=2015, max_num_rows_read=None, chunksize=10000, log_per_chunks=500,
+                        checkpoint_per_chunks=100, resume=False):
+    """ Read and filter raw data by chunks and append each filtered chunk to a csv, saving a checkpoint with the
+    chunk counter, the byte offset reached in the raw data and the rows written so far every `checkpoint_per_chunks`
+    chunks. A resumed run drops the rows written after the last checkpoint and continues from its byte offset, so its
+    output is identical to the one of an uninterrupted run. The checkpoint is removed once filtering is done.
+    Args:
+        file_path (`str`): The path to the raw data
+        save_to (`str`): The path to save the filtered data, which has to be a csv
+        year (int): The specific year where data is filtered by. Optional, default = 2015
+        max_num_rows_read: The max number of rows read from raw data. Optional, default is None, which indicates reading
+            all data
+        chunksize: The chunk size. Optional, default is 10000.
+        log_per_chunks: After this number of chunks gets done, log information once. Optional, default = 500 chunks.
+        checkpoint_per_chunks: After this number of chunks gets done, save a checkpoint once. Optional, default = 100.
+        resume (bool): Whether to continue from the checkpoint of a previous run. Optional, default = False.
+    Returns:
+        num_rows (int): The number of rows in the filtered data
+    """
+    if os.path.exists(file_path) is False:
+        raise FileNotFoundError("Failed to read and filter data by chunks, since the file path does not exist")
+
+    if not isinstance(checkpoint_per_chunks, int) or checkpoint_per_chunks < 1:
+        raise ValueError("checkpoint_per_chunks has to be a positive integer")
+
+    path = checkpoint_path(save_to)
+    settings = {'file': os.path.abspath(file_path), 'signature': file_signature(file_path), 'year': year,
+                'max_num_rows_read': max_num_rows_read, 'chunksize': chunksize}
+    checkpoint = load_checkpoint(path, settings) if resume else None
+
+    with ChunkWriter(save_to, columns=list(pd.read_csv(file_path, nrows=0).columns)) as writer:
+        if checkpoint is None:
+            counter, offset, num_rows_read = 0, None, 0
+        else:
+            counter, offset, num_rows_read = checkpoint['chunks'], checkpoint['offset'], checkpoint['rows_read']
+            writer.resume(checkpoint['output']['rows'], checkpoint['output']['size'])
+            logger.info("Resuming from chunk %i (%i rows of raw data read, %i filtered rows written)"
+                        % (counter, num_rows_read, writer.num_rows))
+
+        nrows = None if max_num_rows_read is None else max_num_rows_read - num_rows_read
+        start = time.perf_counter()
+        for chunk, offset in read_csv_lines(file_path, offset, chunksize, nrows):
+            rows_in = chunk.shape[0]
+            num_rows_read = num_rows_read + rows_in
+            chunk = filter_year(chunk, year)
+            record_chunk(rows_in, chunk.shape[0])
+            writer.write(chunk)
             counter = counter + 1
 
-            # log info after each `log_per_chunks` chunks done
             if counter % log_per_chunks == 0:
-                logger.info("Filtered data by year for %i chunks" % counter)
+                logger.info("Filtered data by year for %i chunks (%i rows read, %.0f rows/sec)"
+                            % (counter, num_rows_read, num_rows_read / max(time.perf_counter() - start, 1e-9)))
 
-            # stop if we reach total # of rows we need to read
-            if counter * chunksize == max_num_rows_read:
-                break
-        logger.info("Filtered %i rows of data by year = %i, and the filtered data has %i rows" %
-                    (max_num_rows_read, year, filtered_df.shape[0]))
+            if counter % checkpoint_per_chunks == 0:
+                save_checkpoint({'settings': settings, 'chunks': counter, 'offset': offset, 'rows_read': num_rows_read,
+                                 'output': {'path': save_to, 'rows': writer.num_rows,
+                                            'size': os.path.getsize(save_to)}}, path)
+
+    if os.path.exists(path):
+        os.remove(path)
+
+    logger.info("Filtered data by year = %i, and the filtered data has %i rows" % (year, writer.num_rows))
+    return writer.num_rows
 
-    return filtered_df
+
+def stream_by_chunk(file_path, save_to, year=2015, max_num_rows_read=None, chunksize=10000, log_per_chunks=500,
+                    n_workers=1, index_path=None, checkpoint_per_chunks=None, resume=False):
+    """ Read and filter data by chunks, and write each filtered chunk straight to the output file, so that memory usage
+    is bounded by the chunk size
+    Args:
+        file_path (`str`): The path to the raw data
+        save_to (`str`): The path to save the filtered data
+        year (int): The specific year where data is filtered by. Optional, default is most recent year in raw data, 2015
+        max_num_rows_read: The max number of rows read from raw data. Optional, default is None, which indicates reading
+            all data
+        chunksize: The chunk size. Optional, default is 10000.
+        log_per_chunks: After this number of chunks gets done, log information once. Optional, default = 500 chunks.
+        n_workers (int): The number of worker processes. If greater than 1, data is filtered by `parallel_filter`.
+            Optional, default = 1.
+        index_path (`str`): The path to a year index. If it is up to date, only blocks containing rows of the specific
+            year are read. Optional, default is None, which indicates reading all data.
+        checkpoint_per_chunks: After this number of chunks gets done, save a checkpoint once, see
+            `checkpointed_filter`. Only used when a single process scans the whole raw data into a csv. Optional,
+            default is None, which indicates no checkpoints.
+        resume (bool): Whether to continue from the checkpoint of a previous run. Optional, default = False.
+    Returns:
+        num_rows (int): The number of rows in the filtered data
+    """
+    if n_workers > 1:
+        # byte ranges cannot tell where the first max_num_rows_read rows end, so only the whole file is split
+        if max_num_rows_read is None:
+            index = None if index_path is None else load_year_index(index_path, file_path)
+            ranges = None if index is None else [(block['start'], block['end']) for block in year_blocks(index, year)]
+            return parallel_filter(file_path, save_to, year, n_workers, chunksize, ranges)
+        logger.warning("Filtering data with a single process, since max_num_rows_read is specified")
+
+    if checkpoint_per_chunks is not None:
+        if data_format(save_to) != 'csv':
+            logger.warning("Checkpoints are not saved, since only csv outputs can be resumed")
+        elif index_path is not None and load_year_index(index_path, file_path) is not None:
+            logger.warning("Checkpoints are not saved, since only blocks of the year index are read")
+        else:
+            return checkpointed_filter(file_path, save_to, year, max_num_rows_read, chunksize, log_per_chunks,
+                                       checkpoint_per_chunks, resume)
+
+    # the columns of the raw data are written even if no rows are read, e.g. the year index has no blocks of the year
+    with ChunkWriter(save_to, columns=list(pd.read_csv(file_path, nrows=0).columns)) as writer:
+        for chunk in read_by_chunk(file_path, year, max_num_rows_read, chunksize, log_per_chunks, index_path):
+            writer.write(chunk)
+    num_rows = writer.num_rows
+
+    logger.info("Filtered data by year = %i, and the filtered data has %i rows" % (year, num_rows))
+    return num_rows
 
 def run_filter(args):
     """ Wrapper function to pass in args, read data, load configuration, and execute filter_year function """
     logger.info("------------------Starting to filter data by year-----------------")
     logger.info("Please note it will take a while (max = ~2h) to run the filter step, as the raw data has ~50 million observations")
 
-    # read configuration
-    config = load_yaml(args.config)
-
-    # filter data by chunks
-    filtered_df = process_by_chunk(args.input, **config['filter'])
+    with StageMetrics('filter', args.metrics) as metrics:
+        # read configuration
+        config = load_yaml(args.config)
+        metrics.read(args.input)
 
-    # save filtered data
-    logger.info("Starting to write filtered data")
-    write_csv(filtered_df, path=args.output, description='Filtered data')
+        # filter data by chunks and write each filtered chunk to the output file
+        num_rows = stream_by_chunk(args.input, args.output, index_path=args.index, resume=args.resume,
+                                   **config['filter'])
+        logger.info("Filtered data saved to %s" % args.output)
+        metrics.rows(rows_out=num_rows)
+        metrics.write(args.output)
 
     logger.info("------------------Finished filtering data-----------------")
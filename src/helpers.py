@@ -1,8 +1,15 @@
+import io
 import os
 import yaml
+import json
 import pickle
 import logging
+import numpy as np
 import pandas as pd
+from itertools import islice
+from collections import namedtuple
+
+from src.schema import read_dtypes, apply_schema, memory_usage
 
 logger = logging.getLogger(__name__)
 
@@ -38,6 +45,512 @@ def write_csv(output, path, description=None, index=False):
         logger.error(e)
 
 
+# file extensions of the supported storage formats for data artifacts
+DATA_FORMATS = {'.csv': 'csv', '.parquet': 'parquet', '.pq': 'parquet', '.feather': 'feather', '.npy': 'npy',
+                '.npz': 'npz', '.rows': 'rows'}
+
+# the number of rows in each row group of parquet files written at once, which bounds the rows `read_data_chunks`
+# reads into memory at a time
+PARQUET_ROW_GROUP_ROWS = 100000
+
+# a feature matrix (n rows x n features) and a target vector, which are memory-mapped when read by `read_matrix`, or
+# a sparse CSR feature matrix
+FeatureMatrix = namedtuple('FeatureMatrix', ['X', 'y', 'columns', 'target_column'])
+
+
+def data_format(path):
+    """Get the storage format (csv, parquet, feather, npy, npz or rows) of a data artifact from its file extension"""
+
+    extension = os.path.splitext(path)[1].lower()
+    if extension not in DATA_FORMATS:
+        raise ValueError("%s is not a supported data file. Supported extensions are %s"
+                         % (path, list(DATA_FORMATS.keys())))
+    return DATA_FORMATS[extension]
+
+
+def read_data(path, columns=None):
+    """Read a data artifact from a given path in the format given by its extension (csv, parquet or feather)
+
+    Args:
+        path (`str`): The path to the data
+        columns (:obj:`list` of :obj:`str`): The columns to load. Parquet and feather only read these columns from
+            disk. Optional, default is None, which loads all columns.
+
+    Returns:
+        df (`pandas.DataFrame`): The data
+    """
+
+    try:
+        fmt = data_format(path)
+        if fmt == 'parquet':
+            df = pd.read_parquet(path, columns=columns)
+        elif fmt == 'feather':
+            df = pd.read_feather(path, columns=columns)
+        else:
+            df = pd.read_csv(path, usecols=columns, dtype=read_dtypes())
+        df = apply_schema(df)
+        logger.info('Input data loaded from %s', path)
+        memory_usage(df, description='Input data')
+        return df
+    except FileNotFoundError:
+        logger.error("%s is invalid. Please provide a valid file location to read data from." % path)
+    except Exception as e:
+        logger.error(e)
+
+
+def read_data_chunks(path, chunksize=10000, columns=None):
+    """Read a data artifact from a given path by chunks in the format given by its extension
+
+    Args:
+        path (`str`): The path to the data
+        chunksize (int): The number of rows in each chunk. Default: 10000.
+        columns (:obj:`list` of :obj:`str`): The columns to load. Optional, default is None, which loads all columns.
+
+    Yields:
+        chunk (`pandas.DataFrame`): A chunk of data
+    """
+    if os.path.exists(path) is False:
+        raise FileNotFoundError("%s is invalid. Please provide a valid file location to read data from." % path)
+
+    fmt = data_format(path)
+    if fmt == 'csv':
+        for chunk in pd.read_csv(path, chunksize=chunksize, usecols=columns, dtype=read_dtypes()):
+            yield apply_schema(chunk)
+
+    elif fmt == 'parquet':
+        import pyarrow.parquet as pq
+
+        # parquet files are read one row group at a time, and each row group is split into chunks
+        parquet_file = pq.ParquetFile(path)
+        for i in range(parquet_file.num_row_groups):
+            row_group = apply_schema(parquet_file.read_row_group(i, columns=columns).to_pandas())
+            for start in range(0, row_group.shape[0], chunksize):
+                # chunks are copied, so columns can be added to them without touching the row group
+                yield row_group.iloc[start:start + chunksize].copy()
+
+        if parquet_file.metadata.num_rows == 0:
+            # empty data is read as a single empty chunk, as for csv files, so its columns are kept
+            yield apply_schema(parquet_file.read(columns=columns).to_pandas())
+
+    else:
+        # feather files cannot be read partially, so the data is loaded at once and then split into chunks
+        logger.warning("%s is read into memory at once, since feather files cannot be read by chunks" % path)
+        df = apply_schema(pd.read_feather(path, columns=columns))
+        for start in range(0, max(df.shape[0], 1), chunksize):
+            yield df.iloc[start:start + chunksize].copy()
+
+
+def write_data(output, path, description=None, row_group_size=PARQUET_ROW_GROUP_ROWS):
+    """Write a pd.DataFrame to a given path in the format given by its extension (csv, parquet or feather). Parquet
+    files are written in row groups of `row_group_size` rows, so they can be read by chunks."""
+
+    # check the path is valid
+    check_path(path)
+
+    try:
+        fmt = data_format(path)
+        if fmt == 'parquet':
+            output.to_parquet(path, index=False, row_group_size=row_group_size)
+        elif fmt == 'feather':
+            # feather only stores a default index
+            output.reset_index(drop=True).to_feather(path)
+        else:
+            output.to_csv(path, index=False)
+
+        # if a file description is given, use that in logging
+        if description is None:
+            logger.info("Output saved to %s" % path)
+        else:
+            logger.info("%s saved to %s" % (description, path))
+    except Exception as e:
+        logger.error(e)
+
+
+def matrix_paths(path):
+    """Get the paths to the target vector and the column manifest that are saved next to a feature matrix"""
+    root = os.path.splitext(path)[0]
+    return root + '.target.npy', root + '.columns.json'
+
+
+def write_matrix(output, path, target_column='fare_amount', description=None):
+    """Write the features of a pd.DataFrame as a contiguous float32 `.npy` matrix, together with a `.target.npy` target
+    vector and a `.columns.json` manifest of the feature column names, so they can be memory-mapped by `read_matrix`
+
+    Args:
+        output (`pandas.DataFrame`): The data frame with numeric features and the target
+        path (`str`): The path to save the feature matrix, which has to end with .npy
+        target_column (`str`): Column name of the target. Default: fare_amount.
+        description (`str`): The description of the data used in logging. Optional.
+
+    Returns:
+        None
+    """
+    if data_format(path) != 'npy':
+        raise ValueError("The path to a feature matrix has to end with .npy")
+
+    if target_column not in list(output.columns):
+        raise KeyError("Failed to write feature matrix: the target column does not exist in data frame")
+
+    features = [col for col in output.columns if col != target_column]
+    try:
+        X = np.ascontiguousarray(output[features].to_numpy(dtype=np.float32))
+        y = output[target_column].to_numpy(dtype=np.float32)
+    except (TypeError, ValueError):
+        raise TypeError("All features and the target have to be numeric to be saved in a feature matrix")
+
+    target_path, columns_path = matrix_paths(path)
+    check_path(path)
+    np.save(path, X)
+    np.save(target_path, y)
+    with open(columns_path, 'w') as f:
+        json.dump({'features': features, 'target': target_column, 'rows': int(output.shape[0])}, f)
+
+    logger.info("%s saved to %s as a feature matrix" % (description or 'Output', path))
+
+
+def write_sparse_matrix(X, y, path, features, target_column='fare_amount', description=None):
+    """Write a sparse feature matrix as a CSR `.npz` file, together with a `.target.npy` target vector and a
+    `.columns.json` manifest of the feature column names as `write_matrix` does
+
+    Args:
+        X (`scipy.sparse.csr_matrix`): The features, e.g. encoded by `OneHotLayout.encode_sparse`
+        y (`numpy.ndarray` or `pandas.Series`): The target
+        path (`str`): The path to save the feature matrix, which has to end with .npz
+        features (:obj:`list` of :obj:`str`): The names of the columns of X
+        target_column (`str`): Column name of the target. Default: fare_amount.
+        description (`str`): The description of the data used in logging. Optional.
+
+    Returns:
+        None
+    """
+    from scipy import sparse
+
+    if data_format(path) != 'npz':
+        raise ValueError("The path to a sparse feature matrix has to end with .npz")
+
+    if X.shape[1] != len(features):
+        raise ValueError("The sparse feature matrix has %i columns, but %i feature names are given"
+                         % (X.shape[1], len(features)))
+
+    target_path, columns_path = matrix_paths(path)
+    check_path(path)
+    sparse.save_npz(path, sparse.csr_matrix(X), compressed=False)
+    np.save(target_path, np.asarray(y, dtype=np.float32))
+    with open(columns_path, 'w') as f:
+        json.dump({'features': list(features), 'target': target_column, 'rows': int(X.shape[0])}, f)
+
+    logger.info("%s saved to %s as a sparse feature matrix with %i stored values (%.1f%% of a dense matrix)"
+                % (description or 'Output', path, X.nnz, 100 * X.nnz / max(X.shape[0] * X.shape[1], 1)))
+
+
+def read_matrix(path):
+    """Open a feature matrix, its target vector and its column manifest written by `write_matrix` or
+    `write_sparse_matrix`. Dense arrays are memory-mapped read-only, so they are not copied into memory and the OS page
+    cache is shared between processes, and sparse matrices are loaded as CSR matrices.
+
+    Args:
+        path (`str`): The path to the feature matrix (.npy or .npz)
+
+    Returns:
+        matrix (`FeatureMatrix`): The feature matrix `X` (memory-mapped, or CSR if sparse), memory-mapped target vector
+            `y`, feature names `columns` and `target_column`
+    """
+    target_path, columns_path = matrix_paths(path)
+    for file_path in [path, target_path, columns_path]:
+        if os.path.exists(file_path) is False:
+            raise FileNotFoundError("%s is invalid. Please provide a valid feature matrix written by the split step."
+                                    % file_path)
+
+    with open(columns_path, 'r') as f:
+        manifest = json.load(f)
+
+    if data_format(path) == 'npz':
+        from scipy import sparse
+
+        X = sparse.load_npz(path).tocsr()
+    else:
+        X = np.load(path, mmap_mode='r')
+
+    matrix = FeatureMatrix(X=X, y=np.load(target_path, mmap_mode='r'), columns=manifest['features'],
+                           target_column=manifest['target'])
+    logger.info("Feature matrix with %i rows and %i features %s from %s"
+                % (matrix.X.shape[0], matrix.X.shape[1], 'loaded' if data_format(path) == 'npz' else 'memory-mapped',
+                   path))
+    return matrix
+
+
+def read_matrix_chunks(path, chunksize=100000):
+    """Read a feature matrix written by `write_matrix` or `write_sparse_matrix` by chunks of rows. Dense arrays are
+    memory-mapped, so only the rows of a chunk are read into memory when it is used.
+
+    Args:
+        path (`str`): The path to the feature matrix (.npy or .npz)
+        chunksize (int): The number of rows in each chunk. Default: 100000.
+
+    Yields:
+        chunk (`FeatureMatrix`): The feature matrix of a chunk of rows
+    """
+    matrix = read_matrix(path)
+    for start in range(0, matrix.X.shape[0], chunksize):
+        yield matrix._replace(X=matrix.X[start:start + chunksize], y=matrix.y[start:start + chunksize])
+
+
+def row_spec_path(path):
+    """Get the path to the spec that is saved next to a row manifest"""
+    return os.path.splitext(path)[0] + '.spec.json'
+
+
+def write_row_manifest(rows, path, spec, description=None):
+    """Write the positions of the rows of a data artifact that make up a training or test set as an int64 `.rows`
+    array, together with a `.spec.json` spec of how to build the set from them, instead of a copy of the rows
+
+    Args:
+        rows (`numpy.ndarray`): The positions of the rows in the source data, in the order of the set
+        path (`str`): The path to save the row manifest, which has to end with .rows
+        spec (`dict`): The `source` data path and how its rows are turned into the set, e.g. the one-hot `encoder`
+            and the `target`
+        description (`str`): The description of the data used in logging. Optional.
+
+    Returns:
+        None
+    """
+    if data_format(path) != 'rows':
+        raise ValueError("The path to a row manifest has to end with .rows")
+
+    check_path(path)
+    rows = np.asarray(rows, dtype=np.int64)
+    # np.save would add .npy to the path, so the array is written to an open file
+    with open(path, 'wb') as f:
+        np.save(f, rows)
+    with open(row_spec_path(path), 'w') as f:
+        json.dump(dict(spec, rows=int(rows.shape[0])), f)
+
+    logger.info("%s saved to %s as a manifest of %i rows of %s" % (description or 'Output', path, rows.shape[0],
+                                                                    spec.get('source')))
+
+
+def read_row_manifest(path):
+    """Read the row positions and the spec of a row manifest written by `write_row_manifest`
+
+    Args:
+        path (`str`): The path to the row manifest (.rows)
+
+    Returns:
+        rows (`numpy.ndarray`): The positions of the rows in the source data
+        spec (`dict`): The spec of the set
+    """
+    for file_path in [path, row_spec_path(path)]:
+        if os.path.exists(file_path) is False:
+            raise FileNotFoundError("%s is invalid. Please provide a valid row manifest written by the split step."
+                                    % file_path)
+
+    with open(row_spec_path(path), 'r') as f:
+        spec = json.load(f)
+    return np.load(path), spec
+
+
+class ChunkWriter:
+    """Write a data artifact chunk by chunk in the format given by its extension (csv, parquet or feather)
+
+    Csv files are appended to and each chunk of a parquet file is written as a row group, so memory usage is bounded
+    by the chunk size. Feather files cannot be appended to, so their chunks are kept in memory and written on close.
+    Every chunk has to contain the same columns as the first one. If no chunk is written, e.g. no rows were read, an
+    empty file with `columns` is written on close, so the next step reads empty data instead of failing.
+
+    Args:
+        path (`str`): The path to save the data
+        columns (:obj:`list` of :obj:`str`): The columns of the empty file written if no chunk is written. Optional,
+            default is None, which writes a file without columns.
+    """
+
+    def __init__(self, path, columns=None):
+        self.path = path
+        self.columns = columns
+        self._written = False
+        self.format = data_format(path)
+        self.num_rows = 0
+        self._parquet_writer = None
+        self._schema = None
+        self._empty = None
+        self._chunks = []
+        check_path(path)
+
+    def write(self, chunk):
+        """Write a chunk (`pandas.DataFrame`) to the file"""
+        if self.format == 'csv':
+            # overwrite the file and write the header with the first chunk, then append the rest
+            append_csv(chunk, self.path, header=(self._schema is None))
+            self._schema = list(chunk.columns)
+
+        elif self.format == 'parquet':
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            if chunk.shape[0] == 0:
+                # the types of empty object columns cannot be inferred, so the writer is opened with the first chunk
+                # that has rows, and an empty chunk is only kept for its columns in case every chunk is empty
+                if self._parquet_writer is None and self._empty is None:
+                    self._empty = chunk
+            elif self._parquet_writer is None:
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                self._schema = table.schema
+                self._parquet_writer = pq.ParquetWriter(self.path, self._schema)
+                self._parquet_writer.write_table(table)
+            else:
+                # inferred dtypes may differ between chunks, so every chunk is cast to the schema of the first one
+                self._parquet_writer.write_table(pa.Table.from_pandas(chunk, schema=self._schema,
+                                                                      preserve_index=False))
+
+        else:
+            self._chunks.append(chunk)
+
+        self._written = True
+        self.num_rows = self.num_rows + chunk.shape[0]
+
+    def resume(self, num_rows, size):
+        """Continue a csv written by a previous run, after dropping anything written beyond its first `size` bytes,
+        which hold the header and `num_rows` rows"""
+        if self.format != 'csv':
+            raise ValueError("Only csv files can be resumed, %s is a %s file" % (self.path, self.format))
+
+        with open(self.path, 'r+b') as f:
+            f.truncate(size)
+        self._schema = list(pd.read_csv(self.path, nrows=0).columns)
+        self._written = True
+        self.num_rows = num_rows
+
+    def close(self):
+        """Finish writing the file"""
+        if not self._written:
+            self.write(pd.DataFrame(columns=self.columns or []))
+
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+        elif self.format == 'parquet' and self._empty is not None:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            # no chunk had rows, so an empty file is written, with the columns of unknown type saved as strings
+            schema = pa.Schema.from_pandas(self._empty, preserve_index=False)
+            schema = pa.schema([pa.field(field.name, pa.string()) if field.type == pa.null() else field
+                                for field in schema])
+            pq.write_table(pa.Table.from_pandas(self._empty, schema=schema, preserve_index=False), self.path)
+        elif self.format == 'feather' and self._chunks:
+            pd.concat(self._chunks).reset_index(drop=True).to_feather(self.path)
+            self._chunks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def append_csv(output, path, header=False):
+    """Append a pd.DataFrame to a csv at a given path. If header is True, the file is overwritten and the column
+    names are written first, which is used for the first chunk of a file written by chunks"""
+
+    if header:
+        check_path(path)
+        output.to_csv(path, index=False, mode='w', header=True)
+    else:
+        output.to_csv(path, index=False, mode='a', header=False)
+
+
+def csv_byte_ranges(path, n_ranges):
+    """Split the rows of a csv into `n_ranges` contiguous byte ranges that start and end on line boundaries
+
+    Args:
+        path (`str`): The path to the csv file
+        n_ranges (int): The number of byte ranges desired
+
+    Returns:
+        ranges (:obj:`list` of :obj:`tuple`): A list of (start, end) byte offsets in file order. The header line is
+            not included in any range. Ranges can be fewer than `n_ranges` if the file is small.
+    """
+    size = os.path.getsize(path)
+
+    with open(path, 'rb') as f:
+        # skip the header
+        f.readline()
+        data_start = f.tell()
+
+        step = max((size - data_start) // n_ranges, 1)
+        boundaries = [data_start]
+        for i in range(1, n_ranges):
+            # move to an approximate boundary and then to the beginning of the next line
+            f.seek(max(data_start + i * step - 1, boundaries[-1]))
+            f.readline()
+            boundary = min(f.tell(), size)
+            if boundary > boundaries[-1]:
+                boundaries.append(boundary)
+        if size > boundaries[-1]:
+            boundaries.append(size)
+
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def read_csv_byte_range(path, start, end, chunksize=10000, block_size=64 * 2 ** 20):
+    """Read the rows of a csv between two line-aligned byte offsets by chunks
+
+    Args:
+        path (`str`): The path to the csv file
+        start (int): The byte offset of the first row to read
+        end (int): The byte offset right after the last row to read
+        chunksize (int): The number of rows in each chunk. Default: 10000.
+        block_size (int): The number of bytes held in memory at once. Default: 64MB.
+
+    Yields:
+        chunk (`pandas.DataFrame`): A chunk of rows, with columns named by the header of the csv
+    """
+    with open(path, 'rb') as f:
+        header = f.readline()
+        f.seek(start)
+        pos = start
+
+        while pos < end:
+            block = f.read(min(block_size, end - pos))
+            # finish the last line of the block, since ranges always end on a line boundary
+            if not block.endswith(b'\n') and f.tell() < end:
+                block = block + f.readline()
+            pos = f.tell()
+
+            for chunk in pd.read_csv(io.BytesIO(header + block), chunksize=chunksize, dtype=read_dtypes()):
+                yield apply_schema(chunk)
+
+
+def read_csv_lines(path, start=None, chunksize=10000, nrows=None):
+    """Read the rows of a csv by chunks from a line-aligned byte offset, and keep track of the byte offset reached
+    after each chunk, so reading can be continued from there later
+
+    Args:
+        path (`str`): The path to the csv file
+        start (int): The byte offset of the first row to read. Default: None, which starts right after the header.
+        chunksize (int): The number of rows in each chunk. Default: 10000.
+        nrows (int): The max number of rows to read. Default: None, which reads until the end of the file.
+
+    Yields:
+        chunk (`pandas.DataFrame`): A chunk of rows, with columns named by the header of the csv
+        offset (int): The byte offset right after the last row of the chunk
+    """
+    with open(path, 'rb') as f:
+        header = f.readline()
+        if start is not None:
+            f.seek(start)
+        offset = f.tell()
+        num_rows = 0
+
+        while nrows is None or num_rows < nrows:
+            lines = list(islice(f, chunksize if nrows is None else min(chunksize, nrows - num_rows)))
+            if not lines:
+                break
+            offset = offset + sum(len(line) for line in lines)
+            num_rows = num_rows + len(lines)
+
+            chunk = pd.read_csv(io.BytesIO(header + b''.join(lines)), dtype=read_dtypes())
+            yield apply_schema(chunk), offset
+
+
 def check_path(path):
     """Create a directory if a directory or the directory of a file does not exist"""
 
@@ -47,7 +560,7 @@ def check_path(path):
         path = os.path.dirname(path)
 
     # if the directory does not exist, create it
-    if os.path.exists(path) is False:
+    if path != '' and os.path.exists(path) is False:
         os.makedirs(path)
         logger.info("The path %s does not exist and has been created." % path)
 
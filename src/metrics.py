@@ -0,0 +1,165 @@
+import os
+import sys
+import json
+import time
+import logging
+
+from src.helpers import check_path
+from src.stage_cache import artifact_files
+
+logger = logging.getLogger(__name__)
+
+# default path of the report that every pipeline step appends its metrics to
+METRICS_PATH = 'evaluation/pipeline-metrics.json'
+
+# number of latest step runs kept in the report, so it does not grow without limit
+MAX_RUNS = 100
+
+
+def peak_rss_mb():
+    """Get the peak resident set size in MB of this process and of its finished child processes (e.g. the workers of
+    a parallel filter), or None if the platform does not report it"""
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def file_size(paths):
+    """Get the total size in bytes of the existing files of data artifacts, including the companion files of a
+    feature matrix"""
+    return sum(os.path.getsize(path) for p in paths for path in artifact_files(p) if os.path.exists(path))
+
+
+class StageMetrics:
+    """Record the wall time, rows in and out, throughput, peak memory and bytes read and written of a pipeline step,
+    and append them to a JSON report when the step finishes
+
+    It is used as a context manager around the body of a `run_*` wrapper. While a step is running, chunk loops report
+    their rows with `record_chunk`, which are used as the rows in and out of the step unless they are set explicitly.
+
+    Args:
+        stage (`str`): The name of the step
+        save_to (`str`): The path to the JSON report. Default: evaluation/pipeline-metrics.json.
+    """
+
+    # the step currently being recorded, which chunk loops report to
+    active = None
+
+    def __init__(self, stage, save_to=METRICS_PATH):
+        self.stage = stage
+        self.save_to = save_to
+        self.rows_in = None
+        self.rows_out = None
+        self.chunks = 0
+        self.chunk_rows_in = 0
+        self.chunk_rows_out = 0
+        self.model = None
+        self._inputs = []
+        self._outputs = []
+        self._start = None
+
+    def read(self, *paths):
+        """Record the files read by the step"""
+        self._inputs.extend(path for path in paths if path is not None)
+
+    def write(self, *paths):
+        """Record the files written by the step, whose sizes are taken when the step finishes"""
+        self._outputs.extend(path for path in paths if path is not None)
+
+    def rows(self, rows_in=None, rows_out=None):
+        """Set the number of rows the step has read and written"""
+        if rows_in is not None:
+            self.rows_in = int(rows_in)
+        if rows_out is not None:
+            self.rows_out = int(rows_out)
+
+    def chunk(self, rows_in, rows_out):
+        """Add the rows of a chunk before and after it is processed"""
+        self.chunks = self.chunks + 1
+        self.chunk_rows_in = self.chunk_rows_in + int(rows_in)
+        self.chunk_rows_out = self.chunk_rows_out + int(rows_out)
+
+    def record_model(self, **profile):
+        """Set the costs of the model trained by the step, e.g. its fit time and size"""
+        self.model = profile
+
+    def elapsed(self):
+        """Get the seconds since the step started"""
+        return time.perf_counter() - self._start
+
+    def summary(self, status='finished'):
+        """Get the metrics of the step as a dict"""
+        wall_time = self.elapsed()
+        rows_in = self.rows_in if self.rows_in is not None else (self.chunk_rows_in if self.chunks else None)
+        rows_out = self.rows_out if self.rows_out is not None else (self.chunk_rows_out if self.chunks else None)
+        # throughput is measured on the rows read, or on the rows written if the rows read are unknown
+        rows = rows_in if rows_in is not None else rows_out
+
+        record = {'stage': self.stage, 'status': status, 'finished': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'wall_time_sec': round(wall_time, 3), 'rows_in': rows_in, 'rows_out': rows_out,
+                'rows_per_sec': None if rows is None else round(rows / max(wall_time, 1e-9), 1),
+                'chunks': self.chunks, 'peak_rss_mb': peak_rss_mb(),
+                'bytes_read': file_size(self._inputs), 'bytes_written': file_size(self._outputs)}
+        if self.model is not None:
+            record['model'] = self.model
+        return record
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        StageMetrics.active = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        StageMetrics.active = None
+        record = self.summary('finished' if exc_type is None else 'failed')
+        logger.info("%s step took %.2f sec, read %s rows and wrote %s rows (%s rows/sec), peak memory %.1f MB"
+                    % (self.stage, record['wall_time_sec'], record['rows_in'], record['rows_out'],
+                       record['rows_per_sec'], record['peak_rss_mb'] or 0))
+        save_metrics(record, self.save_to)
+
+
+def record_chunk(rows_in, rows_out):
+    """Report the rows of a chunk before and after it is processed to the step currently being recorded, if any"""
+    if StageMetrics.active is not None:
+        StageMetrics.active.chunk(rows_in, rows_out)
+
+
+def record_model(**profile):
+    """Report the costs of a trained model to the step currently being recorded, if any"""
+    if StageMetrics.active is not None:
+        StageMetrics.active.record_model(**profile)
+
+
+def load_metrics(path=METRICS_PATH):
+    """Load the metrics report, or return an empty report if it does not exist"""
+    if os.path.exists(path) is False:
+        return {'stages': {}, 'runs': []}
+
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_metrics(record, path=METRICS_PATH, max_runs=MAX_RUNS):
+    """ Append the metrics of a step run to the report, which keeps the latest `max_runs` runs in `runs` and the
+    latest run of each step in `stages`
+    Args:
+        record (`dict`): The metrics of a step run from `StageMetrics.summary`
+        path (`str`): The path to the JSON report
+        max_runs (int): The number of latest runs to keep. Default: 100.
+    Returns:
+        None
+    """
+    report = load_metrics(path)
+    report['stages'][record['stage']] = record
+    report['runs'] = (report['runs'] + [record])[-max_runs:]
+
+    check_path(path)
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    logger.info("Metrics of the %s step saved to %s" % (record['stage'], path))
@@ -0,0 +1,66 @@
+import logging
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# day names indexed by day of week, where Monday = 0 and Sunday = 6 (same as pandas)
+DAY_NAMES = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+# length and separators of the fixed-width "%Y-%m-%d %H:%M:%S" prefix of pickup_datetime
+DATETIME_WIDTH = 19
+SEPARATORS = {4: b'-', 7: b'-', 10: b' ', 13: b':', 16: b':'}
+
+# month offsets of Sakamoto's day of week algorithm
+MONTH_OFFSETS = np.array([0, 3, 2, 5, 0, 3, 5, 1, 4, 6, 2, 4])
+
+
+def parse_datetime_fields(values):
+    """Parse datetime strings in the fixed layout "%Y-%m-%d %H:%M:%S" (optionally followed by a suffix such as " UTC")
+    into integer fields, by slicing the digits of each field directly instead of calling pd.to_datetime
+
+    Args:
+        values (:obj:`list` or `pandas.Series` or `numpy.ndarray`): Datetime strings, or datetime64 values, in which
+            case the fields are taken from the `.dt` accessor.
+
+    Returns:
+        fields (`dict`): Integer arrays of `year`, `month`, `day`, `hour` and `dayofweek` (Monday = 0, Sunday = 6)
+    """
+    values = pd.Series(values) if not isinstance(values, pd.Series) else values
+
+    # values that are already parsed do not need to be parsed again
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return {'year': values.dt.year.values, 'month': values.dt.month.values, 'day': values.dt.day.values,
+                'hour': values.dt.hour.values, 'dayofweek': values.dt.dayofweek.values}
+
+    try:
+        # keep the first 19 characters of each string as bytes and view them as a (n, 19) matrix of characters
+        chars = np.asarray(values, dtype='S%i' % DATETIME_WIDTH).view(np.uint8).reshape(-1, DATETIME_WIDTH)
+    except (UnicodeEncodeError, ValueError, TypeError):
+        raise ValueError("Datetime values have to be strings in the format of %Y-%m-%d %H:%M:%S")
+
+    digit_positions = [i for i in range(DATETIME_WIDTH) if i not in SEPARATORS]
+    digits = chars[:, digit_positions].astype(np.int32) - ord('0')
+    separators = chars[:, list(SEPARATORS.keys())]
+    expected = np.frombuffer(b''.join(SEPARATORS.values()), dtype=np.uint8)
+
+    if ((digits < 0) | (digits > 9)).any() or (separators != expected).any():
+        raise ValueError("At least one datetime value is not in the format of %Y-%m-%d %H:%M:%S")
+
+    # digits are ordered as YYYY MM DD HH MM SS
+    year = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 + digits[:, 3]
+    month = digits[:, 4] * 10 + digits[:, 5]
+    day = digits[:, 6] * 10 + digits[:, 7]
+    hour = digits[:, 8] * 10 + digits[:, 9]
+
+    if ((month < 1) | (month > 12) | (day < 1) | (day > 31) | (hour > 23)).any():
+        raise ValueError("At least one datetime value has a month, day or hour out of range")
+
+    return {'year': year, 'month': month, 'day': day, 'hour': hour, 'dayofweek': dayofweek(year, month, day)}
+
+
+def dayofweek(year, month, day):
+    """Get the day of week (Monday = 0, Sunday = 6) of integer year, month and day arrays with Sakamoto's algorithm"""
+    year = year - (month < 3)
+    sunday_first = (year + year // 4 - year // 100 + year // 400 + MONTH_OFFSETS[month - 1] + day) % 7
+    return (sunday_first + 6) % 7
@@ -0,0 +1,75 @@
+import logging
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# compact dtypes of the columns in the data artifacts of every step, from raw data to test sets
+SCHEMA = {
+    'fare_amount': 'float32',
+    'pickup_longitude': 'float32',
+    'pickup_latitude': 'float32',
+    'dropoff_longitude': 'float32',
+    'dropoff_latitude': 'float32',
+    'passenger_count': 'uint8',
+    'pickup_hour': 'uint8',
+    'pickup_dayofweek': 'uint8',
+    'distance': 'float32',
+    'haversine_km': 'float32',
+    'manhattan_km': 'float32',
+    'pickup_zone': 'int32',
+    'dropoff_zone': 'int32',
+    'pickup_jfk_km': 'float32',
+    'pickup_lga_km': 'float32',
+    'pickup_midtown_km': 'float32',
+    'dropoff_jfk_km': 'float32',
+    'dropoff_lga_km': 'float32',
+    'dropoff_midtown_km': 'float32',
+}
+
+
+def read_dtypes(columns=None):
+    """Get the dtypes that can be passed to pd.read_csv for the schema columns (optionally only those in `columns`).
+    Integer columns are left out, since raw data may contain missing values that cannot be stored as integers; they
+    are cast by `apply_schema` after reading."""
+    return {col: dtype for col, dtype in SCHEMA.items()
+            if (columns is None or col in columns) and not pd.api.types.is_integer_dtype(dtype)}
+
+
+def apply_schema(df):
+    """Cast the columns of a data frame to the compact dtypes in SCHEMA
+
+    Integer columns are only cast if they have no missing values and all values fit in the integer dtype, otherwise
+    they are kept as they are.
+
+    Args:
+        df (`pandas.DataFrame`): The data frame
+
+    Returns:
+        df (`pandas.DataFrame`): The data frame with compact dtypes
+    """
+    if not isinstance(df, pd.DataFrame):
+        raise TypeError("The `df` input has to be pd.DataFrame")
+
+    for col, dtype in SCHEMA.items():
+        if col not in df.columns or df[col].dtype == dtype:
+            continue
+
+        if pd.api.types.is_integer_dtype(dtype):
+            info = np.iinfo(dtype)
+            values = df[col]
+            if values.isna().any() or not np.issubdtype(values.dtype, np.number) \
+                    or values.min() < info.min or values.max() > info.max:
+                logger.debug("%s is not cast to %s, since it has missing or out of range values" % (col, dtype))
+                continue
+
+        df[col] = df[col].astype(dtype)
+    return df
+
+
+def memory_usage(df, description='Data'):
+    """Log and return the in-memory size of a data frame in bytes, including the contents of object columns"""
+    size = int(df.memory_usage(index=True, deep=True).sum())
+    logger.info("%s takes %.2f MB in memory (%i rows, %.1f bytes per row)"
+                % (description, size / 2 ** 20, df.shape[0], size / max(df.shape[0], 1)))
+    return size
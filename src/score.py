@@ -1,17 +1,23 @@
 import sys
 import pickle
 import logging
+import numpy as np
 import pandas as pd
 
-from src.helpers import load_yaml, read_csv, write_csv, load_model
+from src.helpers import load_yaml, read_data, write_data, load_model, data_format, read_matrix, FeatureMatrix
+from src.encoder import encoder_path
+from src.metrics import StageMetrics
+from src.split import gather_rows
+from src.train import required_columns, select_features, predict
 
 logger = logging.getLogger(__name__)
 
 def score_model(data, model, feature_columns=None, target_column='fare_amount'):
     """ Generate prediction on test set
     Args:
-        data (`pandas.DataFrame`): The test set data frame.
-        model (`sklearn.linear_model.LogisticRegression`): The trained model object.
+        data (`pandas.DataFrame` or `FeatureMatrix`): The test set data frame, or a memory-mapped or sparse CSR feature
+            matrix read by `src.helpers.read_matrix`.
+        model: The trained model object of one of the backends in `src.train.BACKENDS`.
         feature_columns (:obj:`list` of :obj:`str`): List of feature column names. If not provided, then every columns
             except the target column and `test` indicator column will be used as features.
         target_column (`str`): Column name of the target. If not provided, 'fare_amount' will be used as default.
@@ -20,30 +26,19 @@ def score_model(data, model, feature_columns=None, target_column='fare_amount'):
             on test set.
     """
 
-    if not isinstance(data, pd.DataFrame):
-        raise TypeError("The `data` input has to be pd.DataFrame")
+    if not isinstance(data, (pd.DataFrame, FeatureMatrix)):
+        raise TypeError("The `data` input has to be pd.DataFrame or FeatureMatrix")
 
-    if target_column not in list(data.columns):
-        raise KeyError("Failed to score model: the target column does not exist in data frame")
+    try:
+        X_test, y_test, _ = select_features(data, feature_columns, target_column)
+    except KeyError as e:
+        raise KeyError("Failed to score model: %s" % e)
 
     # create a data frame to save the predictions
-    df = pd.DataFrame(columns=['y_test', 'ypred_test'])
-
-    df['y_test'] = data.loc[:, target_column]
-
-
-    # get features from test set
-    # if feature columns are not specified, use all columns other than the target column as features
-    if feature_columns is None:
-        X_test = data.loc[:, ~data.columns.isin([target_column])]
-    else:
-        X_test = data.loc[:, data.columns.isin(feature_columns)]
-        if X_test.shape[1] != len(feature_columns):
-            raise KeyError("At least one column in feature_columns does not exist in data frame")
-
+    df = pd.DataFrame({'y_test': np.asarray(y_test)})
 
     # get predictions
-    ypred_test = model.predict(X_test)
+    ypred_test = predict(model, X_test)
 
     # add predictions to data frame
     df['ypred_test'] = ypred_test
@@ -57,14 +52,25 @@ def run_score(args):
 
     logger.info("-------------Starting to score model-------------")
 
-    # load configuration
-    config = load_yaml(args.config)
-    # read data
-    data = read_csv(args.input_data)
-    # load model
-    model = load_model(args.input_model)
-
-    output = score_model(data, model, **config['score'])
-    write_csv(output, args.output, description="Predictions on test set")
+    with StageMetrics('score', args.metrics) as metrics:
+        # load configuration
+        config = load_yaml(args.config)
+        # read data
+        if data_format(args.input_data) in ('npy', 'npz'):
+            data = read_matrix(args.input_data)
+        elif data_format(args.input_data) == 'rows':
+            data = gather_rows(args.input_data)
+        else:
+            # only the features of the model are loaded, as given by the configuration or the layout saved next to it
+            data = read_data(args.input_data,
+                             columns=required_columns(config['score'], encoder_path(args.input_model)))
+        # load model
+        model = load_model(args.input_model)
+        metrics.read(args.input_data, args.input_model)
+
+        output = score_model(data, model, **config['score'])
+        write_data(output, args.output, description="Predictions on test set")
+        metrics.rows(rows_in=output.shape[0], rows_out=output.shape[0])
+        metrics.write(args.output)
 
     logger.info("-------------Finished scoring model-------------")
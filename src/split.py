@@ -2,17 +2,90 @@ import logging
 import numpy as np
 import pandas as pd
 from numbers import Number
-from sklearn.model_selection import train_test_split
 
-from src.helpers import read_csv, load_yaml, write_csv
+from src.helpers import read_data, read_data_chunks, load_yaml, write_data, write_matrix, write_sparse_matrix, \
+    data_format, write_row_manifest, read_row_manifest
+from src.metrics import StageMetrics, record_chunk
+from src.encoder import OneHotLayout, encoder_path
 
 logger = logging.getLogger(__name__)
 
+def strata_codes(df, strata_cols):
+    """Number each combination of values of the columns that the sampling is stratified on
+
+    Args:
+        df (`pandas.DataFrame`): The data frame
+        strata_cols (`list` of str or str): The variable names that the sampling is stratified on
+
+    Returns:
+        codes (`numpy.ndarray`): An integer stratum code per row, from 0 to the number of strata - 1 in the order
+            that strata first appear
+    """
+    if isinstance(strata_cols, str):
+        strata_cols = [strata_cols]
+    elif not isinstance(strata_cols, list):
+        raise TypeError("The strata_cols in stratified_sampling() can only be str or list, but %s is obtained"
+                        % type(strata_cols))
+
+    existing_cols = []
+    for col in strata_cols:
+        if col in df.columns:
+            existing_cols.append(col)
+        else:
+            logger.error("Failed to perform stratified sampling. %s in strata_cols does not exist in data "
+                         "frame." % col)
+
+    if not existing_cols:
+        return np.zeros(df.shape[0], dtype=np.int64)
+
+    # combine the codes of the values of each column into one key per row, with missing values coded as 0 so they make
+    # up a stratum of their own, and number the keys in the order they first appear
+    key = np.zeros(df.shape[0], dtype=np.int64)
+    for col in existing_cols:
+        codes, uniques = pd.factorize(df[col], sort=False)
+        key = key * (len(uniques) + 1) + codes + 1
+    return pd.factorize(key, sort=False)[0].astype(np.int64)
+
+
+def split_strata(codes, order, strata_obs, test_size):
+    """Sample up to `strata_obs` rows from each stratum and split them into train and test rows
+
+    Args:
+        codes (`numpy.ndarray`): The stratum code of each row, given by `strata_codes`
+        order (`numpy.ndarray`): The positions of all rows in a random order. The first `strata_obs` rows of each
+            stratum in this order are sampled.
+        strata_obs (int): The maximum number of rows sampled from each stratum
+        test_size (float): The proportion of test size out of the rows sampled from each stratum
+
+    Returns:
+        train_positions, test_positions (`numpy.ndarray`): The positions of training and test rows
+    """
+    sizes = np.bincount(codes)
+
+    # order the rows by stratum with a stable sort, so that the rows of each stratum stay in random order and the rank
+    # of a row within its stratum is its position minus the start of the stratum
+    order = order[np.argsort(codes[order], kind='stable')]
+    ordered_codes = codes[order]
+    rank = np.arange(order.shape[0]) - (np.cumsum(sizes) - sizes)[ordered_codes]
+
+    # the first strata_obs rows of each stratum are sampled, and the first ceil(test_size * sampled) of them are the
+    # test set as in train_test_split, keeping at least one row for training
+    sampled = np.minimum(sizes, strata_obs)
+    test_obs = np.where(sampled > 1, np.minimum(np.ceil(sampled * test_size), sampled - 1), 0).astype(np.int64)
+    in_test = rank < test_obs[ordered_codes]
+    in_train = ~in_test & (rank < sampled[ordered_codes])
+    return order[in_train], order[in_test]
+
+
 # get a subset of dataset for training and testing stratified on desired columns
 def stratified_sampling(df, strata_cols=['pickup_hour', 'pickup_dayofweek'], sample_obs=50000, test_size=0.3,
                         random_state=678):
     """Perform stratified sampling on multiple columns and generate train and test sets based on strata
 
+    Strata codes are assigned once, and rows are shuffled once and ordered by stratum, so that up to the same number
+    of rows is sampled from each stratum and split into train and test sets without scanning the data per stratum.
+    A stratum with a single sampled row only adds it to the training set.
+
     Args:
         df (`pandas.DataFrame`): The data frame that contains all data that need to sample from.
         strata_cols (`list` of str): A list of variable names that the sampling is stratified on.
@@ -23,8 +96,9 @@ def stratified_sampling(df, strata_cols=['pickup_hour', 'pickup_dayofweek'], sam
             Pass an int for reproducible output across multiple function calls. Default: 678.
 
     Returns:
-        train_df (`pandas.DataFrame`): The data frame that contains training set.
-        test_df (`pandas.DataFrame`): The data frame that contains test set.
+        train_df (`pandas.DataFrame`): The data frame that contains training set, indexed by the index of its rows in
+            `df`.
+        test_df (`pandas.DataFrame`): The data frame that contains test set, indexed by the index of its rows in `df`.
     """
 
     if not isinstance(df, pd.DataFrame):
@@ -37,73 +111,129 @@ def stratified_sampling(df, strata_cols=['pickup_hour', 'pickup_dayofweek'], sam
     if df.shape[0] < sample_obs:
         sample_obs = df.shape[0]
 
-    # check strata_cols type
-    # create a `strata` column
-    if isinstance(strata_cols, str):
-        df['strata'] = df[strata_cols]
-    elif isinstance(strata_cols, list):
-        if len(strata_cols) == 1:
-            df['strata'] = df[strata_cols[0]]
-        else:
-            # create a strata column and concatenate multiple columns that need to be stratified on
-            df['strata'] = ''
-
-            for col in strata_cols:
-                try:
-                    df['strata'] = df['strata'] + df[col].astype(str)
-                except KeyError:
-                    logger.error("Failed to perform stratified sampling. %s in strata_cols does not exist in data "
-                                 "frame." % col)
-    else:
-        raise TypeError("The strata_cols in stratified_sampling() can only be str or list, but %s is obtained"
-                        % type(strata_cols))
-
-    # create data frames to save train and test sets
-    train_df = pd.DataFrame(columns=df.columns)
-    test_df = pd.DataFrame(columns=df.columns)
+    codes = strata_codes(df, strata_cols)
 
     # calculate approximate # of obs for each strata
-    strata_obs = int(np.ceil(sample_obs / len(df['strata'].unique())))
+    strata_obs = int(np.ceil(sample_obs / max(codes.max() + 1 if codes.shape[0] else 0, 1)))
 
-    # for each strata
-    for strata in df['strata'].unique():
+    # shuffle all rows once
+    order = np.random.RandomState(int(random_state)).permutation(df.shape[0])
+    in_train, in_test = split_strata(codes, order, strata_obs, test_size)
 
-        # get all observations in this strata
-        subset = df.loc[df['strata'] == strata, :]
+    train_df = df.take(in_train)
+    test_df = df.take(in_test)
 
-        # if there are no obs in this strata, nothing would be added to training/test set
-        if subset.shape[0] == 0:
-            pass
+    logger.info('Train test split has been done. The training and test sets contains %i and %i observations, '
+                'respectively.' % (train_df.shape[0], test_df.shape[0]))
+    return train_df, test_df
 
-        # if there is only one observation in this strata, add it to training set
-        elif subset.shape[0] == 1:
-            train_df = train_df.append(subset, ignore_index=True, sort=False)
 
-        # if there are more than one observation in this strata
-        else:
-            # use all observations if total # of obs in this strata  <= # of obs we need to get for each strata
-            if subset.shape[0] < strata_obs:
-                # split all obs in this strata into train and test
-                train, test = train_test_split(subset, test_size=test_size, random_state=random_state)
+# column of the random key of each row kept in the reservoirs of `reservoir_sampling`
+RESERVOIR_KEY = '_reservoir_key'
 
-            # if total # of rows > # of observations we want to get
-            else:
-                # get the pre-defined # of obs for this strata
-                subset = subset.sample(n=strata_obs, random_state=random_state)
-                # split all obs in this strata into train and test
-                train, test = train_test_split(subset, test_size=test_size, random_state=random_state)
 
-            # add the train and test set obtained from this strata to df that contain all train and test samples
-            train_df = train_df.append(train, ignore_index=True, sort=False)
-            test_df = test_df.append(test, ignore_index=True, sort=False)
+def trim_reservoirs(reservoirs, strata_cols, sample_obs):
+    """Keep the rows with the smallest random keys in each stratum, up to an equal share of `sample_obs` per stratum
 
-    # drop 'strata' column afterwards
-    train_df.drop(['strata'], axis=1, inplace=True)
-    test_df.drop(['strata'], axis=1, inplace=True)
+    Args:
+        reservoirs (`pandas.DataFrame`): The rows kept so far and the rows of new chunks, with a RESERVOIR_KEY column
+        strata_cols (`list` of str): A list of variable names that the sampling is stratified on
+        sample_obs (int): The total number of observations in training and test sets desired
 
-    logger.info('Train test split has been done. The training and test sets contains %i and %i observations, '
-                'respectively.' % (train_df.shape[0], test_df.shape[0]))
-    return train_df, test_df
+    Returns:
+        reservoirs (`pandas.DataFrame`): The rows that are kept
+        thresholds (`pandas.DataFrame`): The largest key kept in each full stratum, which rows of later chunks have to
+            be below to enter its reservoir
+    """
+    codes = strata_codes(reservoirs, strata_cols)
+    capacity = int(np.ceil(sample_obs / (codes.max() + 1)))
+    rank = reservoirs[RESERVOIR_KEY].groupby(codes).rank(method='first').values
+    reservoirs = reservoirs.loc[rank <= capacity]
+
+    thresholds = reservoirs.groupby(strata_cols, sort=False)[RESERVOIR_KEY].agg(['max', 'size']).reset_index()
+    thresholds['threshold'] = np.where(thresholds['size'] >= capacity, thresholds['max'], 1.0)
+    return reservoirs, thresholds[strata_cols + ['threshold']]
+
+
+def reservoir_sampling(path, strata_cols=['pickup_hour', 'pickup_dayofweek'], sample_obs=50000, test_size=0.3,
+                       random_state=678, chunksize=100000):
+    """Perform stratified sampling on a data file by chunks, without loading it into memory, and generate train and
+    test sets based on strata
+
+    Every row gets a seeded random key, and each stratum keeps a reservoir of the rows with the smallest keys, which
+    is a uniform sample of the stratum. As new strata appear the share of `sample_obs` per stratum can only shrink, so
+    reservoirs are trimmed to the current share whenever they hold twice `sample_obs` rows. Rows whose keys are above
+    those kept in a full reservoir are dropped as soon as they are read, so memory usage is bounded by `sample_obs`
+    and `chunksize`. The kept rows are then split as in `stratified_sampling`, in the order of their keys.
+
+    Args:
+        path (`str`): The path to the data that need to sample from.
+        strata_cols (`list` of str): A list of variable names that the sampling is stratified on.
+            Default: ['pickup_hour', 'pickup_dayofweek']
+        sample_obs (int): The total number of observations in training and test sets desired. Default:50000.
+        test_size (int): The proportion of test size out of the total sample. Default: 0.3.
+        random_state (int): Seed of the random keys. Pass an int for reproducible output across multiple function
+            calls. Default: 678.
+        chunksize (int): The number of rows in each chunk. Default: 100000.
+
+    Returns:
+        train_df (`pandas.DataFrame`): The data frame that contains training set, indexed by the positions of its
+            rows in the file.
+        test_df (`pandas.DataFrame`): The data frame that contains test set, indexed by the positions of its rows in
+            the file.
+        num_rows (int): The number of rows read
+    """
+    if not all(isinstance(x, Number) for x in [sample_obs, test_size, random_state]):
+        raise TypeError("At least one of inputs (sample_obs, test_size, random_state) is not numeric")
+
+    if isinstance(strata_cols, str):
+        strata_cols = [strata_cols]
+
+    random_state = np.random.RandomState(int(random_state))
+    reservoirs = None
+    thresholds = None
+    num_rows = 0
+    for chunk in read_data_chunks(path, chunksize=chunksize):
+        missing = [col for col in strata_cols if col not in chunk.columns]
+        if missing:
+            raise KeyError("%s in strata_cols do not exist in data. Columns in data are %s"
+                           % (missing, chunk.columns.to_list()))
+
+        rows_in = chunk.shape[0]
+        # rows are indexed by their positions in the file
+        chunk.index = pd.RangeIndex(num_rows, num_rows + rows_in)
+        num_rows += rows_in
+        chunk[RESERVOIR_KEY] = random_state.random_sample(chunk.shape[0])
+
+        # rows of new strata are always kept, and rows of known strata only if their keys are below the threshold
+        if thresholds is not None:
+            limits = chunk[strata_cols].merge(thresholds, how='left', on=strata_cols)['threshold'].fillna(1.0)
+            chunk = chunk.loc[chunk[RESERVOIR_KEY].values < limits.values]
+
+        reservoirs = chunk if reservoirs is None else pd.concat([reservoirs, chunk])
+        if reservoirs.shape[0] > 2 * sample_obs:
+            reservoirs, thresholds = trim_reservoirs(reservoirs, strata_cols, sample_obs)
+        # rows out of a chunk are the rows that enter the reservoirs
+        record_chunk(rows_in, chunk.shape[0])
+
+    if reservoirs is None:
+        raise ValueError("%s does not contain any rows to sample from" % path)
+
+    reservoirs, _ = trim_reservoirs(reservoirs, strata_cols, min(sample_obs, num_rows))
+    codes = strata_codes(reservoirs, strata_cols)
+    strata_obs = int(np.ceil(min(sample_obs, num_rows) / (codes.max() + 1)))
+
+    # rows are split in the order of their keys, which is a random order
+    order = np.argsort(reservoirs[RESERVOIR_KEY].values, kind='stable')
+    in_train, in_test = split_strata(codes, order, strata_obs, test_size)
+
+    reservoirs.drop([RESERVOIR_KEY], axis=1, inplace=True)
+    train_df = reservoirs.take(in_train)
+    test_df = reservoirs.take(in_test)
+
+    logger.info('Train test split has been done by chunks over %i rows. The training and test sets contains %i and %i '
+                'observations, respectively.' % (num_rows, train_df.shape[0], test_df.shape[0]))
+    return train_df, test_df, num_rows
 
 
 def one_hot_encoder(data, one_hot_dict):
@@ -143,17 +273,128 @@ def one_hot_encoder(data, one_hot_dict):
         data.drop([feature], axis=1, inplace=True)
     return data
 
+def manifest_parts(rows, source, chunksize=100000, complement=False):
+    """ Read the rows at some positions of a data artifact by chunks, in the order of the data
+    Args:
+        rows (`numpy.ndarray`): Sorted positions of rows in the data
+        source (`str`): The path to the data
+        chunksize (int): The number of rows of the data read at once. Default: 100000.
+        complement (bool): Whether to read the rows that are not at the positions instead. Default: False.
+    Yields:
+        part (`pandas.DataFrame`): The rows of a chunk of the data
+    """
+    start = 0
+    found = 0
+    for chunk in read_data_chunks(source, chunksize=chunksize):
+        end = start + chunk.shape[0]
+        first, last = np.searchsorted(rows, [start, end])
+        found = found + last - first
+        if complement:
+            keep = np.ones(chunk.shape[0], dtype=bool)
+            keep[rows[first:last] - start] = False
+            if keep.any():
+                yield chunk.iloc[np.flatnonzero(keep)]
+        elif last > first:
+            yield chunk.iloc[rows[first:last] - start]
+        start = end
+        if not complement and last == rows.shape[0]:
+            break
+
+    if found != rows.shape[0]:
+        raise ValueError("%i rows do not exist in %s, which may have changed since the split step"
+                         % (rows.shape[0] - found, source))
+
+
+def gather_rows(path, chunksize=100000):
+    """Build a training or test set from a row manifest written by the split step: gather its rows from the source
+    data by chunks and one-hot encode them with the layout in the manifest
+
+    Args:
+        path (`str`): The path to the row manifest (.rows)
+        chunksize (int): The number of rows of the source data read at once. Default: 100000.
+
+    Returns:
+        data (`pandas.DataFrame`): The set, with the same rows in the same order and the same columns as the set
+            written by the split step as a data file
+    """
+    rows, spec = read_row_manifest(path)
+
+    # rows are gathered in the order of the source data and then put back in the order of the manifest
+    order = np.argsort(rows, kind='stable')
+    parts = list(manifest_parts(rows[order], spec['source'], chunksize))
+
+    data = pd.concat(parts, ignore_index=True).take(np.argsort(order)).reset_index(drop=True)
+    data = OneHotLayout.from_dict(spec['encoder']).transform(data)
+    logger.info("%i rows gathered from %s by %s" % (data.shape[0], spec['source'], path))
+    return data
+
+
+def stream_rows(path, chunksize=100000, complement=False):
+    """Stream the rows of a row manifest from the source data by chunks, in the order of the source data, one-hot
+    encoded with the layout in the manifest, so a set is never gathered in memory
+
+    Args:
+        path (`str`): The path to the row manifest (.rows)
+        chunksize (int): The number of rows of the source data read at once. Default: 100000.
+        complement (bool): Whether to stream every row of the source data that is not in the manifest instead, e.g.
+            all features data but the test set. Default: False.
+
+    Yields:
+        chunk (`pandas.DataFrame`): The encoded rows of a chunk of the source data
+    """
+    rows, spec = read_row_manifest(path)
+    layout = OneHotLayout.from_dict(spec['encoder'])
+    for part in manifest_parts(np.sort(rows), spec['source'], chunksize, complement):
+        yield layout.transform(part.reset_index(drop=True))
+
+
 def run_split(args):
     """ Wrapper function to pass in args, load configuration, read data and execute each step to generate train
     and test sets"""
 
     logger.info("------------------Starting to generate train and test sets------------------")
-    config = load_yaml(args.config)
-    config_split = config['split']
-    data = read_csv(args.input)
-    df_train, df_test = stratified_sampling(data, **config_split['stratified_sampling'])
-    df_train = one_hot_encoder(df_train, **config_split['one_hot_encoder'])
-    df_test = one_hot_encoder(df_test, **config_split['one_hot_encoder'])
-    write_csv(df_train, args.output_train, description='Training set')
-    write_csv(df_test, args.output_test, description='Test set')
+    with StageMetrics('split', args.metrics) as metrics:
+        config = load_yaml(args.config)
+        config_split = config['split']
+        metrics.read(args.input)
+
+        if args.chunksize is not None:
+            # sample from the data by chunks, so the data is never loaded into memory at once
+            df_train, df_test, num_rows = reservoir_sampling(args.input, chunksize=args.chunksize,
+                                                             **config_split['stratified_sampling'])
+            metrics.rows(rows_in=num_rows)
+        else:
+            data = read_data(args.input)
+            metrics.rows(rows_in=data.shape[0])
+            df_train, df_test = stratified_sampling(data, **config_split['stratified_sampling'])
+
+        # the one-hot layout fixes the columns of both sets, and is saved next to the training set for the train step
+        layout = OneHotLayout(df_train.columns, config_split['one_hot_encoder']['one_hot_dict'],
+                              target_column=config_split['target_column'])
+        layout.save(encoder_path(args.output_train))
+
+        outputs = [(df_train, args.output_train, 'Training set'), (df_test, args.output_test, 'Test set')]
+        for df, path, description in outputs:
+            # .rows outputs only save the positions of the rows in the input and how to encode them, and the train and
+            # score steps gather the rows from the input
+            if data_format(path) == 'rows':
+                spec = {'source': args.input, 'target': config_split['target_column'], 'encoder': layout.to_dict()}
+                write_row_manifest(df.index.values, path, spec, description=description)
+                continue
+
+            # .npz outputs are saved as sparse CSR feature matrices, encoded without the dense binary columns
+            if data_format(path) == 'npz':
+                write_sparse_matrix(layout.encode_sparse(df), df[config_split['target_column']], path,
+                                    layout.features, target_column=config_split['target_column'],
+                                    description=description)
+                continue
+
+            df = layout.transform(df)
+            # .npy outputs are saved as feature matrices that can be memory-mapped by the train and score steps
+            if data_format(path) == 'npy':
+                write_matrix(df, path, target_column=config_split['target_column'], description=description)
+            else:
+                write_data(df, path, description=description)
+        metrics.rows(rows_out=df_train.shape[0] + df_test.shape[0])
+        metrics.write(args.output_train, args.output_test, encoder_path(args.output_train))
     logger.info("------------------Finished generating train and test sets------------------")
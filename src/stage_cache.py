@@ -0,0 +1,175 @@
+import os
+import json
+import time
+import hashlib
+import logging
+
+from src.helpers import load_yaml, check_path, data_format, matrix_paths, row_spec_path
+from src.encoder import encoder_path
+
+logger = logging.getLogger(__name__)
+
+# pipeline steps in order, so that the steps after a step are its downstream steps
+STAGE_ORDER = ['index', 'filter', 'clean', 'featurize', 'stream', 'split', 'train', 'score', 'evaluate', 'tune']
+
+# for each step, the configuration sections it uses, the argparse args of its input and output files, and those of
+# its inputs and outputs that have a one-hot layout saved next to them
+STAGES = {
+    'index': {'config': ['index'], 'inputs': ['input'], 'outputs': ['output']},
+    'filter': {'config': ['filter'], 'inputs': ['input', 'index'], 'outputs': ['output']},
+    'clean': {'config': ['clean'], 'inputs': ['input'], 'outputs': ['output']},
+    'featurize': {'config': ['featurize'], 'inputs': ['input'], 'outputs': ['output']},
+    'stream': {'config': ['filter', 'clean', 'featurize'], 'inputs': ['input', 'index'], 'outputs': ['output']},
+    'split': {'config': ['split'], 'inputs': ['input'], 'outputs': ['output_train', 'output_test'],
+              'encoders': ['output_train']},
+    'train': {'config': ['train'], 'inputs': ['input', 'exclude'], 'outputs': ['output_model', 'output_feature_imp'],
+              'encoders': ['input', 'output_model']},
+    'score': {'config': ['score'], 'inputs': ['input_data', 'input_model'], 'outputs': ['output']},
+    'evaluate': {'config': ['evaluate'], 'inputs': ['input'], 'outputs': ['output']},
+    'tune': {'config': ['tune', 'train'], 'inputs': ['input'], 'outputs': ['output_params', 'output_leaderboard']},
+}
+
+# argparse args that do not change the outputs of a step
+IGNORED_ARGS = ['func', 'stage', 'force', 'manifest', 'resume', 'metrics']
+
+
+def load_manifest(path):
+    """Load the manifest of step hashes, or return an empty manifest if it does not exist"""
+    if os.path.exists(path) is False:
+        return {'stages': {}, 'files': {}}
+
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_manifest(manifest, path):
+    """Save the manifest of step hashes"""
+    check_path(path)
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+
+def artifact_files(path, sources=False, encoder=False):
+    """Get all files of a data artifact, which includes the target vector and column manifest of a (sparse) feature
+    matrix, and the spec of a row manifest. With `sources`, the source data that a row manifest gathers rows from is
+    included, since the rows change whenever it changes. With `encoder`, the one-hot layout saved next to a training
+    set or a model is included."""
+    if path is None:
+        return []
+    if encoder:
+        return artifact_files(path, sources) + [encoder_path(path)]
+    if data_format_or_none(path) in ('npy', 'npz'):
+        return [path] + list(matrix_paths(path))
+    if data_format_or_none(path) == 'rows':
+        files = [path, row_spec_path(path)]
+        if sources and os.path.exists(row_spec_path(path)):
+            with open(row_spec_path(path), 'r') as f:
+                files.append(json.load(f)['source'])
+        return files
+    return [path]
+
+
+def data_format_or_none(path):
+    """Get the storage format of a data artifact, or None if it is not a data artifact (e.g. a model or a report)"""
+    try:
+        return data_format(path)
+    except ValueError:
+        return None
+
+
+def file_digest(path, files, block_size=2 ** 20):
+    """ Get the sha256 of a file's content. The digest is cached in `files` with the size and modification time of
+    the file, and it is only computed again when either of them changes.
+    Args:
+        path (`str`): The path to the file
+        files (`dict`): The cache of file digests from the manifest, updated in place
+        block_size (int): The number of bytes hashed at once. Default: 1MB.
+    Returns:
+        digest (`str`): The hex digest, or None if the file does not exist
+    """
+    if os.path.exists(path) is False:
+        return None
+
+    stat = os.stat(path)
+    key = os.path.abspath(path)
+    cached = files.get(key)
+    if cached is not None and cached['size'] == stat.st_size and cached['mtime'] == stat.st_mtime:
+        return cached['sha256']
+
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha256.update(block)
+
+    files[key] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': sha256.hexdigest()}
+    return files[key]['sha256']
+
+
+def stage_hash(stage, args, config, files):
+    """ Hash everything a step's outputs depend on: the contents of its input files, its own configuration sections
+    and its command line arguments
+    Args:
+        stage (`str`): The name of the step
+        args: Argparse args of the step
+        config (`dict`): The configuration
+        files (`dict`): The cache of file digests from the manifest
+    Returns:
+        digest (`str`): The hex digest of the step
+    """
+    spec = STAGES[stage]
+    arguments = {key: value for key, value in sorted(vars(args).items()) if key not in IGNORED_ARGS}
+
+    inputs = {}
+    for name in spec['inputs']:
+        encoder = name in spec.get('encoders', [])
+        for path in artifact_files(getattr(args, name, None), sources=True, encoder=encoder):
+            inputs[path] = file_digest(path, files)
+
+    content = {'stage': stage, 'args': arguments, 'inputs': inputs,
+               'config': {section: config.get(section) for section in spec['config']}}
+    return hashlib.sha256(json.dumps(content, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def downstream(stage):
+    """Get a step and all steps after it in the pipeline"""
+    return STAGE_ORDER[STAGE_ORDER.index(stage):]
+
+
+def run_cached(stage, func, args):
+    """ Run a pipeline step unless its inputs, its configuration sections and its arguments are unchanged since its last
+    successful run and its outputs still exist. With `args.force`, the step and all its downstream steps are marked
+    as stale first, so they are rerun.
+    Args:
+        stage (`str`): The name of the step, one of STAGE_ORDER
+        func (`function`): The function that runs the step with args
+        args: Argparse args of the step, including `config`, `manifest` and `force`
+    Returns:
+        ran (bool): Whether the step has been run
+    """
+    if stage not in STAGES:
+        raise ValueError("%s is not a pipeline step that can be cached. Steps are %s" % (stage, STAGE_ORDER))
+
+    manifest = load_manifest(args.manifest)
+    if args.force:
+        for name in downstream(stage):
+            manifest['stages'].pop(name, None)
+        logger.info("Steps %s have been marked to rerun" % downstream(stage))
+
+    config = load_yaml(args.config)
+    digest = stage_hash(stage, args, config, manifest['files'])
+    encoders = STAGES[stage].get('encoders', [])
+    outputs = [path for name in STAGES[stage]['outputs']
+               for path in artifact_files(getattr(args, name, None), encoder=name in encoders)]
+
+    if manifest['stages'].get(stage, {}).get('hash') == digest and all(os.path.exists(path) for path in outputs):
+        logger.info("Skipped the %s step, since its inputs and configuration have not changed. Use --force to rerun it."
+                    % stage)
+        save_manifest(manifest, args.manifest)
+        return False
+
+    func(args)
+
+    manifest['stages'][stage] = {'hash': digest, 'outputs': outputs,
+                                 'finished': time.strftime('%Y-%m-%d %H:%M:%S')}
+    save_manifest(manifest, args.manifest)
+    return True
@@ -0,0 +1,55 @@
+import logging
+
+from src.clean import clean_data
+from src.featurize import featurize_data
+from src.filter import read_by_chunk
+from src.helpers import load_yaml, ChunkWriter
+from src.metrics import StageMetrics
+
+logger = logging.getLogger(__name__)
+
+
+def stream_ingest(file_path, save_to, config, index_path=None):
+    """ Read raw data by chunks, and filter, clean and featurize each chunk in one pass, appending the results to the
+    features output, so that raw data is read once and intermediate data is never written to disk
+    Args:
+        file_path (`str`): The path to the raw data
+        save_to (`str`): The path to save the data with features generated
+        config (`dict`): The configuration, whose `filter`, `clean` and `featurize` sections are used the same way as
+            in the filter, clean and featurize steps
+        index_path (`str`): The path to a year index. If it is up to date, only blocks containing rows of the year are
+            read. Optional, default is None, which indicates reading all raw data.
+    Returns:
+        num_rows (int): The number of rows in the features output
+    """
+    config_filter = config['filter']
+
+    with ChunkWriter(save_to) as writer:
+        for chunk in read_by_chunk(file_path, year=config_filter['year'],
+                                   max_num_rows_read=config_filter.get('max_num_rows_read'),
+                                   chunksize=config_filter.get('chunksize', 10000),
+                                   log_per_chunks=config_filter.get('log_per_chunks', 500),
+                                   index_path=index_path):
+            chunk = clean_data(chunk, config['clean'])
+            chunk = featurize_data(chunk, config['featurize'])
+            writer.write(chunk)
+
+    logger.info("Filtered, cleaned and featurized data has %i rows" % writer.num_rows)
+    return writer.num_rows
+
+
+def run_stream(args):
+    """ Wrapper function to pass in args, load configuration, and filter, clean and featurize raw data in one pass """
+    logger.info("------------------Starting to filter, clean and featurize data by chunks-----------------")
+
+    with StageMetrics('stream', args.metrics) as metrics:
+        config = load_yaml(args.config)
+        metrics.read(args.input)
+
+        # rows read are reported by the chunk loop, and rows written are the rows left after cleaning
+        num_rows = stream_ingest(args.input, args.output, config, index_path=args.index)
+        logger.info("Data with additional features generated saved to %s" % args.output)
+        metrics.rows(rows_out=num_rows)
+        metrics.write(args.output)
+
+    logger.info("------------------Finished filtering, cleaning and featurizing data-----------------")
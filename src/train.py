@@ -1,83 +1,438 @@
+import os
 import sys
 import csv
+import time
 import pickle
 import logging
+import importlib
+import numpy as np
 import pandas as pd
-from sklearn.ensemble import RandomForestRegressor
+from collections import namedtuple
+from scipy import sparse
+from sklearn.inspection import permutation_importance
 
-from src.helpers import check_path, load_yaml, read_csv, write_csv
+from src.helpers import check_path, load_yaml, read_data, read_data_chunks, write_csv, data_format, read_matrix, \
+    read_matrix_chunks, read_row_manifest, FeatureMatrix
+from src.metrics import StageMetrics, record_chunk, record_model
+from src.split import gather_rows, stream_rows
+from src.encoder import OneHotLayout, encoder_path
 
 logger = logging.getLogger(__name__)
 
-def train_rf_model(data, save_model_to=None, save_feature_imp_to=None, feature_columns=None,
-                   target_column='fare_amount', random_state=678, **kwargs):
-    """Train a logistic regression model and save the model
+def select_features(data, feature_columns=None, target_column='fare_amount'):
+    """Get the features and the target from a data frame or a feature matrix
     Args:
-        data (`pandas.DataFrame`): The training set data frame.
-        save_model_to (`str`): The path to save the trained model. If not given, it will not be saved.
-        save_model_to (`str`): The path to save feature importance. If not given, it will not be saved.
+        data (`pandas.DataFrame` or `FeatureMatrix`): The data frame, or a feature matrix read by `read_matrix`.
         feature_columns (:obj:`list` of :obj:`str`): List of feature column names. If not provided, then every columns
             except the target column will be used as features.
         target_column (`str`): Column name of the target. If not provided, 'fare_amount' will be used as default.
-        random_state (`int`): Used when solver == ‘sag’, ‘saga’ or ‘liblinear’ to shuffle the data. Default is 678.
-            It will not be used in other solvers such as the default solver ’lbfgs’.
-        **kwargs: Keyword arguments for sklearn.ensemble.RandomForestRegressor. Please see sklearn documentation
-            for all possible options:
-            https://scikit-learn.org/stable/modules/generated/sklearn.ensemble.RandomForestRegressor.html
     Returns:
-        model (`sklearn.ensemble.RandomForestRegressor`): The trained model object.
-        imp_df (`pandas.DataFrame`): The feature importance data frame.
+        X (`pandas.DataFrame`, `numpy.ndarray` or `scipy.sparse.csr_matrix`): The features. All features of a feature
+            matrix are returned without copying them.
+        y (`pandas.Series` or `numpy.ndarray`): The target
+        features (:obj:`list` of :obj:`str`): The feature names
     """
+    if isinstance(data, FeatureMatrix):
+        if target_column != data.target_column:
+            raise KeyError("The target column of the feature matrix is %s, not %s"
+                           % (data.target_column, target_column))
+
+        if feature_columns is None:
+            return data.X, data.y, list(data.columns)
+
+        if not all(col in data.columns for col in feature_columns):
+            raise KeyError("At least one column in feature_columns does not exist in the feature matrix")
+        # keep the column order of the matrix, the same as selecting columns from a data frame
+        features = [col for col in data.columns if col in feature_columns]
+        return data.X[:, [data.columns.index(col) for col in features]], data.y, features
 
-    # get y_train
     if target_column not in list(data.columns):
-        raise KeyError("Failed to start model training: the target column does not exist in data frame")
+        raise KeyError("The target column does not exist in data frame")
 
-    y_train = data.loc[:, target_column]
+    y = data.loc[:, target_column]
 
     # get features
     # if feature columns are not specified, use all columns other than the target column as features
     if feature_columns is None:
-        X_train = data.loc[:, ~data.columns.isin([target_column])]
+        X = data.loc[:, ~data.columns.isin([target_column])]
     else:
-        X_train = data.loc[:, data.columns.isin(feature_columns)]
-        if X_train.shape[1] != len(feature_columns):
+        X = data.loc[:, data.columns.isin(feature_columns)]
+        if X.shape[1] != len(feature_columns):
             raise KeyError("At least one column in feature_columns does not exist in data frame")
+    return X, y, list(X.columns)
+
+
+# model backends selected by `train.backend`: the import path of the estimator, whether it fits and predicts on sparse
+# features, whether it has impurity-based `feature_importances_`, and whether it can be trained by chunks, adding trees
+# fitted on each chunk with `warm_start`. Gradient boosting cannot, since its new trees fit the residuals of the
+# previous ones on binned features, and the bins of a new chunk differ from those of the previous ones. Backends whose
+# package is not installed can still be configured and fail when they are used.
+Backend = namedtuple('Backend', ['estimator', 'accepts_sparse', 'impurity_importances', 'incremental'])
+
+BACKENDS = {
+    'random_forest': Backend('sklearn.ensemble.RandomForestRegressor', True, True, True),
+    'hist_gradient_boosting': Backend('sklearn.ensemble.HistGradientBoostingRegressor', False, False, False),
+    'lightgbm': Backend('lightgbm.LGBMRegressor', True, True, False),
+    'xgboost': Backend('xgboost.XGBRegressor', True, True, False),
+}
+
+# modules that enable experimental estimators of backends in older versions of their packages
+EXPERIMENTAL = {'hist_gradient_boosting': 'sklearn.experimental.enable_hist_gradient_boosting'}
+
+# the section of the `train` configuration with the settings of training by chunks
+INCREMENTAL = 'incremental'
+
+
+def load_estimator(backend):
+    """Import the estimator class of a backend in `BACKENDS`"""
+    if backend not in BACKENDS:
+        raise ValueError("%s is not a model backend. Please choose one of %s" % (backend, list(BACKENDS)))
+
+    module, name = BACKENDS[backend].estimator.rsplit('.', 1)
+    try:
+        module = importlib.import_module(module)
+    except ImportError:
+        raise ImportError("The %s backend needs the %s package, which is not installed" % (backend, module))
+
+    if not hasattr(module, name) and backend in EXPERIMENTAL:
+        # scikit-learn before 1.0 only exposes experimental estimators once they are enabled
+        importlib.import_module(EXPERIMENTAL[backend])
+    try:
+        return getattr(module, name)
+    except AttributeError:
+        raise ImportError("The %s backend needs %s, which this version of %s does not have"
+                          % (backend, BACKENDS[backend].estimator, module.__name__))
+
+
+def model_backend(model):
+    """Get the name of the backend in `BACKENDS` of a trained model, or None if it is not one of them"""
+    for backend, spec in BACKENDS.items():
+        if type(model).__name__ == spec.estimator.rsplit('.', 1)[1]:
+            return backend
+    return None
+
+
+def model_config(config):
+    """ Get the keyword arguments of `train_model` from the `train` configuration
+    Args:
+        config (`dict`): The `train` configuration, whose `backend` selects the backend (default: random_forest) and
+            whose section named after the backend holds the parameters of its estimator
+    Returns:
+        kwargs (`dict`): The settings shared by all backends, the backend and the parameters of its estimator, without
+            the sections of the other backends
+    """
+    backend = config.get('backend', 'random_forest')
+    kwargs = {key: value for key, value in config.items() if key not in BACKENDS and key != INCREMENTAL}
+    kwargs.update(config.get(backend) or {})
+    kwargs['backend'] = backend
+    return kwargs
+
+
+def predict(model, X):
+    """Predict with a trained model, with sparse features made dense for backends that do not accept them"""
+    backend = model_backend(model)
+    if sparse.issparse(X) and backend is not None and not BACKENDS[backend].accepts_sparse:
+        X = X.toarray()
+    return model.predict(X)
+
+
+def feature_importance(model, X, y, features, random_state=678, max_samples=5000):
+    """ Get the importance of each feature of a trained model: the impurity-based importances of the backends that
+    have them, and the permutation importances on up to `max_samples` training rows otherwise
+    Args:
+        model: The trained model
+        X (`pandas.DataFrame`, `numpy.ndarray` or `scipy.sparse.csr_matrix`): The features the model is trained on
+        y (`pandas.Series` or `numpy.ndarray`): The target
+        features (:obj:`list` of :obj:`str`): The feature names
+        random_state (`int`): Seed of the permutations. Default is 678.
+        max_samples (`int`): The maximum number of rows to permute. Default: 5000.
+    Returns:
+        imp_df (`pandas.DataFrame`): The feature importance data frame, sorted by importance
+    """
+    backend = model_backend(model)
+    if backend is not None and BACKENDS[backend].impurity_importances:
+        importance = model.feature_importances_
+    else:
+        # permute a sample of the rows, the same for every feature
+        rows = np.random.RandomState(random_state).choice(X.shape[0], min(max_samples, X.shape[0]), replace=False)
+        rows.sort()
+        X = X.iloc[rows] if isinstance(X, pd.DataFrame) else X[rows]
+        if sparse.issparse(X):
+            X = X.toarray()
+        importance = permutation_importance(model, X, np.asarray(y)[rows], n_repeats=1,
+                                            random_state=random_state).importances_mean
+
+    imp_df = pd.DataFrame({"features": features, "importance": np.asarray(importance, dtype=np.float64).tolist()})
+    imp_df.sort_values('importance', ascending=False, inplace=True)
+    return imp_df
+
+
+def model_profile(model, X, fit_time, model_size=None, repeat=20, batch_rows=10000):
+    """ Measure the costs of a trained model
+    Args:
+        model: The trained model
+        X (`pandas.DataFrame`, `numpy.ndarray` or `scipy.sparse.csr_matrix`): Features to predict on
+        fit_time (float): The seconds the model took to fit
+        model_size (int): The bytes of the saved model. Default: None, which pickles the model to measure it.
+        repeat (int): The number of single-row predictions whose median is the latency. Default: 20.
+        batch_rows (int): The number of rows predicted at once to measure the throughput. Default: 10000.
+    Returns:
+        profile (`dict`): The backend, the fit time in seconds, the model size in MB, the latency of predicting a
+            single row in milliseconds, as the app does, and the rows per second of batch predictions
+    """
+    if model_size is None:
+        model_size = len(pickle.dumps(model))
+
+    # a single row in the form the model is trained on, e.g. a one-row data frame for models fitted on data frames
+    row = X.iloc[:1] if isinstance(X, pd.DataFrame) else X[:1]
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        predict(model, row)
+        latencies.append(time.perf_counter() - start)
+
+    batch = X.iloc[:batch_rows] if isinstance(X, pd.DataFrame) else X[:batch_rows]
+    start = time.perf_counter()
+    predict(model, batch)
+    batch_time = time.perf_counter() - start
+
+    return {'backend': model_backend(model), 'fit_time_sec': round(fit_time, 3),
+            'model_size_mb': round(model_size / 2 ** 20, 3),
+            'predict_latency_ms': round(float(np.median(latencies)) * 1e3, 3),
+            'predict_rows_per_sec': round(batch.shape[0] / max(batch_time, 1e-9), 1)}
+
+
+def save_model(model, path):
+    """Pickle a trained model to a path if it is given, and return the size of the file in bytes, or None if the model
+    is not saved"""
+    if path is None:
+        return None
+
+    # make sure the path is valid
+    check_path(path)
+    try:
+        with open(path, "wb") as f:
+            pickle.dump(model, f)
+            logger.info("Trained model object saved to %s", path)
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        logger.error("%s is valid. Please provide a valid path to save the model." % path)
+    except Exception as e:
+        logger.error(e)
+    return None
+
+
+def train_model(data, save_model_to=None, save_feature_imp_to=None, feature_columns=None, target_column='fare_amount',
+                backend='random_forest', random_state=678, dense_fit=True, **kwargs):
+    """Train a model with one of the backends in `BACKENDS` and save the model
+    Args:
+        data (`pandas.DataFrame` or `FeatureMatrix`): The training set data frame, or a memory-mapped or sparse CSR
+            feature matrix read by `src.helpers.read_matrix`.
+        save_model_to (`str`): The path to save the trained model. If not given, it will not be saved.
+        save_feature_imp_to (`str`): The path to save feature importance. If not given, it will not be saved.
+        feature_columns (:obj:`list` of :obj:`str`): List of feature column names. If not provided, then every columns
+            except the target column will be used as features.
+        target_column (`str`): Column name of the target. If not provided, 'fare_amount' will be used as default.
+        backend (`str`): The model backend: random_forest, hist_gradient_boosting, lightgbm or xgboost. Default:
+            random_forest.
+        random_state (`int`): The seed of the estimator. Default is 678.
+        dense_fit (bool): Whether a sparse feature matrix is fitted as a dense float32 copy, since random forests fit
+            several times faster on dense features than with their sparse splitter. Backends that do not accept sparse
+            features always fit on a dense copy. The sparse matrix is still what is stored and loaded. Default: True.
+        **kwargs: Keyword arguments for the estimator of the backend, e.g. sklearn.ensemble.RandomForestRegressor.
+            Please see its documentation for all possible options:
+            https://scikit-learn.org/stable/modules/generated/sklearn.ensemble.RandomForestRegressor.html
+    Returns:
+        model: The trained model object.
+        imp_df (`pandas.DataFrame`): The feature importance data frame.
+    """
+    estimator = load_estimator(backend)
+    X_train, y_train, features = select_features(data, feature_columns, target_column)
+    if sparse.issparse(X_train) and (dense_fit or not BACKENDS[backend].accepts_sparse):
+        X_train = X_train.toarray()
 
     # for reproducibility, we specify random_state ahead of time in case users forget to set it in yaml file
-    model = RandomForestRegressor(random_state=random_state, **kwargs)
+    model = estimator(random_state=random_state, **kwargs)
+    start = time.perf_counter()
     model.fit(X_train, y_train)
+    fit_time = time.perf_counter() - start
 
     # get feature importance from model
-    featureimp = model.feature_importances_.tolist()
+    imp_df = feature_importance(model, X_train, y_train, features, random_state)
 
-    # create a data frame to save feature importance
-    imp_df = pd.DataFrame({"features": list(X_train.columns), "importance": featureimp})
-    imp_df.sort_values('importance', ascending=False, inplace=True)
+    model_size = save_model(model, save_model_to)
+    if save_feature_imp_to is not None:
+        write_csv(imp_df, save_feature_imp_to, description="Feature importance")
+
+    profile = model_profile(model, X_train, fit_time, model_size)
+    logger.info("%s model fitted in %.2f sec, size %.1f MB, predicts a row in %.2f ms and %.0f rows/sec in batches"
+                % (backend, profile['fit_time_sec'], profile['model_size_mb'], profile['predict_latency_ms'],
+                   profile['predict_rows_per_sec']))
+    record_model(**profile)
 
-    if save_model_to is not None:
-        # make sure the path is valid
-        check_path(save_model_to)
-        try:
-            with open(save_model_to, "wb") as f:
-                pickle.dump(model, f)
-                logger.info("Trained model object saved to %s", save_model_to)
-        except FileNotFoundError:
-            logger.error("%s is valid. Please provide a valid path to save the model." % save_model_to)
-        except Exception as e:
-            logger.error(e)
+    return model, imp_df
+
+
+def train_rf_model(data, save_model_to=None, save_feature_imp_to=None, feature_columns=None,
+                   target_column='fare_amount', random_state=678, dense_fit=True, **kwargs):
+    """Train a random forest with `train_model` and save the model
+    Args:
+        The arguments of `train_model`, with **kwargs for sklearn.ensemble.RandomForestRegressor
+    Returns:
+        model (`sklearn.ensemble.RandomForestRegressor`): The trained model object.
+        imp_df (`pandas.DataFrame`): The feature importance data frame.
+    """
+    return train_model(data, save_model_to, save_feature_imp_to, feature_columns, target_column, 'random_forest',
+                       random_state, dense_fit, **kwargs)
 
+
+def training_chunks(path, chunksize=100000, columns=None, exclude=None):
+    """ Read a training set by chunks in the format given by its extension
+    Args:
+        path (`str`): The path to the training set written by the split step, in any format
+        chunksize (int): The number of rows read at once. Default: 100000.
+        columns (:obj:`list` of :obj:`str`): The columns to load from data files. Default: None, which loads all.
+        exclude (`str`): The path to a row manifest (.rows), e.g. the test set. If given, the chunks are every row of
+            the data the manifest was sampled from except its rows, one-hot encoded with its layout, instead of the
+            training set. Default: None.
+    Yields:
+        chunk (`pandas.DataFrame` or `FeatureMatrix`): A chunk of the training set
+    """
+    if exclude is not None:
+        return stream_rows(exclude, chunksize, complement=True)
+    if data_format(path) in ('npy', 'npz'):
+        return read_matrix_chunks(path, chunksize)
+    if data_format(path) == 'rows':
+        return stream_rows(path, chunksize)
+    return read_data_chunks(path, chunksize, columns)
+
+
+def train_incremental(chunks, save_model_to=None, save_feature_imp_to=None, feature_columns=None,
+                      target_column='fare_amount', backend='random_forest', random_state=678, trees_per_chunk=10,
+                      **kwargs):
+    """Train a model by chunks of the training set, adding `trees_per_chunk` trees fitted on each chunk to the model
+    with `warm_start`, so memory usage depends on the chunk size rather than the size of the training set
+    Args:
+        chunks (iterable of `pandas.DataFrame` or `FeatureMatrix`): The chunks of the training set, e.g. from
+            `training_chunks`
+        save_model_to (`str`): The path to save the trained model. If not given, it will not be saved.
+        save_feature_imp_to (`str`): The path to save feature importance. If not given, it will not be saved.
+        feature_columns (:obj:`list` of :obj:`str`): List of feature column names. If not provided, then every columns
+            except the target column will be used as features.
+        target_column (`str`): Column name of the target. If not provided, 'fare_amount' will be used as default.
+        backend (`str`): A backend of `BACKENDS` that can be trained by chunks. Default: random_forest.
+        random_state (`int`): The seed of the estimator. Default is 678.
+        trees_per_chunk (int): The number of trees fitted on each chunk. Default: 10.
+        **kwargs: Keyword arguments for the estimator of the backend. `n_estimators` is ignored, since the number of
+            trees is `trees_per_chunk` times the number of chunks, and so is `dense_fit`, since chunks are always
+            fitted dense.
+    Returns:
+        model: The trained model object.
+        imp_df (`pandas.DataFrame`): The feature importance data frame.
+    """
+    estimator = load_estimator(backend)
+    if not BACKENDS[backend].incremental:
+        raise ValueError("The %s backend cannot be trained by chunks. Please choose one of %s"
+                         % (backend, [name for name, spec in BACKENDS.items() if spec.incremental]))
+
+    kwargs = {key: value for key, value in kwargs.items() if key not in ('n_estimators', 'dense_fit')}
+    model = estimator(random_state=random_state, warm_start=True, n_estimators=0, **kwargs)
+
+    fit_time = 0
+    features = None
+    last = None
+    for chunk in chunks:
+        X_chunk, y_chunk, chunk_features = select_features(chunk, feature_columns, target_column)
+        if features is not None and chunk_features != features:
+            raise ValueError("The features of a chunk %s differ from the features of the first chunk %s"
+                             % (chunk_features, features))
+        features = chunk_features
+        if X_chunk.shape[0] == 0:
+            continue
+        if sparse.issparse(X_chunk):
+            X_chunk = X_chunk.toarray()
+
+        # the new trees are fitted on this chunk only, and the trees of the previous chunks are kept
+        start = time.perf_counter()
+        model.set_params(n_estimators=model.n_estimators + trees_per_chunk)
+        model.fit(X_chunk, y_chunk)
+        fit_time = fit_time + time.perf_counter() - start
+        record_chunk(X_chunk.shape[0], X_chunk.shape[0])
+        last = X_chunk, y_chunk
+
+    if last is None:
+        raise ValueError("The training set has no rows to train on")
+
+    # impurity importances are averaged over all trees, so the last chunk is only used by backends without them
+    X_chunk, y_chunk = last
+    imp_df = feature_importance(model, X_chunk, y_chunk, features, random_state)
+    model_size = save_model(model, save_model_to)
     if save_feature_imp_to is not None:
         write_csv(imp_df, save_feature_imp_to, description="Feature importance")
 
+    profile = model_profile(model, X_chunk, fit_time, model_size)
+    logger.info("%s model fitted by chunks with %i trees in %.2f sec, size %.1f MB, predicts a row in %.2f ms"
+                % (backend, model.n_estimators, profile['fit_time_sec'], profile['model_size_mb'],
+                   profile['predict_latency_ms']))
+    record_model(**profile)
+
     return model, imp_df
 
 
+def required_columns(config, layout_path=None):
+    """Get the columns that need to be loaded for a model given its configuration (`train` or `score` section). If
+    feature_columns is not configured, the features of the one-hot layout at `layout_path` are used, e.g. the layout
+    saved next to a training set or a model. If neither exists, None is returned, which indicates loading all
+    columns."""
+    feature_columns = config.get('feature_columns')
+    if feature_columns is None:
+        if layout_path is None or os.path.exists(layout_path) is False:
+            return None
+        feature_columns = OneHotLayout.load(layout_path).features
+    return list(feature_columns) + [config.get('target_column', 'fare_amount')]
+
+
 def run_train(args):
     """Load configuration file and pass argparse args which include args.input, args.output, and args.config """
 
+    if args.exclude is not None and args.chunksize is None:
+        raise ValueError("--exclude is only used when training by chunks. Please also give --chunksize.")
+
     logger.info("-------------Starting to train model-------------")
-    config = load_yaml(args.config)
-    data = read_csv(args.input)
-    train_rf_model(data, args.output_model, args.output_feature_imp, **config['train'])
+    with StageMetrics('train', args.metrics) as metrics:
+        config = load_yaml(args.config)
+        if args.chunksize is not None:
+            # train by chunks, so the training set is never loaded into memory at once
+            chunks = training_chunks(args.input, args.chunksize,
+                                     required_columns(config['train'], encoder_path(args.input)), args.exclude)
+            metrics.read(args.input if args.exclude is None else args.exclude)
+            train_incremental(chunks, args.output_model, args.output_feature_imp, **model_config(config['train']),
+                              **(config['train'].get(INCREMENTAL) or {}))
+        else:
+            if data_format(args.input) in ('npy', 'npz'):
+                data = read_matrix(args.input)
+            elif data_format(args.input) == 'rows':
+                data = gather_rows(args.input)
+            else:
+                data = read_data(args.input, columns=required_columns(config['train'], encoder_path(args.input)))
+            metrics.read(args.input)
+            metrics.rows(rows_in=data.X.shape[0] if isinstance(data, FeatureMatrix) else data.shape[0])
+
+            train_model(data, args.output_model, args.output_feature_imp, **model_config(config['train']))
+        metrics.write(args.output_model, args.output_feature_imp)
+
+        # the one-hot layout of the training set is saved next to the model, with the features the model uses, so
+        # the app encodes requests the same way
+        layout = None
+        if args.exclude is not None:
+            layout = OneHotLayout.from_dict(read_row_manifest(args.exclude)[1]['encoder'])
+        elif os.path.exists(encoder_path(args.input)):
+            layout = OneHotLayout.load(encoder_path(args.input))
+
+        if args.output_model is not None and layout is not None:
+            layout.select(config['train'].get('feature_columns')).save(encoder_path(args.output_model))
+            metrics.write(encoder_path(args.output_model))
+        else:
+            logger.warning("No one-hot layout found at %s, so none is saved next to the model"
+                           % encoder_path(args.input))
     logger.info("-------------Finished model training-------------")
@@ -0,0 +1,246 @@
+import os
+import json
+import time
+import logging
+import numpy as np
+import pandas as pd
+import yaml
+from concurrent.futures import ProcessPoolExecutor
+from sklearn.model_selection import ParameterGrid, ParameterSampler
+from threadpoolctl import threadpool_limits
+
+from src.helpers import check_path, load_yaml, read_data, write_csv, write_matrix, data_format, read_matrix
+from src.metrics import StageMetrics
+from src.split import gather_rows
+from src.train import load_estimator, select_features, predict
+
+logger = logging.getLogger(__name__)
+
+
+def sample_candidates(search_space, n_candidates=12, random_state=678):
+    """ Get the candidate parameters of a search space
+    Args:
+        search_space (`dict`): For each parameter of the estimator, the list of its values to search
+        n_candidates (int): The maximum number of candidates. Default: 12.
+        random_state (int): Seed of the sampling. Default: 678.
+    Returns:
+        candidates (:obj:`list` of `dict`): Every combination of values if there are at most `n_candidates` of them,
+            and `n_candidates` combinations sampled without replacement otherwise
+    """
+    if not isinstance(search_space, dict) or not search_space:
+        raise TypeError("The search space has to be a dict of lists of values of each parameter")
+
+    grid = ParameterGrid(search_space)
+    if len(grid) <= n_candidates:
+        return list(grid)
+    return list(ParameterSampler(search_space, n_candidates, random_state=random_state))
+
+
+def fold_order(rows, cv=3, cache_dir='data/tune-cache', random_state=678):
+    """ Get the path to a cached random permutation of the rows of a training set. The subsample of n rows of
+    successive halving is its first n rows, so each subsample contains the smaller ones, and the CV fold of a row is
+    its position in the permutation modulo `cv`, so its fold does not change as the subsamples grow. The permutation is
+    saved once for each number of rows and seed, and memory-mapped by every candidate.
+    Args:
+        rows (int): The number of rows of the training set
+        cv (int): The number of CV folds. Default: 3.
+        cache_dir (`str`): The directory of the cached permutations. Default: data/tune-cache.
+        random_state (int): Seed of the permutation. Default: 678.
+    Returns:
+        path (`str`): The path to the permutation (.npy)
+    """
+    if not isinstance(cv, int) or cv < 2:
+        raise ValueError("cv has to be an integer of at least 2")
+
+    path = os.path.join(cache_dir, 'folds-%i-rows-seed-%i.npy' % (rows, random_state))
+    if os.path.exists(path):
+        logger.info("CV folds of %i rows loaded from %s" % (rows, path))
+    else:
+        check_path(path)
+        np.save(path, np.random.RandomState(random_state).permutation(rows))
+        logger.info("CV folds of %i rows saved to %s" % (rows, path))
+    return path
+
+
+def evaluate_candidate(matrix_path, order_path, rows, params, backend='random_forest', cv=3, random_state=678,
+                       threads=None):
+    """ Cross-validate a candidate on a subsample of a memory-mapped feature matrix. It runs in the worker processes
+    of `tune_model`, which only receive the paths, so the data is shared through the OS page cache instead of being
+    copied to every worker.
+    Args:
+        matrix_path (`str`): The path to the feature matrix (.npy)
+        order_path (`str`): The path to the permutation of its rows from `fold_order`
+        rows (int): The number of rows of the subsample
+        params (`dict`): The parameters of the estimator
+        backend (`str`): The backend in `src.train.BACKENDS`. Default: random_forest.
+        cv (int): The number of CV folds. Default: 3.
+        random_state (int): Seed of the estimator. Default: 678.
+        threads (int): The maximum number of threads of the estimator. Default: None, which does not limit them.
+    Returns:
+        result (`dict`): The mean and standard deviation of the RMSE over the folds, and the mean seconds to fit and
+            to predict a fold
+    """
+    estimator = load_estimator(backend)
+    matrix = read_matrix(matrix_path)
+    subsample = np.load(order_path, mmap_mode='r')[:rows]
+    folds = np.arange(rows) % cv
+
+    rmse, fit_times, predict_times = [], [], []
+    with threadpool_limits(limits=threads):
+        for fold in range(cv):
+            # sorted rows are read from the memory-mapped matrix in the order they are stored
+            train_rows = np.sort(subsample[folds != fold])
+            test_rows = np.sort(subsample[folds == fold])
+
+            model = estimator(random_state=random_state, **params)
+            start = time.perf_counter()
+            model.fit(matrix.X[train_rows], matrix.y[train_rows])
+            fit_times.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            ypred = predict(model, matrix.X[test_rows])
+            predict_times.append(time.perf_counter() - start)
+            rmse.append(np.sqrt(np.mean((ypred - matrix.y[test_rows]) ** 2)))
+
+    return {'rmse': round(float(np.mean(rmse)), 4), 'rmse_std': round(float(np.std(rmse)), 4),
+            'fit_time_sec': round(float(np.mean(fit_times)), 3),
+            'predict_time_sec': round(float(np.mean(predict_times)), 3)}
+
+
+def tune_model(matrix_path, base_params=None, backend='random_forest', search_space=None, n_candidates=12,
+               min_rows=1000, factor=3, cv=3, n_workers=1, random_state=678, cache_dir='data/tune-cache'):
+    """ Search the parameters of a backend with successive halving: every candidate is cross-validated on a small
+    subsample, the best 1 / `factor` of them are kept, and the kept ones are cross-validated again on a subsample
+    `factor` times larger, until one candidate is left or the subsample is the whole training set
+    Args:
+        matrix_path (`str`): The path to the training set as a feature matrix (.npy)
+        base_params (`dict`): The parameters of the estimator that are not searched. Default: None.
+        backend (`str`): The backend in `src.train.BACKENDS` to tune. Default: random_forest.
+        search_space (`dict`): For each backend, the lists of values of the parameters to search
+        n_candidates (int): The maximum number of candidates. Default: 12.
+        min_rows (int): The number of rows of the first subsample. Default: 1000.
+        factor (int): The factor by which candidates are cut and subsamples grow at each rung. Default: 3.
+        cv (int): The number of CV folds. Default: 3.
+        n_workers (int): The number of processes that cross-validate candidates in parallel, each with a single
+            thread. Default: 1.
+        random_state (int): Seed of the sampling of candidates, the folds and the estimators. Default: 678.
+        cache_dir (`str`): The directory of the cached CV folds. Default: data/tune-cache.
+    Returns:
+        best_params (`dict`): The parameters of the best candidate, including `base_params`
+        leaderboard (`pandas.DataFrame`): The result of every candidate at every rung, best first
+    """
+    load_estimator(backend)
+    if search_space is None or backend not in search_space:
+        raise KeyError("The search space has no parameters of the %s backend" % backend)
+
+    if not isinstance(factor, int) or factor < 2:
+        raise ValueError("factor has to be an integer of at least 2")
+
+    if not isinstance(n_workers, int) or n_workers < 1:
+        raise ValueError("n_workers has to be a positive integer")
+
+    base_params = dict(base_params or {})
+    candidates = sample_candidates(search_space[backend], n_candidates, random_state)
+    total_rows = read_matrix(matrix_path).X.shape[0]
+    order_path = fold_order(total_rows, cv, cache_dir, random_state)
+
+    threads = None
+    fit_params = dict(base_params)
+    if n_workers > 1:
+        # workers run in parallel, so each of them fits with a single thread
+        threads = 1
+        if 'n_jobs' in fit_params:
+            fit_params['n_jobs'] = 1
+
+    results = []
+    alive = list(range(len(candidates)))
+    rows = min(min_rows, total_rows)
+    rung = 0
+    executor = ProcessPoolExecutor(max_workers=n_workers) if n_workers > 1 else None
+    try:
+        while True:
+            logger.info("Rung %i: cross-validating %i candidates on %i rows" % (rung, len(alive), rows))
+            args = [(matrix_path, order_path, rows, dict(fit_params, **candidates[i]), backend, cv, random_state,
+                     threads) for i in alive]
+            if executor is None:
+                scores = [evaluate_candidate(*arg) for arg in args]
+            else:
+                scores = [future.result() for future in [executor.submit(evaluate_candidate, *arg) for arg in args]]
+
+            for i, score in zip(alive, scores):
+                results.append(dict({'rung': rung, 'rows': rows, 'candidate': i,
+                                     'params': json.dumps(candidates[i], sort_keys=True)}, **score))
+
+            if len(alive) == 1 or rows == total_rows:
+                break
+
+            # keep the best 1 / factor candidates for the next rung, on a subsample factor times larger
+            ranked = sorted(zip(alive, scores), key=lambda pair: pair[1]['rmse'])
+            alive = [i for i, _ in ranked[:int(np.ceil(len(alive) / factor))]]
+            rows = min(rows * factor, total_rows)
+            rung = rung + 1
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    leaderboard = pd.DataFrame(results).sort_values(['rung', 'rmse'], ascending=[False, True]).reset_index(drop=True)
+    leaderboard.insert(0, 'rank', np.arange(1, leaderboard.shape[0] + 1))
+    best_params = dict(base_params, **candidates[int(leaderboard.loc[0, 'candidate'])])
+    logger.info("Best %s parameters %s with RMSE %.3f on %i rows"
+                % (backend, best_params, leaderboard.loc[0, 'rmse'], leaderboard.loc[0, 'rows']))
+    return best_params, leaderboard
+
+
+def tuning_matrix(path, cache_dir='data/tune-cache', feature_columns=None, target_column='fare_amount'):
+    """Get the path to a training set as a dense feature matrix that can be memory-mapped: the training set itself if
+    it is an .npy matrix of the features to use, and a copy of it in `cache_dir` otherwise"""
+    if data_format(path) == 'npy' and feature_columns is None:
+        return path
+
+    if data_format(path) in ('npy', 'npz'):
+        data = read_matrix(path)
+    elif data_format(path) == 'rows':
+        data = gather_rows(path)
+    else:
+        data = read_data(path)
+
+    X, y, features = select_features(data, feature_columns, target_column)
+    X = X.toarray() if hasattr(X, 'toarray') else np.asarray(X, dtype=np.float32)
+    df = pd.DataFrame(X, columns=features)
+    df[target_column] = np.asarray(y, dtype=np.float32)
+
+    matrix_path = os.path.join(cache_dir, 'train-data.npy')
+    write_matrix(df, matrix_path, target_column, description="Training set to tune on")
+    return matrix_path
+
+
+def write_params(best_params, backend, path):
+    """Write the best parameters as a fragment of config.yaml, to be copied into its `train` section"""
+    check_path(path)
+    with open(path, 'w') as f:
+        yaml.safe_dump({'train': {'backend': backend, backend: best_params}}, f, default_flow_style=False)
+    logger.info("Best parameters saved to %s" % path)
+
+
+def run_tune(args):
+    """Load configuration file and pass argparse args which include args.input, args.output_params,
+    args.output_leaderboard, args.cache_dir and args.config"""
+
+    logger.info("-------------Starting to tune model-------------")
+    with StageMetrics('tune', args.metrics) as metrics:
+        config = load_yaml(args.config)
+        config_tune = dict(config['tune'])
+        backend = config_tune.get('backend', config['train'].get('backend', 'random_forest'))
+        config_tune['backend'] = backend
+
+        matrix_path = tuning_matrix(args.input, args.cache_dir, config['train'].get('feature_columns'),
+                                    config['train'].get('target_column', 'fare_amount'))
+        metrics.read(args.input)
+        metrics.rows(rows_in=read_matrix(matrix_path).X.shape[0])
+
+        best_params, leaderboard = tune_model(matrix_path, config['train'].get(backend), cache_dir=args.cache_dir,
+                                              **config_tune)
+        write_params(best_params, backend, args.output_params)
+        write_csv(leaderboard, args.output_leaderboard, description="Tuning leaderboard")
+        metrics.write(args.output_params, args.output_leaderboard)
+    logger.info("-------------Finished model tuning-------------")
@@ -0,0 +1,126 @@
+import io
+import os
+import json
+import logging
+import itertools
+import pandas as pd
+
+from src.helpers import load_yaml, check_path
+from src.metrics import StageMetrics
+
+logger = logging.getLogger(__name__)
+
+
+def file_signature(file_path):
+    """Get the size and modification time of a file, which are used to tell whether an index is out of date"""
+    stat = os.stat(file_path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def build_year_index(file_path, date_column='pickup_datetime', block_rows=100000):
+    """ Scan raw data once and record, for each block of rows, its byte offsets, row count and number of rows per
+    pickup year
+    Args:
+        file_path (`str`): The path to the raw data
+        date_column (`str`): The datetime column whose first four characters are the year. Default: pickup_datetime.
+        block_rows (int): The number of rows in each block. Default: 100000.
+    Returns:
+        index (`dict`): The index, which contains the size and modification time of the raw data (`file`), a list of
+            `blocks`, each with `start` and `end` byte offsets, `first_row`, `num_rows` and row counts per year
+            (`years`), and the total row counts per year over all blocks (`years`).
+    """
+    if os.path.exists(file_path) is False:
+        raise FileNotFoundError("Failed to index data by year, since the file path does not exist")
+
+    if not isinstance(block_rows, int) or block_rows < 1:
+        raise ValueError("block_rows has to be a positive integer")
+
+    blocks = []
+    year_rows = {}
+    first_row = 0
+
+    logger.info("Starting to index raw data by year with %i rows per block" % block_rows)
+    with open(file_path, 'rb') as f:
+        header = f.readline()
+        start = f.tell()
+
+        while True:
+            lines = list(itertools.islice(f, block_rows))
+            if not lines:
+                break
+            end = start + sum(len(line) for line in lines)
+
+            # only parse the datetime column, and take the year from its first four characters
+            dates = pd.read_csv(io.BytesIO(header + b''.join(lines)), usecols=[date_column], dtype=str)[date_column]
+            years = pd.to_numeric(dates.str[:4], errors='coerce').dropna().astype(int).value_counts()
+            block_years = {str(year): int(count) for year, count in years.items()}
+
+            blocks.append({'start': start, 'end': end, 'first_row': first_row, 'num_rows': len(lines),
+                           'years': block_years})
+            for year, count in block_years.items():
+                year_rows[year] = year_rows.get(year, 0) + count
+
+            first_row = first_row + len(lines)
+            start = end
+
+    logger.info("Indexed %i rows in %i blocks" % (first_row, len(blocks)))
+    return {'file': file_signature(file_path), 'date_column': date_column, 'block_rows': block_rows,
+            'blocks': blocks, 'years': year_rows}
+
+
+def load_year_index(index_path, file_path):
+    """ Load a year index and check it was built from the current version of the raw data
+    Args:
+        index_path (`str`): The path to the index
+        file_path (`str`): The path to the raw data
+    Returns:
+        index (`dict`): The index, or None if it does not exist or is out of date (the size or the modification
+            time of the raw data has changed since the index was built)
+    """
+    if index_path is None or os.path.exists(index_path) is False:
+        logger.warning("Year index %s does not exist, all raw data will be scanned" % index_path)
+        return None
+
+    with open(index_path, 'r') as f:
+        index = json.load(f)
+
+    if index.get('file') != file_signature(file_path):
+        logger.warning("Year index %s is out of date, since %s has changed. All raw data will be scanned. Please run "
+                       "`python run.py index` again to rebuild the index." % (index_path, file_path))
+        return None
+
+    logger.info("Year index loaded from %s" % index_path)
+    return index
+
+
+def year_blocks(index, year, max_num_rows_read=None):
+    """ Get the blocks in a year index that contain rows of a specific year
+    Args:
+        index (`dict`): The year index
+        year (int): The specific year
+        max_num_rows_read: Only blocks starting within this number of rows are returned. Optional, default is None,
+            which indicates all blocks.
+    Returns:
+        blocks (:obj:`list` of :obj:`dict`): The matching blocks in file order
+    """
+    return [block for block in index['blocks'] if block['years'].get(str(year), 0) > 0
+            and (max_num_rows_read is None or block['first_row'] < max_num_rows_read)]
+
+
+def run_index(args):
+    """ Wrapper function to pass in args, load configuration, build the year index of raw data and save it """
+    logger.info("------------------Starting to index raw data by year-----------------")
+
+    with StageMetrics('index', args.metrics) as metrics:
+        config = load_yaml(args.config)
+        index = build_year_index(args.input, **config['index'])
+        metrics.read(args.input)
+        metrics.rows(rows_in=sum(block['num_rows'] for block in index['blocks']))
+
+        check_path(args.output)
+        with open(args.output, 'w') as f:
+            json.dump(index, f)
+        logger.info("Year index saved to %s" % args.output)
+        metrics.write(args.output)
+
+    logger.info("------------------Finished indexing raw data-----------------")
@@ -0,0 +1,73 @@
+import logging
+import numpy as np
+from functools import lru_cache
+from collections import namedtuple
+
+from src.distance import distance_kernel
+
+logger = logging.getLogger(__name__)
+
+# landmarks whose distances from each zone are precomputed, as (longitude, latitude)
+LANDMARKS = {
+    'jfk': (-73.7781, 40.6413),
+    'lga': (-73.8740, 40.7769),
+    'midtown': (-73.9855, 40.7580),
+}
+
+# a fixed grid of square cells (zones) over a bounding box, and per-zone features indexed by zone ID
+ZoneGrid = namedtuple('ZoneGrid', ['min_lon', 'min_lat', 'cell_size', 'n_lon', 'n_lat', 'features'])
+
+
+@lru_cache(maxsize=8)
+def build_zone_grid(min_lon=-75, max_lon=-72, min_lat=39, max_lat=42, cell_size=0.01, landmarks=None):
+    """ Build a grid of zones over a bounding box and precompute the haversine distance in km from the center of each
+    zone to each landmark. Grids are cached, so building the same grid again is free.
+    Args:
+        min_lon, max_lon, min_lat, max_lat (float): The bounding box of the grid, by default the bounds of NYC used
+            by `clean_locations`
+        cell_size (float): The width and height of a zone in degrees. Default: 0.01 (about 1km).
+        landmarks (:obj:`tuple` of :obj:`tuple`): (name, longitude, latitude) of each landmark. Default: None, which
+            uses LANDMARKS.
+    Returns:
+        grid (`ZoneGrid`): The grid, whose `features` maps `<landmark>_km` to a float32 array with one value per zone
+    """
+    if not cell_size > 0:
+        raise ValueError("cell_size has to be positive")
+
+    if not (min_lon < max_lon and min_lat < max_lat):
+        raise ValueError("The minimum longitude and latitude of the grid have to be less than the maximum ones")
+
+    if landmarks is None:
+        landmarks = tuple((name, lon, lat) for name, (lon, lat) in LANDMARKS.items())
+
+    n_lon = int(np.ceil((max_lon - min_lon) / cell_size))
+    n_lat = int(np.ceil((max_lat - min_lat) / cell_size))
+
+    # zone IDs are row-major: zone = lat_index * n_lon + lon_index
+    center_lon = np.tile(min_lon + (np.arange(n_lon) + 0.5) * cell_size, n_lat)
+    center_lat = np.repeat(min_lat + (np.arange(n_lat) + 0.5) * cell_size, n_lon)
+
+    features = {}
+    for name, lon, lat in landmarks:
+        features[name + '_km'] = distance_kernel(center_lon, center_lat, np.full(center_lon.shape, lon),
+                                                 np.full(center_lat.shape, lat), metrics=['haversine'],
+                                                 dtype='float32')['haversine']
+
+    logger.debug("Built a grid of %i x %i zones with features %s" % (n_lon, n_lat, list(features)))
+    return ZoneGrid(min_lon, min_lat, cell_size, n_lon, n_lat, features)
+
+
+def zone_ids(grid, longitude, latitude):
+    """ Get the zone IDs of points with integer arithmetic on whole arrays. Points outside the grid are assigned to the
+    nearest zone on its border.
+    Args:
+        grid (`ZoneGrid`): The grid built by `build_zone_grid`
+        longitude, latitude (`numpy.ndarray` or `pandas.Series`): Coordinates of the points in degrees
+    Returns:
+        ids (`numpy.ndarray`): int32 zone IDs
+    """
+    lon_index = np.floor((np.asarray(longitude, dtype=np.float64) - grid.min_lon) / grid.cell_size)
+    lat_index = np.floor((np.asarray(latitude, dtype=np.float64) - grid.min_lat) / grid.cell_size)
+    lon_index = np.clip(lon_index, 0, grid.n_lon - 1).astype(np.int32)
+    lat_index = np.clip(lat_index, 0, grid.n_lat - 1).astype(np.int32)
+    return lat_index * np.int32(grid.n_lon) + lon_index
@@ -1,17 +1,35 @@
 import os
+import json
+import argparse
 import pandas as pd
 import numpy as np
 import sklearn.ensemble
 from numbers import Number
 from src.unit_tests_helpers import compare_df, format_df, make_raw_data, make_clean_data, make_features_data, \
     make_train_data, make_test_data, make_pred_data
-from src.filter import filter_year, process_by_chunk
-from src.clean import remove_missing_obs, clean_key, clean_fare_amount, clean_locations, clean_passenger_count
-from src.featurize import generate_hour, generate_dayofweek, generate_distance
-from src.split import stratified_sampling, one_hot_encoder
-from src.train import train_rf_model
+from src.filter import filter_year, process_by_chunk, stream_by_chunk, parallel_filter, checkpointed_filter, \
+    checkpoint_path
+from src.year_index import build_year_index, load_year_index
+from src.clean import remove_missing_obs, clean_key, clean_fare_amount, clean_locations, clean_passenger_count, \
+    validity_mask
+from src.parse_datetime import parse_datetime_fields
+from src.featurize import generate_hour, generate_dayofweek, generate_distance, generate_zones
+from src.distance import distance_kernel
+from src.clean import clean_data, run_clean
+from src.featurize import featurize_data
+from src.stream import stream_ingest
+from src.split import stratified_sampling, strata_codes, reservoir_sampling, one_hot_encoder, gather_rows, stream_rows
+from src.train import train_rf_model, train_model, model_config, predict, train_incremental, run_train, \
+    required_columns
 from src.score import score_model
 from src.evaluate import evaluate_model
+from src.tune import sample_candidates, tune_model
+from src.helpers import read_data, write_data, read_data_chunks, ChunkWriter, write_matrix, read_matrix, \
+    write_sparse_matrix, write_row_manifest
+from src.schema import apply_schema
+from src.encoder import OneHotLayout, encoder_path
+from src.stage_cache import run_cached
+from src.metrics import StageMetrics, record_chunk, save_metrics
 
 ###############
 # Script: src.filter
@@ -79,6 +97,151 @@ def test_process_by_chunk_unhappy():
 
     assert compare_df(df, df_true)
 
+# filter data by chunks and write each chunk to the output file
+def test_stream_by_chunk_happy():
+    if not os.path.exists('unit_tests/'):
+        os.makedirs('unit_tests/')
+
+    file_path = 'unit_tests/test_stream_chunk_happy.csv'
+    save_to = 'unit_tests/test_stream_chunk_happy_output.csv'
+    df = make_raw_data()
+    df.to_csv(file_path, index=False)
+    num_rows = stream_by_chunk(file_path, save_to, year=2010, max_num_rows_read=None, chunksize=1, log_per_chunks=1)
+
+    # output should be the same as filtering all data at once
+    df_true = process_by_chunk(file_path, year=2010, max_num_rows_read=None, chunksize=2, log_per_chunks=1)
+    assert num_rows == 1 and compare_df(pd.read_csv(save_to), df_true)
+
+# raw data file does not exist
+def test_stream_by_chunk_unhappy():
+    try:
+        stream_by_chunk('unit_tests/not_exist.csv', 'unit_tests/not_exist_output.csv', year=2010)
+        assert False
+    except FileNotFoundError:
+        assert True
+
+# interrupt filtering after a checkpoint, and the resumed output should be identical to an uninterrupted run
+def test_checkpointed_filter_happy(monkeypatch):
+    if not os.path.exists('unit_tests/'):
+        os.makedirs('unit_tests/')
+
+    file_path = 'unit_tests/test_checkpoint_happy.csv'
+    save_to = 'unit_tests/test_checkpoint_happy_output.csv'
+    pd.concat([make_raw_data()] * 20).to_csv(file_path, index=False)
+    stream_by_chunk(file_path, 'unit_tests/test_checkpoint_happy_true.csv', year=2010, chunksize=3)
+
+    # fail on the 8th chunk, after the checkpoint of the 6th chunk has been saved
+    calls = []
+    def failing_filter_year(df, year):
+        calls.append(year)
+        if len(calls) == 8:
+            raise RuntimeError("Interrupted")
+        return filter_year(df, year)
+    monkeypatch.setattr('src.filter.filter_year', failing_filter_year)
+    try:
+        checkpointed_filter(file_path, save_to, year=2010, chunksize=3, checkpoint_per_chunks=3)
+        assert False
+    except RuntimeError:
+        assert os.path.exists(checkpoint_path(save_to))
+
+    monkeypatch.setattr('src.filter.filter_year', filter_year)
+    num_rows = checkpointed_filter(file_path, save_to, year=2010, chunksize=3, checkpoint_per_chunks=3, resume=True)
+
+    with open('unit_tests/test_checkpoint_happy_true.csv') as f1, open(save_to) as f2:
+        assert num_rows == 20 and f1.read() == f2.read()
+    assert not os.path.exists(checkpoint_path(save_to))
+
+# checkpoints have to be saved after a positive number of chunks
+def test_checkpointed_filter_unhappy():
+    if not os.path.exists('unit_tests/'):
+        os.makedirs('unit_tests/')
+
+    file_path = 'unit_tests/test_checkpoint_unhappy.csv'
+    make_raw_data().to_csv(file_path, index=False)
+    try:
+        checkpointed_filter(file_path, 'unit_tests/test_checkpoint_unhappy_output.csv', checkpoint_per_chunks=0)
+        assert False
+    except ValueError:
+        assert True
+
+# filter data in parallel by byte ranges, and the output should be identical to the serial one
+def test_parallel_filter_happy():
+    if not os.path.exists('unit_tests/'):
+        os.makedirs('unit_tests/')
+
+    file_path = 'unit_tests/test_parallel_filter_happy.csv'
+    pd.concat([make_raw_data()] * 50).to_csv(file_path, index=False)
+    stream_by_chunk(file_path, 'unit_tests/test_parallel_filter_serial.csv', year=2010, chunksize=7)
+    num_rows = parallel_filter(file_path, 'unit_tests/test_parallel_filter_parallel.csv', year=2010, n_workers=3,
+                               chunksize=7)
+
+    with open('unit_tests/test_parallel_filter_serial.csv') as f1, \
+            open('unit_tests/test_parallel_filter_parallel.csv') as f2:
+        assert num_rows == 50 and f1.read() == f2.read()
+
+# rows read by the workers are reported to the step being recorded
+def test_parallel_filter_metrics_happy(tmp_path):
+    if not os.path.exists('unit_tests/'):
+        os.makedirs('unit_tests/')
+
+    file_path = 'unit_tests/test_parallel_filter_metrics_happy.csv'
+    raw = pd.concat([make_raw_data()] * 50)
+    raw.to_csv(file_path, index=False)
+    with StageMetrics('filter', str(tmp_path / 'metrics.json')) as metrics:
+        parallel_filter(file_path, 'unit_tests/test_parallel_filter_metrics_output.csv', year=2010, n_workers=3,
+                        chunksize=7)
+
+    summary = metrics.summary()
+    assert summary['rows_in'] == raw.shape[0] and summary['rows_out'] == 50 and summary['chunks'] == 3
+
+# number of workers has to be positive
+def test_parallel_filter_unhappy():
+    if not os.path.exists('unit_tests/'):
+        os.makedirs('unit_tests/')
+
+    file_path = 'unit_tests/test_parallel_filter_unhappy.csv'
+    make_raw_data().to_csv(file_path, index=False)
+
+    try:
+        parallel_filter(file_path, 'unit_tests/test_parallel_filter_unhappy_output.csv', year=2010, n_workers=0)
+        assert False
+    except ValueError:
+        assert True
+
+###############
+# Script: src.year_index
+###############
+
+# index data by year and read only blocks containing the year
+def test_build_year_index_happy():
+    if not os.path.exists('unit_tests/'):
+        os.makedirs('unit_tests/')
+
+    file_path = 'unit_tests/test_build_year_index_happy.csv'
+    index_path = 'unit_tests/test_build_year_index_happy.json'
+    pd.concat([make_raw_data().iloc[[1]]] * 4 + [make_raw_data()]).to_csv(file_path, index=False)
+    index = build_year_index(file_path, block_rows=2)
+    with open(index_path, 'w') as f:
+        json.dump(index, f)
+
+    df = process_by_chunk(file_path, year=2010, chunksize=2, index_path=index_path)
+    df_true = process_by_chunk(file_path, year=2010, chunksize=2)
+    assert index['years'] == {'2009': 5, '2010': 1} and len(index['blocks']) == 3 and df.equals(df_true)
+
+# index is out of date after raw data changes
+def test_build_year_index_unhappy():
+    if not os.path.exists('unit_tests/'):
+        os.makedirs('unit_tests/')
+
+    file_path = 'unit_tests/test_build_year_index_unhappy.csv'
+    index_path = 'unit_tests/test_build_year_index_unhappy.json'
+    make_raw_data().to_csv(file_path, index=False)
+    with open(index_path, 'w') as f:
+        json.dump(build_year_index(file_path, block_rows=1), f)
+    pd.concat([make_raw_data()] * 2).to_csv(file_path, index=False)
+
+    assert load_year_index(index_path, file_path) is None
+
 ###############
 # Script: src.clean
 ###############
@@ -189,6 +352,85 @@ def test_clean_passenger_count_unhappy():
     except ValueError:
         assert True
 
+# every rule is evaluated on all observations, and rejections are counted for each rule
+def test_validity_mask_happy():
+    df = make_raw_data()
+    # fare_amount = 0.5 < 2.5 and pickup_longitude = -100 < -75
+    df.loc[len(df), :] = [
+        '2011-06-13 12:26:12.0000001', 0.5, '2011-06-13 12:26:12 UTC', -100, 40.721319, -73.84161, 40.712278, 1
+    ]
+    df.loc[len(df), :] = [
+        '2011-06-13 12:26:12.0000002', 8.5, '2011-06-13 12:26:12 UTC', -73.844311, 40.721319, None, 40.712278, 1
+    ]
+    config_clean = {'clean_fare_amount': {'initial_charge': 2.5},
+                    'clean_locations': {'nyc_min_lon': -75, 'nyc_max_lon': -72, 'nyc_min_lat': 39, 'nyc_max_lat': 42},
+                    'clean_passenger_count': {'min_count': 1, 'max_count': 5}}
+    mask, rejected = validity_mask(df, config_clean)
+
+    assert mask.tolist() == [True, True, False, False]
+    assert rejected == {'remove_missing_obs': 1, 'clean_fare_amount': 1, 'clean_locations': 1,
+                        'clean_passenger_count': 0}
+
+# every section of the clean configuration has to be a rule
+def test_validity_mask_unhappy():
+    try:
+        validity_mask(make_raw_data(), {'clean_tips': {'max_tip': 100}})
+        assert False
+    except KeyError:
+        assert True
+
+# cleaning by chunks should give the same output as cleaning all data at once
+def test_run_clean_chunks_happy(tmp_path):
+    if not os.path.exists('unit_tests/'):
+        os.makedirs('unit_tests/')
+
+    df = pd.concat([make_raw_data()] * 10, ignore_index=True)
+    df.loc[3, 'fare_amount'] = 0.5
+    df.loc[8, 'passenger_count'] = None
+    df.to_csv('unit_tests/test_run_clean_chunks_input.csv', index=False)
+
+    outputs = []
+    for chunksize in [None, 3]:
+        output = 'unit_tests/test_run_clean_chunks_%s.csv' % chunksize
+        run_clean(argparse.Namespace(input='unit_tests/test_run_clean_chunks_input.csv', output=output,
+                                     config='config/config.yaml', chunksize=chunksize,
+                                     metrics=str(tmp_path / 'metrics.json')))
+        outputs.append(pd.read_csv(output))
+
+    assert outputs[0].shape[0] == 18 and outputs[0].equals(outputs[1])
+
+# input data has to exist to be cleaned by chunks
+def test_run_clean_chunks_unhappy(tmp_path):
+    try:
+        run_clean(argparse.Namespace(input='unit_tests/not_exist.csv', output='unit_tests/not_exist_output.csv',
+                                     config='config/config.yaml', chunksize=3,
+                                     metrics=str(tmp_path / 'metrics.json')))
+        assert False
+    except FileNotFoundError:
+        assert True
+
+###############
+# Script: src.parse_datetime
+###############
+
+# fields parsed from fixed-width strings should be the same as the ones from pandas
+def test_parse_datetime_fields_happy():
+    values = pd.Series(['2010-01-05 16:52:16 UTC', '2009-06-15 17:26:21', '2012-02-29 00:00:00 UTC',
+                        '2015-12-31 23:59:59 UTC'])
+    fields = parse_datetime_fields(values)
+    datetimes = pd.to_datetime(values.str[:19], format='%Y-%m-%d %H:%M:%S')
+
+    assert (fields['year'] == datetimes.dt.year.values).all() and (fields['hour'] == datetimes.dt.hour.values).all() \
+        and (fields['dayofweek'] == datetimes.dt.dayofweek.values).all()
+
+# values not in the fixed-width format
+def test_parse_datetime_fields_unhappy():
+    try:
+        parse_datetime_fields(['2010/01/05 16:52:16 UTC', '2010-01-05 16:52:16 UTC'])
+        assert False
+    except ValueError:
+        assert True
+
 ###############
 # Script: src.featurize
 ###############
@@ -213,7 +455,7 @@ def test_generate_dayofweek_happy():
     df = generate_dayofweek(df)
 
     df_true = make_clean_data()
-    df_true['pickup_dayofweek'] = ['Tuesday', 'Monday']
+    df_true['pickup_dayofweek'] = np.array([1, 0], dtype=np.uint8)
     assert compare_df(df, df_true, str_col=None)
 
 def test_generate_dayofweek_unhappy():
@@ -246,6 +488,79 @@ def test_generate_distance_unhappy():
     except TypeError:
         assert True
 
+# zones are looked up on the grid, and a pickup in Midtown is in the zone closest to Midtown
+def test_generate_zones_happy():
+    df = make_clean_data()
+    df.loc[0, ['pickup_longitude', 'pickup_latitude']] = [-73.9855, 40.7580]
+    df = generate_zones(df, min_lon=-75, max_lon=-72, min_lat=39, max_lat=42, cell_size=0.01)
+
+    # longitude index = floor((-73.9855 + 75) / 0.01) = 101, latitude index = floor((40.758 - 39) / 0.01) = 175
+    assert df.loc[0, 'pickup_zone'] == 175 * 300 + 101
+    assert df.loc[0, 'pickup_midtown_km'] < 1 and abs(df.loc[0, 'pickup_jfk_km'] - 21.8) < 1
+    assert df['dropoff_zone'].dtype == np.int32
+
+# zones have to have a positive size
+def test_generate_zones_unhappy():
+    try:
+        generate_zones(make_clean_data(), cell_size=0)
+        assert False
+    except ValueError:
+        assert True
+
+# haversine and Manhattan distances are in km, e.g. about 21.8km from Midtown to JFK in a straight line
+def test_distance_kernel_happy():
+    distances = distance_kernel(np.array([-73.9855]), np.array([40.7580]), np.array([-73.7781]), np.array([40.6413]),
+                                metrics=['euclidean', 'haversine', 'manhattan'], dtype='float32')
+
+    assert all(values.dtype == np.float32 for values in distances.values())
+    assert abs(distances['euclidean'][0] - 0.23798) < 1e-4 and abs(distances['haversine'][0] - 21.773) < 1e-2 \
+        and distances['manhattan'][0] > distances['haversine'][0]
+
+# metrics have to be one of euclidean, haversine and manhattan
+def test_distance_kernel_unhappy():
+    try:
+        distance_kernel(np.zeros(2), np.zeros(2), np.ones(2), np.ones(2), metrics=['chebyshev'])
+        assert False
+    except ValueError:
+        assert True
+
+###############
+# Script: src.stream
+###############
+
+def make_stream_config():
+    """configuration with the sections used by stream_ingest"""
+    return {'filter': {'year': 2010, 'max_num_rows_read': None, 'chunksize': 1, 'log_per_chunks': 1},
+            'clean': {'clean_fare_amount': {'initial_charge': 2.5},
+                      'clean_locations': {'nyc_min_lon': -75, 'nyc_max_lon': -72, 'nyc_min_lat': 39, 'nyc_max_lat': 42},
+                      'clean_passenger_count': {'min_count': 1, 'max_count': 5}},
+            'featurize': {'generate_hour': {'generate': True}, 'generate_dayofweek': {'generate': True},
+                          'generate_distance': {'generate': True}}}
+
+# output of streaming should be the same as filtering, cleaning and featurizing separately
+def test_stream_ingest_happy():
+    if not os.path.exists('unit_tests/'):
+        os.makedirs('unit_tests/')
+
+    file_path = 'unit_tests/test_stream_ingest_happy.csv'
+    save_to = 'unit_tests/test_stream_ingest_happy_output.csv'
+    pd.concat([make_raw_data()] * 3).to_csv(file_path, index=False)
+    config = make_stream_config()
+    num_rows = stream_ingest(file_path, save_to, config)
+
+    df_true = process_by_chunk(file_path, year=2010, chunksize=2)
+    df_true = featurize_data(clean_data(df_true, config['clean']), config['featurize'])
+    with open(save_to) as f:
+        assert num_rows == 3 and f.read() == df_true.to_csv(index=False)
+
+# raw data file does not exist
+def test_stream_ingest_unhappy():
+    try:
+        stream_ingest('unit_tests/not_exist.csv', 'unit_tests/not_exist_output.csv', make_stream_config())
+        assert False
+    except FileNotFoundError:
+        assert True
+
 ###############
 # Script: src.split
 ###############
@@ -266,13 +581,108 @@ def test_stratified_sampling_unhappy():
     test_df['strata'] = test_df['pickup_hour'].astype(str) + test_df['pickup_dayofweek'].astype(str)
     assert train_df['strata'].value_counts().equals(test_df['strata'].value_counts())
 
+# rows with the same hour and day of week share a code, and the same random_state gives the same split
+def test_strata_codes_happy():
+    df = make_features_data()
+    codes = strata_codes(df, ['pickup_hour', 'pickup_dayofweek'])
+    train_1, test_1 = stratified_sampling(df, random_state=1)
+    train_2, test_2 = stratified_sampling(df, random_state=1)
+    assert list(codes) == [0, 0, 1, 1] and train_1.equals(train_2) and test_1.equals(test_2)
+
+# strata_cols has to be str or list
+def test_strata_codes_unhappy():
+    try:
+        strata_codes(make_features_data(), ('pickup_hour', 'pickup_dayofweek'))
+        assert False
+    except TypeError:
+        assert True
+
+# sampling by chunks of one row splits each stratum as the in-memory sampling does
+def test_reservoir_sampling_happy():
+    if not os.path.exists('unit_tests/'):
+        os.makedirs('unit_tests/')
+
+    make_features_data().to_csv('unit_tests/test_reservoir_sampling_happy.csv', index=False)
+    train_df, test_df, num_rows = reservoir_sampling('unit_tests/test_reservoir_sampling_happy.csv', chunksize=1)
+    train_df['strata'] = train_df['pickup_hour'].astype(str) + train_df['pickup_dayofweek'].astype(str)
+    test_df['strata'] = test_df['pickup_hour'].astype(str) + test_df['pickup_dayofweek'].astype(str)
+    assert num_rows == 4 and train_df['strata'].value_counts().equals(test_df['strata'].value_counts())
+
+# one of strata_cols does not exist in data
+def test_reservoir_sampling_unhappy():
+    if not os.path.exists('unit_tests/'):
+        os.makedirs('unit_tests/')
+
+    make_features_data().to_csv('unit_tests/test_reservoir_sampling_unhappy.csv', index=False)
+    try:
+        reservoir_sampling('unit_tests/test_reservoir_sampling_unhappy.csv', strata_cols=['pickup_hour', 'not_exist'])
+        assert False
+    except KeyError:
+        assert True
+
+# rows gathered from a row manifest are the same as the rows encoded by the split step, in the order of the manifest
+def test_gather_rows_happy():
+    if not os.path.exists('unit_tests/'):
+        os.makedirs('unit_tests/')
+
+    make_features_data().to_csv('unit_tests/test_gather_rows_happy.csv', index=False)
+    layout = OneHotLayout(make_features_data().columns, {'pickup_dayofweek': list(range(7))})
+    write_row_manifest([3, 0], 'unit_tests/test_gather_rows_happy.rows',
+                       {'source': 'unit_tests/test_gather_rows_happy.csv', 'encoder': layout.to_dict()})
+    df = gather_rows('unit_tests/test_gather_rows_happy.rows', chunksize=1)
+    df_true = layout.transform(apply_schema(make_features_data()).iloc[[3, 0]].reset_index(drop=True))
+    assert list(df.columns) == list(df_true.columns) and np.allclose(df.values, df_true.values)
+
+# the manifest has rows that do not exist in the source data
+def test_gather_rows_unhappy():
+    if not os.path.exists('unit_tests/'):
+        os.makedirs('unit_tests/')
+
+    make_features_data().to_csv('unit_tests/test_gather_rows_unhappy.csv', index=False)
+    write_row_manifest([0, 4], 'unit_tests/test_gather_rows_unhappy.rows',
+                       {'source': 'unit_tests/test_gather_rows_unhappy.csv',
+                        'encoder': OneHotLayout(make_features_data().columns, {}).to_dict()})
+    try:
+        gather_rows('unit_tests/test_gather_rows_unhappy.rows')
+        assert False
+    except ValueError:
+        assert True
+
+# the complement of a manifest is every other row of the source data, in order and encoded by chunks
+def test_stream_rows_happy():
+    if not os.path.exists('unit_tests/'):
+        os.makedirs('unit_tests/')
+
+    make_features_data().to_csv('unit_tests/test_stream_rows_happy.csv', index=False)
+    layout = OneHotLayout(make_features_data().columns, {'pickup_dayofweek': list(range(7))})
+    write_row_manifest([2, 0], 'unit_tests/test_stream_rows_happy.rows',
+                       {'source': 'unit_tests/test_stream_rows_happy.csv', 'encoder': layout.to_dict()})
+    chunks = list(stream_rows('unit_tests/test_stream_rows_happy.rows', chunksize=2, complement=True))
+    df_true = layout.transform(apply_schema(make_features_data()).iloc[[1, 3]].reset_index(drop=True))
+    assert len(chunks) == 2 and list(chunks[0].columns) == list(df_true.columns) \
+        and np.allclose(pd.concat(chunks).values, df_true.values)
+
+# the manifest has rows that do not exist in the source data
+def test_stream_rows_unhappy():
+    if not os.path.exists('unit_tests/'):
+        os.makedirs('unit_tests/')
+
+    make_features_data().to_csv('unit_tests/test_stream_rows_unhappy.csv', index=False)
+    write_row_manifest([0, 4], 'unit_tests/test_stream_rows_unhappy.rows',
+                       {'source': 'unit_tests/test_stream_rows_unhappy.csv',
+                        'encoder': OneHotLayout(make_features_data().columns, {}).to_dict()})
+    try:
+        list(stream_rows('unit_tests/test_stream_rows_unhappy.rows', complement=True))
+        assert False
+    except ValueError:
+        assert True
+
 def test_one_hot_encoder_happy():
     df = make_features_data()
-    df = one_hot_encoder(df, {'pickup_dayofweek': ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday',
-                                                   'Saturday', 'Sunday']})
+    df = one_hot_encoder(df, {'pickup_dayofweek': list(range(7))})
 
-    if (df.loc[0:1, 'pickup_dayofweek_Thursday'].all() == 0) and (df.loc[0:1, 'pickup_dayofweek_Sunday'].all() == 1) and \
-            (df.loc[2:3, 'pickup_dayofweek_Thursday'].all() == 1) and (df.loc[2:3, 'pickup_dayofweek_Sunday'].all() == 0):
+    if (df.loc[0:1, 'pickup_dayofweek_3'].all() == 0) and (df.loc[0:1, 'pickup_dayofweek_6'].all() == 1) and \
+            (df.loc[2:3, 'pickup_dayofweek_3'].all() == 1) and (df.loc[2:3, 'pickup_dayofweek_6'].all() == 0):
         assert True
     else:
         assert False
@@ -288,6 +698,49 @@ def test_one_hot_encoder_unhappy():
     except KeyError:
         assert True
 
+###############
+# Script: src.encoder
+###############
+
+# a single row and a batch are encoded into the same columns as the data frame, in a fixed order
+def test_one_hot_layout_happy():
+    df = make_features_data()
+    layout = OneHotLayout(df.columns, {'pickup_dayofweek': list(range(7)), 'pickup_hour': list(range(1, 24))})
+    layout.save('unit_tests/test_one_hot_layout_happy.encoder.json')
+    layout = OneHotLayout.load('unit_tests/test_one_hot_layout_happy.encoder.json')
+    encoded = layout.transform(df)
+    batch = layout.encode(df)
+    row = layout.encode(df.loc[2].to_dict())
+    assert list(encoded.columns[-30:-23]) == ['pickup_dayofweek_%i' % i for i in range(7)] \
+        and np.allclose(encoded[layout.features].values, batch) and np.allclose(batch[2], row[0]) \
+        and row[0, layout.features.index('pickup_dayofweek_3')] == 1 \
+        and row[0, layout.features.index('pickup_hour_10')] == 1
+
+# a feature that needs to be one-hot encoded does not exist in data frame
+def test_one_hot_layout_unhappy():
+    df = make_features_data().drop(['pickup_hour'], axis=1)
+    try:
+        OneHotLayout(df.columns, {'pickup_hour': list(range(24))})
+        assert False
+    except KeyError:
+        assert True
+
+# the CSR matrix has the same values as the dense encoding, without storing the zeros of binary columns
+def test_encode_sparse_happy():
+    df = make_features_data()
+    layout = OneHotLayout(df.columns, {'pickup_dayofweek': list(range(7)), 'pickup_hour': list(range(1, 24))})
+    matrix = layout.encode_sparse(df)
+    assert matrix.format == 'csr' and matrix.nnz == 4 * 8 and np.allclose(matrix.toarray(), layout.encode(df))
+
+# only data frames can be encoded as sparse matrices
+def test_encode_sparse_unhappy():
+    layout = OneHotLayout(make_features_data().columns, {'pickup_dayofweek': list(range(7))})
+    try:
+        layout.encode_sparse(make_features_data().values)
+        assert False
+    except TypeError:
+        assert True
+
 ###############
 # Script: src.train
 ###############
@@ -308,6 +761,70 @@ def test_train_rf_model_unhappy():
     except KeyError:
         assert True
 
+# the backend and its parameters are selected from the train configuration, and the model costs are recorded
+def test_train_model_happy(tmp_path):
+    config = {'target_column': 'fare_amount', 'backend': 'hist_gradient_boosting', 'random_state': 678,
+              'random_forest': {'n_estimators': 5}, 'hist_gradient_boosting': {'max_iter': 10}}
+    kwargs = model_config(config)
+    df = make_train_data()
+    with StageMetrics('train', str(tmp_path / 'metrics.json')) as metrics:
+        model, imp = train_model(df, **kwargs)
+
+    assert type(model).__name__ == 'HistGradientBoostingRegressor' and model.max_iter == 10 \
+        and 'n_estimators' not in kwargs and imp.shape[0] == df.shape[1] - 1 \
+        and metrics.model['backend'] == 'hist_gradient_boosting' and metrics.model['model_size_mb'] > 0 \
+        and predict(model, df.drop(columns=['fare_amount'])).shape == (df.shape[0],)
+
+# an unknown backend raises value error
+def test_train_model_unhappy():
+    try:
+        train_model(make_train_data(), backend='not_exist_backend')
+        assert False
+    except ValueError:
+        assert True
+
+# each chunk adds its trees to the model, empty chunks are skipped and n_estimators of the configuration is ignored
+def test_train_incremental_happy():
+    df = make_train_data()
+    chunks = [df.iloc[:1], df.iloc[1:], df.iloc[2:]]
+    model, imp = train_incremental(chunks, trees_per_chunk=2, n_estimators=500)
+    assert isinstance(model, sklearn.ensemble.RandomForestRegressor) and len(model.estimators_) == 4 \
+        and imp.shape[0] == df.shape[1] - 1
+
+# gradient boosting cannot be trained by chunks
+def test_train_incremental_unhappy():
+    try:
+        train_incremental([make_train_data()], backend='hist_gradient_boosting')
+        assert False
+    except ValueError:
+        assert True
+
+# the rows of a manifest can only be excluded when training by chunks
+def test_run_train_unhappy():
+    args = argparse.Namespace(input='data/train-data.csv', exclude='data/test-data.rows', chunksize=None,
+                              output_model=None, output_feature_imp=None, config='config/config.yaml',
+                              metrics='unit_tests/test_run_train_unhappy.json')
+    try:
+        run_train(args)
+        assert False
+    except ValueError:
+        assert True
+
+# without feature_columns, only the features of the layout saved next to a model and the target are loaded
+def test_required_columns_happy(tmp_path):
+    layout_path = str(tmp_path / 'model.encoder.json')
+    OneHotLayout(['distance', 'pickup_hour', 'fare_amount'], {'pickup_hour': [1, 2]}).select(
+        ['distance', 'pickup_hour_2']).save(layout_path)
+
+    assert required_columns({'target_column': 'fare_amount'}, layout_path) \
+        == ['distance', 'pickup_hour_2', 'fare_amount'] \
+        and required_columns({'feature_columns': ['distance']}, layout_path) == ['distance', 'fare_amount']
+
+# without feature_columns or a layout, all columns are loaded
+def test_required_columns_unhappy(tmp_path):
+    assert required_columns({'target_column': 'fare_amount'}, str(tmp_path / 'not_exist.encoder.json')) is None \
+        and required_columns({'target_column': 'fare_amount'}) is None
+
 ###############
 # Script: src.score
 ###############
@@ -333,6 +850,52 @@ def test_score_model_unhappy():
     except KeyError:
         assert True
 
+###############
+# Script: src.tune
+###############
+
+# every combination is a candidate when there are at most n_candidates of them, and a sample of them otherwise
+def test_sample_candidates_happy():
+    search_space = {'n_estimators': [10, 20], 'min_samples_split': [2, 5, 10]}
+    candidates = sample_candidates(search_space, n_candidates=6)
+    sampled = sample_candidates(search_space, n_candidates=4)
+    assert len(candidates) == 6 and {'n_estimators': 20, 'min_samples_split': 5} in candidates \
+        and len(sampled) == 4 and all(candidate in candidates for candidate in sampled)
+
+# the search space is not a dict of lists
+def test_sample_candidates_unhappy():
+    try:
+        sample_candidates([10, 20])
+        assert False
+    except TypeError:
+        assert True
+
+# the best third of the candidates on 20 rows are cross-validated again on all 60 rows, and the best of them wins
+def test_tune_model_happy():
+    if not os.path.exists('unit_tests/'):
+        os.makedirs('unit_tests/')
+
+    write_matrix(pd.concat([make_train_data()] * 30, ignore_index=True), 'unit_tests/test_tune_model_happy.npy')
+    search_space = {'random_forest': {'n_estimators': [2, 3], 'min_samples_split': [2, 4]}}
+    best_params, leaderboard = tune_model('unit_tests/test_tune_model_happy.npy', {'n_jobs': 1},
+                                          search_space=search_space, min_rows=20, cv=3,
+                                          cache_dir='unit_tests/tune-cache')
+    assert leaderboard['rows'].tolist() == [60, 60, 20, 20, 20, 20] and best_params['n_jobs'] == 1 \
+        and json.loads(leaderboard.loc[0, 'params']) == {key: best_params[key] for key in search_space['random_forest']}
+
+# the search space has no parameters of the backend
+def test_tune_model_unhappy():
+    if not os.path.exists('unit_tests/'):
+        os.makedirs('unit_tests/')
+
+    write_matrix(make_train_data(), 'unit_tests/test_tune_model_unhappy.npy')
+    try:
+        tune_model('unit_tests/test_tune_model_unhappy.npy', backend='hist_gradient_boosting',
+                   search_space={'random_forest': {'n_estimators': [2, 3]}})
+        assert False
+    except KeyError:
+        assert True
+
 ###############
 # Script: src.evaluate
 ###############
@@ -352,4 +915,237 @@ def test_evaluate_model_unhappy():
         assert True
 
 
+###############
+# Script: src.helpers
+###############
+
+# write and read data in parquet format, loading only some of the columns
+def test_read_data_happy():
+    df = make_raw_data()
+    write_data(df, 'unit_tests/test_read_data_happy.parquet')
+    df_read = read_data('unit_tests/test_read_data_happy.parquet', columns=['key', 'fare_amount'])
+    assert list(df_read.columns) == ['key', 'fare_amount'] and compare_df(df_read, df[['key', 'fare_amount']],
+                                                                          numeric_cols=['fare_amount'], date_col=None)
+
+# unsupported file extension returns None
+def test_read_data_unhappy():
+    assert read_data('unit_tests/test_read_data_unhappy.txt') is None
+
+# parquet files written at once are split into row groups, so they are read by chunks without loading the whole file
+def test_write_data_row_groups_happy():
+    if not os.path.exists('unit_tests/'):
+        os.makedirs('unit_tests/')
+
+    import pyarrow.parquet as pq
+    df = pd.concat([make_raw_data()] * 3, ignore_index=True)
+    write_data(df, 'unit_tests/test_write_data_row_groups_happy.parquet', row_group_size=2)
+    chunks = list(read_data_chunks('unit_tests/test_write_data_row_groups_happy.parquet', chunksize=4))
+    assert pq.ParquetFile('unit_tests/test_write_data_row_groups_happy.parquet').num_row_groups == 3 \
+        and [chunk.shape[0] for chunk in chunks] == [2, 2, 2] and compare_df(pd.concat(chunks, ignore_index=True), df)
+
+# write data by chunks in parquet format and read it back by chunks
+def test_chunk_writer_happy():
+    df = pd.concat([make_raw_data()] * 3, ignore_index=True)
+    with ChunkWriter('unit_tests/test_chunk_writer_happy.parquet') as writer:
+        for start in range(0, df.shape[0], 4):
+            writer.write(df.iloc[start:start + 4])
+
+    chunks = list(read_data_chunks('unit_tests/test_chunk_writer_happy.parquet', chunksize=4))
+    assert writer.num_rows == 6 and compare_df(pd.concat(chunks, ignore_index=True), df)
+
+# an empty first chunk does not fix the types of the parquet file, and a file of empty chunks still has the columns
+def test_chunk_writer_empty_chunks_happy():
+    if not os.path.exists('unit_tests/'):
+        os.makedirs('unit_tests/')
+
+    df = make_raw_data()
+    with ChunkWriter('unit_tests/test_chunk_writer_empty_chunks_happy.parquet') as writer:
+        writer.write(df.iloc[:0])
+        writer.write(df)
+    with ChunkWriter('unit_tests/test_chunk_writer_empty_chunks_empty.parquet') as writer:
+        writer.write(df.iloc[:0])
+
+    df_empty = read_data('unit_tests/test_chunk_writer_empty_chunks_empty.parquet')
+    assert compare_df(read_data('unit_tests/test_chunk_writer_empty_chunks_happy.parquet'), df) \
+        and df_empty.shape == (0, df.shape[1]) and list(df_empty.columns) == list(df.columns)
+
+# a file without any chunk is written empty with the given columns in every format, and read back as empty data
+def test_chunk_writer_no_chunks_happy(tmp_path):
+    columns = list(make_raw_data().columns)
+    for extension in ['csv', 'parquet', 'feather']:
+        path = str(tmp_path / ('no_chunks.' + extension))
+        with ChunkWriter(path, columns=columns):
+            pass
+
+        chunks = list(read_data_chunks(path))
+        assert list(read_data(path).columns) == columns and len(chunks) == 1 and chunks[0].shape == (0, len(columns))
+
+# unsupported file extension
+def test_chunk_writer_unhappy():
+    try:
+        ChunkWriter('unit_tests/test_chunk_writer_unhappy.txt')
+        assert False
+    except ValueError:
+        assert True
+
+
+# write a feature matrix and train and score a model on its memory-mapped arrays
+def test_read_matrix_happy():
+    write_matrix(make_train_data(), 'unit_tests/test_read_matrix_train.npy', target_column='fare_amount')
+    write_matrix(make_test_data(), 'unit_tests/test_read_matrix_test.npy', target_column='fare_amount')
+    matrix = read_matrix('unit_tests/test_read_matrix_train.npy')
+    model, imp = train_rf_model(matrix, target_column='fare_amount', n_estimators=5)
+    df_pred = score_model(read_matrix('unit_tests/test_read_matrix_test.npy'), model)
+
+    assert isinstance(matrix.X, np.memmap) and matrix.X.dtype == np.float32 \
+        and matrix.columns == list(make_train_data().columns[1:]) and imp.shape[0] == matrix.X.shape[1] \
+        and df_pred.shape == (2, 2)
+
+# target column does not exist
+def test_read_matrix_unhappy():
+    try:
+        write_matrix(make_train_data(), 'unit_tests/test_read_matrix_unhappy.npy', target_column='not_exist')
+        assert False
+    except KeyError:
+        assert True
+
+# a sparse feature matrix is read back as CSR, and the model is trained and scored on it directly
+def test_write_sparse_matrix_happy():
+    df = make_features_data()
+    layout = OneHotLayout(df.columns, {'pickup_dayofweek': list(range(7)), 'pickup_hour': list(range(1, 24))})
+    write_sparse_matrix(layout.encode_sparse(df), df['fare_amount'], 'unit_tests/test_write_sparse_matrix.npz',
+                        layout.features)
+    matrix = read_matrix('unit_tests/test_write_sparse_matrix.npz')
+    model, imp = train_rf_model(matrix, n_estimators=5)
+    df_pred = score_model(matrix, model)
+
+    assert matrix.X.format == 'csr' and matrix.columns == layout.features and imp.shape[0] == len(layout.features) \
+        and df_pred.shape == (4, 2)
+
+# the path does not end with .npz
+def test_write_sparse_matrix_unhappy():
+    df = make_features_data()
+    layout = OneHotLayout(df.columns, {'pickup_dayofweek': list(range(7))})
+    try:
+        write_sparse_matrix(layout.encode_sparse(df), df['fare_amount'], 'unit_tests/test_write_sparse_matrix.npy',
+                            layout.features)
+        assert False
+    except ValueError:
+        assert True
+
+###############
+# Script: src.schema
+###############
+
+# features data is cast to compact dtypes
+def test_apply_schema_happy():
+    df = apply_schema(make_features_data())
+    assert df['pickup_longitude'].dtype == 'float32' and df['passenger_count'].dtype == 'uint8' \
+        and df['pickup_hour'].dtype == 'uint8' and df['pickup_dayofweek'].dtype == 'uint8' \
+        and list(df['pickup_dayofweek']) == [6, 6, 3, 3]
+
+# integer columns with missing values are not cast
+def test_apply_schema_unhappy():
+    df = make_raw_data()
+    df.loc[0, 'passenger_count'] = None
+    df = apply_schema(df)
+    assert df['passenger_count'].dtype == 'float64' and df['fare_amount'].dtype == 'float32'
+
+
+###############
+# Script: src.stage_cache
+###############
+
+# a step is skipped when its inputs and configuration are unchanged, and rerun when forced or its input changes
+def test_run_cached_happy():
+    if not os.path.exists('unit_tests/'):
+        os.makedirs('unit_tests/')
+
+    make_features_data().to_csv('unit_tests/test_run_cached_input.csv', index=False)
+    manifest = 'unit_tests/test_run_cached_manifest.json'
+    if os.path.exists(manifest):
+        os.remove(manifest)
+    args = argparse.Namespace(input='unit_tests/test_run_cached_input.csv', output='unit_tests/test_run_cached.txt',
+                              config='config/config.yaml', manifest=manifest, force=False)
+
+    def func(args):
+        with open(args.output, 'w') as f:
+            f.write('done')
+
+    ran = [run_cached('evaluate', func, args), run_cached('evaluate', func, args)]
+    args.force = True
+    ran.append(run_cached('evaluate', func, args))
+    args.force = False
+    make_features_data().iloc[:2].to_csv('unit_tests/test_run_cached_input.csv', index=False)
+    ran.append(run_cached('evaluate', func, args))
+    assert ran == [True, False, True, True]
+
+# the train step is rerun when the one-hot layout next to the model is missing, which the app needs
+def test_run_cached_encoder_happy():
+    if not os.path.exists('unit_tests/'):
+        os.makedirs('unit_tests/')
+
+    make_train_data().to_csv('unit_tests/test_run_cached_train.csv', index=False)
+    manifest = 'unit_tests/test_run_cached_encoder_manifest.json'
+    if os.path.exists(manifest):
+        os.remove(manifest)
+    args = argparse.Namespace(input='unit_tests/test_run_cached_train.csv', exclude=None,
+                              output_model='unit_tests/test_run_cached_model.pkl',
+                              output_feature_imp='unit_tests/test_run_cached_imp.csv', config='config/config.yaml',
+                              manifest=manifest, force=False)
+
+    def func(args):
+        for path in [args.output_model, args.output_feature_imp, encoder_path(args.output_model)]:
+            with open(path, 'w') as f:
+                f.write('done')
+
+    ran = [run_cached('train', func, args), run_cached('train', func, args)]
+    os.remove(encoder_path(args.output_model))
+    ran.append(run_cached('train', func, args))
+    assert ran == [True, False, True]
+
+# only pipeline steps can be cached
+def test_run_cached_unhappy():
+    try:
+        run_cached('download', print, argparse.Namespace())
+        assert False
+    except ValueError:
+        assert True
+
+
+###############
+# Script: src.metrics
+###############
+
+# rows reported by a chunk loop and file sizes are saved to the metrics report
+def test_stage_metrics_happy(tmp_path):
+    report = str(tmp_path / 'metrics.json')
+    input_path = str(tmp_path / 'input.csv')
+    make_raw_data().to_csv(input_path, index=False)
+
+    with StageMetrics('filter', report) as metrics:
+        metrics.read(input_path)
+        record_chunk(5, 2)
+        record_chunk(3, 1)
+
+    record = json.load(open(report))['stages']['filter']
+    assert record['status'] == 'finished' and record['rows_in'] == 8 and record['rows_out'] == 3 \
+        and record['chunks'] == 2 and record['bytes_read'] == os.path.getsize(input_path)
+
+# a failed step is still recorded, and its error is raised
+def test_stage_metrics_unhappy(tmp_path):
+    report = str(tmp_path / 'metrics.json')
+    try:
+        with StageMetrics('clean', report):
+            raise KeyError('fare_amount')
+    except KeyError:
+        assert json.load(open(report))['runs'][-1]['status'] == 'failed'
+
+# the report keeps only the latest runs, and the latest run of each step
+def test_save_metrics_happy(tmp_path):
+    report = str(tmp_path / 'metrics.json')
+    for i in range(3):
+        save_metrics({'stage': 'filter', 'run': i}, report, max_runs=2)
 
+    saved = json.load(open(report))
+    assert [run['run'] for run in saved['runs']] == [1, 2] and saved['stages']['filter']['run'] == 2